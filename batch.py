@@ -0,0 +1,311 @@
+'''
+Runs the pipeline of the Makefile for many scenarios at once. A
+manifest lists the scenarios, and each becomes the stages
+
+  convert -> sizes, residence, movie -> plots
+
+which are scheduled across scenarios as their inputs are ready,
+while the cores the running stages use stay within a budget.
+As with make, a stage whose outputs are all newer than its inputs
+is skipped. A stage which fails stops the stages after it in the
+same scenario, and the others go on.
+
+The manifest is a CSV file with a row per scenario. The columns are
+id and trace, and optionally herd, to make a movie, and
+initially_infected, a comma-separated list of units for the movie.
+
+  id,trace,herd
+  base,runs/base.out,herds/sc.xml
+  vacc50,runs/vacc50.out,herds/sc.xml
+
+  python batch.py --manifest sweep.csv --output-dir results --cores 32
+
+Outputs of scenario ID go in the directory output-dir/ID, with the
+names the Makefile gives them, and each stage's log in its logs
+directory.
+'''
+import csv
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from default_parser import DefaultArgumentParser
+
+logger=logging.getLogger(__file__)
+
+toolkit=os.path.dirname(os.path.abspath(__file__))
+
+
+class Stage(object):
+    '''
+    One command of one scenario. It can run once the stages it
+    depends on are done, and uses cores of the budget while it runs.
+    '''
+    def __init__(self, name, command, inputs, outputs, cwd, cores=1,
+            depends=None):
+        self.name=name
+        self.command=command
+        self.inputs=inputs
+        self.outputs=outputs
+        self.cwd=cwd
+        self.cores=cores
+        self.depends=depends or list()
+        self.process=None
+        self.state="waiting"
+
+    def current(self):
+        '''True if every output exists and is newer than every input.'''
+        if not all([os.path.exists(x) for x in self.outputs]):
+            return False
+        oldest=min([os.path.getmtime(x) for x in self.outputs])
+        return all([os.path.getmtime(x)<=oldest for x in self.inputs
+            if os.path.exists(x)])
+
+    def start(self):
+        log_directory=os.path.join(self.cwd, "logs")
+        if not os.path.isdir(log_directory):
+            os.makedirs(log_directory)
+        log=open(os.path.join(log_directory,
+            "{0}.log".format(self.name.split(":")[-1])), "w")
+        try:
+            self.process=subprocess.Popen(self.command, cwd=self.cwd,
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        finally:
+            log.close()
+        self.state="running"
+        self.began=time.time()
+
+    def __str__(self):
+        return "{0}: {1}".format(self.name, " ".join(self.command))
+
+
+def python_command(script, *args):
+    return [sys.executable, os.path.join(toolkit, script)]+list(args)
+
+
+def scenario_stages(row, output_dir, convert_jobs=1, movie_jobs=1,
+        cache_dir=None, plots=True, movie=True):
+    '''The stages for one row of the manifest, in an order they can run.'''
+    ID=row["id"]
+    cwd=os.path.abspath(os.path.join(output_dir, ID))
+    if not os.path.isdir(cwd):
+        os.makedirs(cwd)
+    trace=os.path.abspath(row["trace"])
+    data=os.path.join(cwd, "{0}.h5".format(ID))
+    cache=["--cache-dir", cache_dir] if cache_dir else []
+    def named(stage):
+        return "{0}:{1}".format(ID, stage)
+    def output(name):
+        return os.path.join(cwd, name)
+
+    stages=list()
+    convert=Stage(named("convert"), python_command("read_naadsm.py",
+        "--input", trace, "--output", data, "--jobs", str(convert_jobs),
+        "--append", "--final"), [trace], [data], cwd, convert_jobs)
+    stages.append(convert)
+
+    sizes_csv=output("outbreak_hist_{0}.csv".format(ID))
+    sizes=Stage(named("sizes"), python_command("outbreaksize.py",
+        "--input", data, "--output", sizes_csv, *cache), [data], [sizes_csv],
+        cwd, 1, [convert])
+    stages.append(sizes)
+
+    residence_csv=[output("{0}_{1}.csv".format(x, ID))
+        for x in ["susceptible", "latent", "clinical"]]
+    residence=Stage(named("residence"), python_command("residence_histogram.py",
+        "--input", data, "--id", ID, "--format", "weighted", *cache), [data],
+        residence_csv, cwd, 1, [convert])
+    stages.append(residence)
+
+    if movie and row.get("herd"):
+        herd=os.path.abspath(row["herd"])
+        mp4=output("{0}.mp4".format(ID))
+        arguments=["-i", data, "-u", herd, "-o", mp4, "-H", "-j", str(movie_jobs)]
+        if row.get("initially_infected"):
+            arguments.extend(["-I", row["initially_infected"]])
+        if cache_dir:
+            arguments.extend(["-C", cache_dir])
+        stages.append(Stage(named("movie"), python_command("outbreak_movie.py",
+            *arguments), [data, herd], [mp4], cwd, movie_jobs, [convert]))
+
+    if plots:
+        names=[os.path.splitext(os.path.basename(x))[0] for x in residence_csv]
+        stages.append(Stage(named("plots"), python_command("survival.py",
+            "--name", ",".join(names)), residence_csv,
+            [output(x+".pdf") for x in names], cwd, 1, [residence]))
+        plot="outbreak_hist_{0}".format(ID)
+        stages.append(Stage(named("sizes_plot"), python_command("survival.py",
+            "--sizes", plot), [sizes_csv], [output(plot+".pdf")], cwd, 1, [sizes]))
+    return stages
+
+
+def read_manifest(filename):
+    with open(filename) as csvfile:
+        rows=[row for row in csv.DictReader(csvfile)]
+    for idx, row in enumerate(rows):
+        if not row.get("id") or not row.get("trace"):
+            raise ValueError("Row {0} of {1} needs an id and a trace".format(
+                idx+1, filename))
+    return rows
+
+
+class Scheduler(object):
+    '''
+    Starts stages whose dependencies are done, in the order given,
+    while the cores of running stages fit in the budget. A stage
+    which needs more cores than the budget runs when nothing else does.
+    '''
+    poll_seconds=0.05
+
+    def __init__(self, stages, cores):
+        self.stages=stages
+        self.cores=cores
+
+    def ready(self, stage):
+        return all([x.state in ("done", "skipped") for x in stage.depends])
+
+    def blocked(self, stage):
+        return any([x.state in ("failed", "blocked") for x in stage.depends])
+
+    def run(self):
+        '''Runs every stage and returns the number which failed.'''
+        running=list()
+        while True:
+            for stage in self.stages:
+                if stage.state!="waiting":
+                    continue
+                if self.blocked(stage):
+                    stage.state="blocked"
+                    logger.warning("{0} not run, as an earlier stage failed".format(
+                        stage.name))
+                elif self.ready(stage):
+                    used=sum([x.cores for x in running])
+                    if used+stage.cores>self.cores and len(running)>0:
+                        continue
+                    # Dependencies which ran have made their outputs newer.
+                    if stage.current():
+                        stage.state="skipped"
+                        logger.info("{0} is up to date".format(stage.name))
+                        continue
+                    logger.info("Starting {0}".format(stage))
+                    try:
+                        stage.start()
+                    except OSError as err:
+                        stage.state="failed"
+                        logger.error("{0} could not start: {1}".format(
+                            stage.name, err))
+                        continue
+                    running.append(stage)
+            if len(running)==0:
+                break
+            time.sleep(self.poll_seconds)
+            for stage in list(running):
+                code=stage.process.poll()
+                if code is None:
+                    continue
+                running.remove(stage)
+                if code==0:
+                    stage.state="done"
+                    logger.info("{0} done in {1:.1f} s".format(stage.name,
+                        time.time()-stage.began))
+                else:
+                    stage.state="failed"
+                    logger.error("{0} failed with code {1}, see {2}/logs".format(
+                        stage.name, code, stage.cwd))
+        return len([x for x in self.stages if x.state=="failed"])
+
+
+def batch(manifest, output_dir, cores, convert_jobs=1, movie_jobs=1,
+        cache_dir=None, plots=True, movie=True, dry_run=False):
+    stages=list()
+    for row in read_manifest(manifest):
+        stages.extend(scenario_stages(row, output_dir, convert_jobs,
+            movie_jobs, cache_dir, plots, movie))
+    if dry_run:
+        for stage in stages:
+            print("{0}{1}".format("" if not stage.current() else "(current) ",
+                stage))
+        return 0
+    return Scheduler(stages, cores).run()
+
+
+class BatchTest(unittest.TestCase):
+    '''Runs a small graph of stages which copy files.'''
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.source=os.path.join(self.directory, "source")
+        with open(self.source, "w") as f:
+            f.write("input")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def copy(self, name, source, target, depends=None):
+        return Stage(name, [sys.executable, "-c",
+            "import shutil,sys; shutil.copyfile(sys.argv[1], sys.argv[2])",
+            source, target], [source], [target], self.directory, 1, depends)
+
+    def graph(self):
+        first=self.copy("s:first", self.source, os.path.join(self.directory, "a"))
+        return [first, self.copy("s:second", first.outputs[0],
+            os.path.join(self.directory, "b"), [first]),
+            self.copy("s:third", first.outputs[0],
+            os.path.join(self.directory, "c"), [first])]
+
+    def test_run(self):
+        stages=self.graph()
+        self.assertEqual(Scheduler(stages, 2).run(), 0)
+        self.assertEqual([x.state for x in stages], ["done"]*3)
+        stages=self.graph()
+        Scheduler(stages, 2).run()
+        self.assertEqual([x.state for x in stages], ["skipped"]*3)
+        later=time.time()+10
+        os.utime(self.source, (later, later))
+        stages=self.graph()
+        Scheduler(stages, 2).run()
+        self.assertEqual([x.state for x in stages], ["done"]*3)
+
+    def test_failure(self):
+        os.remove(self.source)
+        stages=self.graph()
+        self.assertEqual(Scheduler(stages, 4).run(), 1)
+        self.assertEqual([x.state for x in stages], ["failed", "blocked", "blocked"])
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(BatchTest)
+
+
+
+if __name__ == "__main__":
+    parser=DefaultArgumentParser(description="Runs the pipeline for many scenarios",
+        suite=suite)
+    parser.add_argument("--manifest", dest="manifest", action="store",
+        default="manifest.csv", help="CSV with columns id, trace and optionally "+
+        "herd and initially_infected")
+    parser.add_argument("--output-dir", dest="output_dir", action="store",
+        default=".", help="Outputs of scenario ID go in output-dir/ID")
+    parser.add_argument("--cores", dest="cores", action="store", type=int,
+        default=os.cpu_count() or 1, help="Cores used by stages running at once")
+    parser.add_argument("--convert-jobs", dest="convert_jobs", action="store",
+        type=int, default=1, help="Processes for each trace conversion")
+    parser.add_argument("--movie-jobs", dest="movie_jobs", action="store",
+        type=int, default=1, help="Processes for each movie")
+    parser.add_argument("--cache-dir", dest="cache_dir", action="store",
+        default=None, help="Result cache for the analysis scripts")
+    parser.add_argument("--no-plots", dest="no_plots", action="store_true",
+        default=False, help="Skip the plots")
+    parser.add_argument("--no-movie", dest="no_movie", action="store_true",
+        default=False, help="Skip movies, even for rows with a herd")
+    parser.add_argument("--dry-run", dest="dry_run", action="store_true",
+        default=False, help="List the stages without running them")
+    args=parser.parse_args()
+
+    failed=batch(args.manifest, args.output_dir, args.cores, args.convert_jobs,
+        args.movie_jobs, args.cache_dir, not args.no_plots, not args.no_movie,
+        args.dry_run)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,255 @@
+'''
+Times the stages of the toolkit on synthetic data, so that versions
+can be compared without real scenario output. It writes a NAADSM/SC
+trace ("node n run r" headers and digit states), a GUI trace
+("Iteration r" headers and letter states), a matching HDF5 event file
+and a herd XML file, then times and measures the peak memory of each
+stage, with tracemalloc, and writes the results as JSON.
+
+  python benchmark.py --units 5000 --days 365 --runs 20 --output bench.json
+  python benchmark.py --compare old.json --output new.json
+'''
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import h5py
+from default_parser import DefaultArgumentParser
+import read_naadsm
+import eventfile
+
+logger=logging.getLogger(__file__)
+
+# GUI state letters, in state order, as decoded by read_naadsm.state_bytes.
+gui_letters=b"SLBCNVD"
+production_types=["Broilers", "Layers", "Turkeys"]
+
+
+def run_states(unit_cnt, day_cnt, attack_rate, seed, run):
+    return read_naadsm.synthetic_states(unit_cnt, day_cnt, attack_rate,
+        seed*1000003+run)
+
+
+def state_lines(states, symbols):
+    '''Lines of space-separated state symbols, one per day, as bytes.'''
+    table=np.frombuffer(symbols, dtype=np.uint8)
+    chars=np.full((states.shape[0], 2*states.shape[1]), ord(" "), dtype=np.uint8)
+    chars[:, 0::2]=table[states]
+    chars[:, -1]=ord("\n")
+    return chars.tobytes()
+
+
+def write_sc_trace(filename, unit_cnt, day_cnt, run_cnt, attack_rate=0.5, seed=0):
+    '''A NAADSM/SC trace, with a "node 0 run r" line before each day.'''
+    with open(filename, "wb") as f:
+        for run in range(run_cnt):
+            states=run_states(unit_cnt, day_cnt, attack_rate, seed, run)
+            lines=state_lines(states, b"0123456")
+            width=len(lines)//day_cnt
+            header="node 0 run {0}\n".format(run).encode()
+            for day in range(day_cnt):
+                f.write(header)
+                f.write(lines[day*width:(day+1)*width])
+
+
+def write_gui_trace(filename, unit_cnt, day_cnt, run_cnt, attack_rate=0.5, seed=0):
+    '''A GUI trace, with an "Iteration r" line before each run.'''
+    with open(filename, "wb") as f:
+        for run in range(run_cnt):
+            states=run_states(unit_cnt, day_cnt, attack_rate, seed, run)
+            f.write("Iteration {0}\n".format(run+1).encode())
+            f.write(state_lines(states, gui_letters))
+            f.write(b"\n")
+
+
+def write_events(filename, unit_cnt, day_cnt, run_cnt, attack_rate=0.5, seed=0,
+        layout=None):
+    '''The event file which converting either trace would make.'''
+    table=read_naadsm.transition_table(read_naadsm.default_transitions())
+    with h5py.File(filename, "w") as f:
+        f.create_group("/trajectory")
+        writer=read_naadsm.EventWriter(f, layout=layout)
+        for run in range(run_cnt):
+            states=run_states(unit_cnt, day_cnt, attack_rate, seed, run)
+            writer.save(read_naadsm.state_changes(states, table)[0], unit_cnt)
+
+
+def write_herd(filename, unit_cnt, seed=0):
+    '''A herd file with units scattered over a box around South Carolina.'''
+    rng=np.random.RandomState(seed)
+    latitude=rng.uniform(32.0, 35.0, unit_cnt)
+    longitude=rng.uniform(-83.0, -79.0, unit_cnt)
+    kind=rng.randint(0, len(production_types), unit_cnt)
+    size=rng.randint(100, 50000, unit_cnt)
+    with open(filename, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<naadsm:herds xmlns:naadsm="http://www.naadsm.org/schema" '+
+            'xmlns:xsd="http://www.w3.org/2001/XMLSchema" '+
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
+        for idx in range(unit_cnt):
+            f.write(("  <herd>\n    <id>{0}</id>\n"+
+                "    <production-type>{1}</production-type>\n"+
+                "    <size>{2}</size>\n    <location>\n"+
+                "      <latitude>{3:.5f}</latitude>\n"+
+                "      <longitude>{4:.5f}</longitude>\n    </location>\n"+
+                "    <status>{5}</status>\n  </herd>\n").format(idx+1,
+                production_types[kind[idx]], size[idx], latitude[idx],
+                longitude[idx], "Latent" if idx==0 else "Susceptible"))
+        f.write("</naadsm:herds>\n")
+
+
+def measure(name, function, memory=True):
+    '''
+    Calls function and returns its result and a dictionary of the
+    stage name, wall and CPU seconds, and peak bytes allocated
+    while it ran, as traced by tracemalloc.
+    '''
+    if memory:
+        tracemalloc.start()
+    wall=time.perf_counter()
+    cpu=time.process_time()
+    result=function()
+    record={"stage" : name, "seconds" : time.perf_counter()-wall,
+        "cpu_seconds" : time.process_time()-cpu}
+    if memory:
+        record["peak_bytes"]=tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    logger.info("{0} {1:.3f} s".format(name, record["seconds"]))
+    return result, record
+
+
+def movie_frames(event_file, herd_file, frame_cnt):
+    '''Renders frame_cnt frames of the first run, off screen.'''
+    import matplotlib
+    matplotlib.use("Agg")
+    import locations
+    import outbreak_movie
+    latlon=locations.load_herd_locations(herd_file)
+    with eventfile.EventFile(event_file) as f:
+        run=f.run(0)
+        event, who, whom, when=[np.asarray(run[x]) for x in eventfile.column_names]
+    # The movie numbers units from one. Longitude and latitude scaled
+    # to the unit square stand in for a projection, to not need pyproj.
+    setup={"locations_scaled" : outbreak_movie.scale_unit_square(latlon[:, ::-1]),
+        "event" : event, "who" : who+1, "whom" : whom+1, "when" : when,
+        "initially_infected" : [1], "frame_cnt" : frame_cnt,
+        "end_time" : max(float(when[-1]) if len(when)>0 else 1.0, 1.0),
+        "figsize" : (7,7), "dpi" : 100}
+    return len(outbreak_movie.render_frames((setup, 0, frame_cnt)))
+
+
+def revision():
+    '''The git commit of this checkout, if there is one.'''
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(directory, unit_cnt, day_cnt, run_cnt, attack_rate=0.5,
+        seed=0, jobs=1, frame_cnt=25, layout=None, memory=True):
+    '''Generates inputs in directory and returns a record of each stage.'''
+    import outbreaksize
+    import residence_histogram
+    import locations
+    names=dict([(x, os.path.join(directory, y)) for (x, y) in [
+        ("sc", "naadsm_sc.out"), ("gui", "naadsm_gui.out"),
+        ("events", "events.h5"), ("herd", "herd.xml"),
+        ("sc_h5", "sc.h5"), ("gui_h5", "gui.h5")]])
+    args=(unit_cnt, day_cnt, run_cnt, attack_rate, seed)
+    stages=list()
+    for name, function in [
+            ("generate_sc_trace", lambda: write_sc_trace(names["sc"], *args)),
+            ("generate_gui_trace", lambda: write_gui_trace(names["gui"], *args)),
+            ("generate_events", lambda: write_events(names["events"], *args,
+                layout=layout)),
+            ("generate_herd", lambda: write_herd(names["herd"], unit_cnt, seed)),
+            ("sc_trace_to_h5", lambda: read_naadsm.read_multiple_naadsmsc(
+                names["sc"], names["sc_h5"], jobs=jobs, layout=layout)),
+            ("gui_trace_to_h5", lambda: read_naadsm.read_multiple_naadsmsc(
+                names["gui"], names["gui_h5"], jobs=jobs, layout=layout)),
+            ("run_sizes", lambda: outbreaksize.run_sizes(names["events"])),
+            ("tracking", lambda: residence_histogram.foreach_dataset(
+                names["events"], residence_histogram.Tracking())),
+            # The first load parses the file and writes its cache.
+            ("landscape_parse", lambda: locations.load_naadsm_herd(names["herd"])),
+            ("landscape_cached", lambda: locations.load_naadsm_herd(names["herd"])),
+            ("movie_frames", lambda: movie_frames(names["events"], names["herd"],
+                frame_cnt))]:
+        result, record=measure(name, function, memory)
+        stages.append(record)
+    for name in ["sc", "gui", "events", "herd"]:
+        stages.append({"stage" : "size_{0}".format(name),
+            "bytes" : os.path.getsize(names[name])})
+    return stages
+
+
+def compare(old, new):
+    '''Logs the ratio of new to old seconds for stages in both.'''
+    before=dict([(x["stage"], x) for x in old["stages"] if "seconds" in x])
+    for record in new["stages"]:
+        if record["stage"] in before and "seconds" in record:
+            ratio=record["seconds"]/max(before[record["stage"]]["seconds"], 1e-9)
+            logger.info("{0} {1:.3f} s, {2:.2f} times {3}".format(record["stage"],
+                record["seconds"], ratio, old.get("revision")))
+
+
+
+if __name__ == "__main__":
+    parser=DefaultArgumentParser(description="Times each stage on synthetic data")
+    parser.add_argument("--units", dest="units", action="store", type=int,
+        default=1000, help="Number of units")
+    parser.add_argument("--days", dest="days", action="store", type=int,
+        default=120, help="Number of days in each run")
+    parser.add_argument("--runs", dest="runs", action="store", type=int,
+        default=10, help="Number of runs")
+    parser.add_argument("--attack-rate", dest="attack_rate", action="store",
+        type=float, default=0.5, help="Fraction of units infected in a run")
+    parser.add_argument("--seed", dest="seed", action="store", type=int,
+        default=0, help="Seed for the synthetic data")
+    parser.add_argument("--jobs", dest="jobs", action="store", type=int,
+        default=1, help="Processes for converting traces")
+    parser.add_argument("--frames", dest="frames", action="store", type=int,
+        default=25, help="Number of movie frames to render")
+    parser.add_argument("--layout", dest="layout", action="store",
+        choices=["groups", "table"], default=None, help="Event file layout")
+    parser.add_argument("--directory", dest="directory", action="store",
+        default=None, help="Keep generated files here instead of a temporary directory")
+    parser.add_argument("--output", dest="outfile", action="store",
+        default="benchmark.json", help="JSON file of results")
+    parser.add_argument("--compare", dest="compare", action="store",
+        default=None, help="JSON file of earlier results to compare with")
+    parser.add_function("no_memory", "time stages without tracemalloc")
+    args=parser.parse_args()
+
+    directory=args.directory or tempfile.mkdtemp()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    try:
+        stages=run_benchmark(directory, args.units, args.days, args.runs,
+            args.attack_rate, args.seed, args.jobs, args.frames, args.layout,
+            not args.no_memory)
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory)
+    results={"revision" : revision(), "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python" : platform.python_version(), "numpy" : np.__version__,
+        "h5py" : h5py.__version__, "machine" : platform.platform(),
+        "parameters" : {"units" : args.units, "days" : args.days,
+            "runs" : args.runs, "attack_rate" : args.attack_rate,
+            "seed" : args.seed, "jobs" : args.jobs, "frames" : args.frames,
+            "layout" : args.layout, "memory" : not args.no_memory},
+        "stages" : stages}
+    with open(args.outfile, "w") as f:
+        json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,272 @@
+'''
+A cache of the output files of analysis stages, kept in a directory.
+Each stage's outputs are keyed by a hash of the contents of its input
+files and of the arguments which change what it writes, so running a
+stage again on the same event file copies its outputs from the cache
+instead of computing them.
+
+The key also holds hashes of the source of the running script and
+of the toolkit modules it imported, so editing the code which made
+an output stops it being reused. Hashing a large event file takes
+time, so the hash of each file is remembered by its path, size and
+modification time. Entries are directories named by their key. The
+cache is kept under a size limit by removing the entries used least
+recently.
+'''
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from default_parser import DefaultArgumentParser
+
+logger=logging.getLogger(__file__)
+
+default_max_bytes=1<<30
+# Changes whenever the layout of entries or keys changes.
+cache_version=2
+fingerprint_file="fingerprints.json"
+manifest_file="manifest.json"
+
+
+def file_digest(filename, block_size=1<<20):
+    '''sha1 of the contents of a file.'''
+    digest=hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def code_files():
+    '''The running script and the modules it imported from this directory.'''
+    toolkit=os.path.dirname(os.path.abspath(__file__))
+    files=set()
+    for module in list(sys.modules.values()):
+        filename=getattr(module, "__file__", None)
+        if filename is None or not filename.endswith(".py"):
+            continue
+        filename=os.path.abspath(filename)
+        if os.path.dirname(filename)==toolkit:
+            files.add(filename)
+    return sorted(files)
+
+
+def directory_size(directory):
+    total=0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            total+=os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class ResultCache(object):
+    '''
+    Output files of stages, in directory, up to max_bytes in total.
+    run() is the usual way in. It looks up the key made from the
+    stage, its inputs and arguments, and copies the outputs into
+    place on a hit, or calls compute and stores the outputs on a miss.
+    '''
+    def __init__(self, directory, max_bytes=default_max_bytes):
+        self.directory=directory
+        self.max_bytes=max_bytes
+        self.entries=os.path.join(directory, "entries")
+        if not os.path.isdir(self.entries):
+            os.makedirs(self.entries)
+        self.fingerprints=self.load_fingerprints()
+
+    def load_fingerprints(self):
+        try:
+            with open(os.path.join(self.directory, fingerprint_file)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict()
+
+    def save_fingerprints(self):
+        filename=os.path.join(self.directory, fingerprint_file)
+        partial="{0}.{1}".format(filename, os.getpid())
+        with open(partial, "w") as f:
+            json.dump(self.fingerprints, f)
+        os.replace(partial, filename)
+
+    def fingerprint(self, filename):
+        '''Hash of a file's contents, computed again only when it changes.'''
+        path=os.path.realpath(filename)
+        stat=os.stat(path)
+        stamp=[stat.st_size, stat.st_mtime_ns]
+        known=self.fingerprints.get(path)
+        if known is not None and known[0]==stamp:
+            return known[1]
+        logger.debug("Hashing {0}".format(filename))
+        digest=file_digest(path)
+        self.fingerprints[path]=[stamp, digest]
+        self.save_fingerprints()
+        return digest
+
+    def key(self, stage, inputs, arguments, sources=None):
+        '''
+        Hash of the stage, its inputs and arguments, and the source
+        files of its code, by default those of code_files.
+        '''
+        sources=code_files() if sources is None else sources
+        description=json.dumps({"version" : cache_version, "stage" : stage,
+            "inputs" : [self.fingerprint(x) for x in inputs],
+            "arguments" : arguments,
+            "code" : [self.fingerprint(x) for x in sources]}, sort_keys=True)
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.entries, key)
+
+    def lookup(self, key, outputs):
+        '''Copies the stored outputs to the paths in outputs, if there are any.'''
+        entry=self.entry(key)
+        try:
+            with open(os.path.join(entry, manifest_file)) as f:
+                count=json.load(f)["count"]
+        except (IOError, ValueError, KeyError):
+            return False
+        if count!=len(outputs):
+            return False
+        for idx, output in enumerate(outputs):
+            shutil.copyfile(os.path.join(entry, str(idx)), output)
+        # The entry's modification time marks when it was last used.
+        os.utime(entry, None)
+        return True
+
+    def store(self, key, outputs):
+        '''Copies outputs into an entry, then evicts old entries.'''
+        partial=tempfile.mkdtemp(dir=self.entries, prefix=".partial")
+        try:
+            for idx, output in enumerate(outputs):
+                shutil.copyfile(output, os.path.join(partial, str(idx)))
+            with open(os.path.join(partial, manifest_file), "w") as f:
+                json.dump({"count" : len(outputs), "outputs" : outputs}, f)
+            entry=self.entry(key)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(partial, entry)
+        except OSError:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+        self.evict()
+
+    def evict(self):
+        '''Removes least recently used entries until under max_bytes.'''
+        entries=list()
+        for name in os.listdir(self.entries):
+            path=os.path.join(self.entries, name)
+            if not name.startswith("."):
+                entries.append((os.path.getmtime(path), directory_size(path), path))
+        total=sum([x[1] for x in entries])
+        for used, size, path in sorted(entries):
+            if total<=self.max_bytes:
+                break
+            logger.debug("Evicting {0}".format(path))
+            shutil.rmtree(path, ignore_errors=True)
+            total-=size
+
+    def run(self, stage, inputs, arguments, outputs, compute):
+        '''
+        Makes the output files of a stage, from the cache if it has
+        them. arguments is a dictionary of whatever else changes the
+        outputs. compute is called with no arguments on a miss.
+        Returns True on a hit.
+        '''
+        key=self.key(stage, inputs, arguments)
+        if self.lookup(key, outputs):
+            logger.info("{0} outputs from cache {1}".format(stage, key))
+            return True
+        compute()
+        self.store(key, outputs)
+        return False
+
+
+def cached(directory, max_bytes, stage, inputs, arguments, outputs, compute):
+    '''
+    Runs a stage through a ResultCache in directory, or calls compute
+    directly when directory is None.
+    '''
+    if directory is None:
+        compute()
+        return False
+    return ResultCache(directory, max_bytes).run(stage, inputs, arguments,
+        outputs, compute)
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.input=os.path.join(self.directory, "input.txt")
+        with open(self.input, "w") as f:
+            f.write("events")
+        self.output=os.path.join(self.directory, "output.txt")
+        self.calls=0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def compute(self):
+        self.calls+=1
+        with open(self.output, "w") as f:
+            f.write("result {0}".format(self.calls))
+
+    def test_hit(self):
+        cache=ResultCache(os.path.join(self.directory, "cache"))
+        self.assertFalse(cache.run("s", [self.input], {"a" : 1}, [self.output], self.compute))
+        os.remove(self.output)
+        self.assertTrue(cache.run("s", [self.input], {"a" : 1}, [self.output], self.compute))
+        with open(self.output) as f:
+            self.assertEqual(f.read(), "result 1")
+        self.assertFalse(cache.run("s", [self.input], {"a" : 2}, [self.output], self.compute))
+        with open(self.input, "w") as f:
+            f.write("changed events")
+        self.assertFalse(cache.run("s", [self.input], {"a" : 1}, [self.output], self.compute))
+        self.assertEqual(self.calls, 3)
+
+    def test_code(self):
+        cache=ResultCache(os.path.join(self.directory, "cache"))
+        source=os.path.join(self.directory, "stage.py")
+        with open(source, "w") as f:
+            f.write("version 1")
+        before=cache.key("s", [self.input], {}, [source])
+        self.assertEqual(before, cache.key("s", [self.input], {}, [source]))
+        with open(source, "w") as f:
+            f.write("version 2")
+        self.assertNotEqual(before, cache.key("s", [self.input], {}, [source]))
+        self.assertIn(os.path.abspath(__file__), code_files())
+
+    def test_evict(self):
+        cache=ResultCache(os.path.join(self.directory, "cache"))
+        for a in range(4):
+            cache.run("s", [self.input], {"a" : a}, [self.output], self.compute)
+            os.utime(cache.entry(cache.key("s", [self.input], {"a" : a})),
+                (a, a))
+        newest=cache.entry(cache.key("s", [self.input], {"a" : 3}))
+        cache.max_bytes=directory_size(newest)
+        cache.evict()
+        self.assertEqual(os.listdir(cache.entries), [os.path.basename(newest)])
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(CacheTest)
+
+
+
+if __name__ == "__main__":
+    parser=DefaultArgumentParser(description="Result cache for analysis stages",
+        suite=suite)
+    parser.add_argument("--cache-dir", dest="cache_dir", action="store",
+        default=None, help="Cache directory to trim or clear")
+    parser.add_argument("--cache-size", dest="cache_size", action="store",
+        type=int, default=default_max_bytes>>20, help="Size limit in MB")
+    parser.add_function("clear", "remove every entry")
+    args=parser.parse_args()
+    if args.cache_dir is not None:
+        cache=ResultCache(args.cache_dir, 0 if args.clear else args.cache_size<<20)
+        cache.evict()
+        logger.info("{0} holds {1} bytes".format(args.cache_dir,
+            directory_size(cache.entries)))
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import sys, getopt, io
+import sys, getopt, io, os, codecs, re, multiprocessing
 
 def print_usage():
     s = """
@@ -9,36 +9,101 @@ def print_usage():
     to a UTF-8 encoded file in <output_filename> .  
     If -o <output_filename> is not specified, output is written to a
     file named converted_xml.xml .
+
+    python convert_naadsm_xml.py -d <input_directory> -o <output_directory> -j <jobs>
+
+    converts every .xml file in <input_directory> to a file of the
+    same name in <output_directory>, using <jobs> processes.
+    If -j is not specified, one process per core is used.
     python convert_naadsm_xml.py -h prints this usage statement ."""
     print(s)
 
-options, arguments = getopt.getopt(sys.argv[1:], "i:o:h")
-input_file = None
-output_file = "converted_xml.xml"
-for option, value in options:
-    if option == "-i":
-        input_file = value
-    if option == "-o":
-        output_file = value
-    if option == "-h":
-        print_usage()
-        exit()
+# Size of each block read from the input file, in bytes.
+block_size = 1 << 20
 
-with io.open(input_file,'r',encoding='utf16') as source_file:
-    contents = source_file.read()
+encoding_declaration = re.compile(r"""(encoding\s*=\s*["'])UTF-16(["'])""",
+    re.IGNORECASE)
 
-source_file.close()
+def rewrite_declaration(text):
+    """
+    Changes the encoding named in the XML declaration at the start
+    of text, if there is one, and leaves the rest of text alone.
+    """
+    if not text.startswith("<?xml"):
+        return text
+    end = text.find("?>")
+    if end < 0:
+        return text
+    declaration = encoding_declaration.sub(r"\1UTF-8\2", text[:end])
+    return declaration + text[end:]
 
-with io.open(output_file,'w',encoding='utf8') as dest_file:
-    dest_file.write(contents.replace('UTF-16','UTF-8'))
+def convert(input_file, output_file):
+    """
+    Streams a UTF-16 file to UTF-8 in blocks. Line endings become
+    newlines, as reading the file as text always did.
+    """
+    decoder = io.IncrementalNewlineDecoder(
+        codecs.getincrementaldecoder('utf16')(), translate=True)
+    head = ""
+    with io.open(input_file, 'rb') as source_file:
+        with io.open(output_file, 'w', encoding='utf8') as dest_file:
+            while True:
+                data = source_file.read(block_size)
+                text = decoder.decode(data, final=not data)
+                if head is not None:
+                    # Hold text until the declaration is complete.
+                    head += text
+                    if data and ("<?xml".startswith(head) or
+                            (head.startswith("<?xml") and "?>" not in head)):
+                        continue
+                    text = rewrite_declaration(head)
+                    head = None
+                dest_file.write(text)
+                if not data:
+                    break
 
-dest_file.close()
+def convert_pair(names):
+    convert(*names)
+    return names[1]
 
-#
-#with open(input_file, 'r') as source_file:
-#  with open(output_file, 'w') as dest_file:
-#    contents = source_file.read()
-#    dest_file.write(contents.decode('utf-16').replace('UTF-16','UTF-8').encode('utf-8'))
+def convert_directory(input_directory, output_directory, jobs=None):
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+    pairs = [(os.path.join(input_directory, name),
+              os.path.join(output_directory, name))
+             for name in sorted(os.listdir(input_directory))
+             if name.lower().endswith(".xml")]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for output_file in pool.imap_unordered(convert_pair, pairs):
+            print("wrote %s" % output_file)
+    finally:
+        pool.close()
+        pool.join()
 
+if __name__ == "__main__":
+    options, arguments = getopt.getopt(sys.argv[1:], "i:o:d:j:h")
+    input_file = None
+    input_directory = None
+    output_file = None
+    jobs = None
+    for option, value in options:
+        if option == "-i":
+            input_file = value
+        if option == "-o":
+            output_file = value
+        if option == "-d":
+            input_directory = value
+        if option == "-j":
+            jobs = int(value)
+        if option == "-h":
+            print_usage()
+            exit()
 
-    
+    if input_directory is not None:
+        if output_file is None:
+            print("Error: must specify an output directory, using -o flag")
+            exit()
+        convert_directory(input_directory, output_file, jobs)
+    else:
+        convert(input_file, output_file or "converted_xml.xml")
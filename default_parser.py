@@ -8,13 +8,109 @@ switches to tell them which little thing to do.
 This augments the argument parser to make it a little easier to
 add boolean switches that determine what the script should do.
 This parser also gives some default behavior for how verbose
-and quiet switches affect logging.
+and quiet switches affect logging, and switches to profile a script.
+
+Code marks its stages with timed(), which keeps counts of calls,
+seconds and whatever the stage counts, such as rows or bytes.
+
+  with timed("save_h5", rows=len(events[0])):
+      ...
+
+--timing logs these at exit as totals, per-call latency and rates.
+--trace-memory adds the peak memory allocated within each stage.
+--profile FILE saves cProfile statistics and logs the top functions.
 '''
+import atexit
+import contextlib
 import sys
+import time
+import tracemalloc
 from argparse import ArgumentParser
 import logging
 import unittest
 
+logger=logging.getLogger(__file__)
+
+
+class Stage(object):
+    '''Totals for every call of one named stage.'''
+    def __init__(self, name):
+        self.name=name
+        self.calls=0
+        self.seconds=0.0
+        self.max_seconds=0.0
+        self.counts=dict()
+        self.peak_bytes=None
+
+    def add(self, seconds, counts, peak_bytes=None):
+        self.calls+=1
+        self.seconds+=seconds
+        self.max_seconds=max(self.max_seconds, seconds)
+        for key, value in counts.items():
+            self.counts[key]=self.counts.get(key, 0)+value
+        if peak_bytes is not None:
+            self.peak_bytes=max(self.peak_bytes or 0, peak_bytes)
+
+    def __str__(self):
+        text=["{0}: {1} calls, {2:.3f} s, {3:.3g} s per call, {4:.3g} s max".format(
+            self.name, self.calls, self.seconds, self.seconds/max(self.calls, 1),
+            self.max_seconds)]
+        for key in sorted(self.counts.keys()):
+            text.append("{0} {1} ({2:.4g}/s)".format(key, self.counts[key],
+                self.counts[key]/max(self.seconds, 1e-9)))
+        if self.peak_bytes is not None:
+            text.append("peak {0:.4g} MB".format(self.peak_bytes/float(1<<20)))
+        return ", ".join(text)
+
+
+# Stages timed in this process, by name.
+stages=dict()
+
+
+@contextlib.contextmanager
+def timed(name, **counts):
+    '''
+    Times the block as one call of stage name. Keyword arguments
+    are counts to add, and the block may add more to the dictionary
+    it is given. With tracemalloc on, the peak of memory allocated
+    within the block is kept too. Nested stages reset the peak, so
+    it is right for the innermost one.
+    '''
+    tracing=tracemalloc.is_tracing()
+    if tracing:
+        before=tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    begin=time.perf_counter()
+    try:
+        yield counts
+    finally:
+        seconds=time.perf_counter()-begin
+        peak=tracemalloc.get_traced_memory()[1]-before if tracing else None
+        stages.setdefault(name, Stage(name)).add(seconds, counts, peak)
+
+
+def count(name, **counts):
+    '''Adds counts to a stage without timing anything.'''
+    stage=stages.setdefault(name, Stage(name))
+    for key, value in counts.items():
+        stage.counts[key]=stage.counts.get(key, 0)+value
+
+
+def report():
+    for name in sorted(stages.keys()):
+        logger.info(str(stages[name]))
+
+
+def save_profile(profile, filename):
+    import io
+    import pstats
+    profile.disable()
+    profile.dump_stats(filename)
+    text=io.StringIO()
+    pstats.Stats(profile, stream=text).sort_stats("cumulative").print_stats(20)
+    logger.info("Profile saved to {0}\n{1}".format(filename, text.getvalue()))
+
+
 class DefaultArgumentParser(ArgumentParser):
     '''This adds some default behaviors to the argument parsing.
     Default logging level is INFO.
@@ -38,6 +134,12 @@ class DefaultArgumentParser(ArgumentParser):
                           default=False,help='print debug messages')
         self.add_argument('-q','--quiet',dest='quiet',action='store_true',
                           default=False,help='print only exceptions')
+        self.add_argument('--profile',dest='profile',action='store',
+                          default=None,help='save cProfile statistics to this file')
+        self.add_argument('--trace-memory',dest='trace_memory',action='store_true',
+                          default=False,help='report peak memory of each timed stage')
+        self.add_argument('--timing',dest='timing',action='store_true',
+                          default=False,help='report time and counts of each stage')
         self._functions=list()
         if self.tests:
             self.add_function('test','run unit tests in this module')
@@ -72,6 +174,16 @@ class DefaultArgumentParser(ArgumentParser):
             log_level=logging.ERROR
         logging.basicConfig(level=log_level)
 
+        if args.trace_memory:
+            tracemalloc.start()
+        if args.timing or args.trace_memory:
+            atexit.register(report)
+        if args.profile:
+            import cProfile
+            profile=cProfile.Profile()
+            atexit.register(save_profile, profile, args.profile)
+            profile.enable()
+
         if 'test' in dir(args) and args.test:
             unittest.TextTestRunner(verbosity=2).run(self.tests())
             sys.exit(0)
@@ -0,0 +1,238 @@
+'''
+Counts of units in each disease state on each day, for every run
+of an HDF5 event file, reduced across runs to the mean, quantiles
+and maximum. These are the epicurves of the ensemble.
+
+Each event code is turned back into its previous and next state
+with read_naadsm.transition_states. A run's counts come from a
+(day x state) array of changes, where each event subtracts one from
+its previous state and adds one to its next state on its day, and
+a cumulative sum over days. A unit starts in the previous state of
+its first event. Units without events are counted as susceptible.
+After a run's last event its counts stay the same to the last day
+of the ensemble.
+'''
+import csv
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import h5py
+from default_parser import DefaultArgumentParser
+import eventfile
+import read_naadsm
+
+logger=logging.getLogger(__file__)
+
+state_names=["susceptible", "latent", "subclinical", "clinical",
+    "naturally_immune", "vaccine_immune", "destroyed"]
+default_quantiles=[0.05, 0.5, 0.95]
+
+
+def run_curve(run, states, unit_cnt, day_cnt):
+    '''
+    A (day x state) array of counts of units in each state on days 0
+    to day_cnt-1 for one run. states is (previous, next) from
+    read_naadsm.transition_states.
+    '''
+    previous, next=states
+    events=np.asarray(run["Event"])
+    whom=np.asarray(run["Whom"])
+    day=np.minimum(np.asarray(run["When"]).astype(np.int64), day_cnt-1)
+    codes=np.clip(events, 0, len(previous)-1)
+    bad=(codes!=events) | (previous[codes]<0)
+    if np.any(bad):
+        raise ValueError("Event {0} is not a change of state".format(events[bad][0]))
+    delta=np.zeros((day_cnt, read_naadsm.state_cnt), dtype=np.int64)
+    np.add.at(delta, (day, previous[events]), -1)
+    np.add.at(delta, (day, next[events]), 1)
+    # Events are in time order, so the first index of each unit
+    # is its first event.
+    units, first=np.unique(whom, return_index=True)
+    delta[0]+=np.bincount(previous[events[first]], minlength=read_naadsm.state_cnt)
+    delta[0, 0]+=max(unit_cnt-len(units), 0)
+    return np.cumsum(delta, axis=0)
+
+
+def ensemble_size(f):
+    '''Units and days for the curves of an open EventFile.'''
+    unit_cnt=f.unit_count()
+    if unit_cnt is None:
+        unit_cnt=0
+        for run in f:
+            whom=run["Whom"]
+            if len(whom)>0:
+                unit_cnt=max(unit_cnt, int(np.max(whom))+1)
+    last=f.last_times()
+    day_cnt=int(np.floor(last.max()))+1 if len(last)>0 else 1
+    return unit_cnt, max(day_cnt, 1)
+
+
+def fill_curves(span):
+    '''
+    Worker which writes the curves of runs begin up to end into
+    rows of the memory-mapped (run x day x state) array.
+    '''
+    filename, curve_file, shape, unit_cnt, begin, end=span
+    states=read_naadsm.transition_states(read_naadsm.default_transitions())
+    curves=np.memmap(curve_file, dtype=np.int32, mode="r+", shape=shape)
+    with eventfile.EventFile(filename) as f:
+        for idx in range(begin, end):
+            curves[idx]=run_curve(f.run(idx), states, unit_cnt, shape[1])
+    curves.flush()
+    del curves
+    return end-begin
+
+
+class Epicurves(object):
+    '''
+    Curves of every run of an event file, kept in a memory-mapped
+    (run x day x state) array in a temporary directory, so memory
+    stays the same however many runs there are. Runs are read by a
+    pool of jobs processes, each writing its own rows. Summaries are
+    computed a block of days at a time.
+    '''
+    day_block=256
+
+    def __init__(self, filename, jobs=1, directory=None):
+        self.filename=filename
+        with eventfile.EventFile(filename) as f:
+            self.run_cnt=len(f)
+            self.unit_cnt, self.day_cnt=ensemble_size(f)
+        self.directory=tempfile.mkdtemp(dir=directory)
+        self.curve_file=os.path.join(self.directory, "curves.dat")
+        self.shape=(self.run_cnt, self.day_cnt, read_naadsm.state_cnt)
+        logger.debug("{0} runs {1} units {2} days".format(self.run_cnt,
+            self.unit_cnt, self.day_cnt))
+        self.curves=np.memmap(self.curve_file, dtype=np.int32, mode="w+",
+            shape=self.shape)
+        self.fill(jobs)
+
+    def fill(self, jobs):
+        per_task=max(1, self.run_cnt//(4*jobs))
+        spans=[(self.filename, self.curve_file, self.shape, self.unit_cnt, begin,
+            min(begin+per_task, self.run_cnt))
+            for begin in range(0, self.run_cnt, per_task)]
+        if jobs>1 and len(spans)>1:
+            with multiprocessing.Pool(jobs) as pool:
+                for cnt in pool.imap_unordered(fill_curves, spans):
+                    logger.debug("filled {0} runs".format(cnt))
+        else:
+            for span in spans:
+                fill_curves(span)
+
+    def close(self):
+        del self.curves
+        shutil.rmtree(self.directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def summary(self, quantiles=default_quantiles):
+        '''
+        Returns mean, quantiles and max across runs, as arrays of
+        (day x state), (quantile x day x state) and (day x state).
+        '''
+        mean=np.zeros((self.day_cnt, read_naadsm.state_cnt))
+        bands=np.zeros((len(quantiles), self.day_cnt, read_naadsm.state_cnt))
+        largest=np.zeros((self.day_cnt, read_naadsm.state_cnt), dtype=np.int64)
+        for begin in range(0, self.day_cnt, self.day_block):
+            end=min(begin+self.day_block, self.day_cnt)
+            block=np.asarray(self.curves[:, begin:end])
+            if self.run_cnt==0:
+                continue
+            mean[begin:end]=block.mean(axis=0)
+            bands[:, begin:end]=np.quantile(block, quantiles, axis=0)
+            largest[begin:end]=block.max(axis=0)
+        return mean, bands, largest
+
+
+def write_csv(outfile, mean, bands, largest, quantiles=default_quantiles):
+    '''One row per day and state.'''
+    with open(outfile, "w") as csvfile:
+        writer=csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(["day", "state", "mean"]+
+            ["q{0:g}".format(q) for q in quantiles]+["max"])
+        for day in range(mean.shape[0]):
+            for state, name in enumerate(state_names):
+                writer.writerow([day, name, mean[day, state]]+
+                    bands[:, day, state].tolist()+[largest[day, state]])
+
+
+def epicurves(filename, outfile, quantiles=default_quantiles, jobs=1):
+    logger.info("Reading input {0}. Writing to {1}".format(filename, outfile))
+    with Epicurves(filename, jobs) as curves:
+        mean, bands, largest=curves.summary(quantiles)
+    write_csv(outfile, mean, bands, largest, quantiles)
+    return mean, bands, largest
+
+
+class EpicurveTest(unittest.TestCase):
+    '''Compares curves with counts of states in the trace they came from.'''
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.h5=os.path.join(self.directory, "events.h5")
+        table=read_naadsm.transition_table(read_naadsm.default_transitions())
+        self.traces=list()
+        with h5py.File(self.h5, "w") as f:
+            f.create_group("/trajectory")
+            writer=read_naadsm.EventWriter(f)
+            for seed in range(9):
+                states=read_naadsm.synthetic_states(30, 20+seed, 0.1*seed, seed)
+                self.traces.append(states)
+                writer.save(read_naadsm.state_changes(states, table)[0],
+                    states.shape[1])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def expected(self, day_cnt):
+        counts=np.zeros((len(self.traces), day_cnt, read_naadsm.state_cnt), np.int64)
+        for idx, states in enumerate(self.traces):
+            for day in range(day_cnt):
+                row=states[min(day, len(states)-1)]
+                counts[idx, day]=np.bincount(row, minlength=read_naadsm.state_cnt)
+        return counts
+
+    def test_curves(self):
+        for jobs in [1, 2]:
+            with Epicurves(self.h5, jobs) as curves:
+                expected=self.expected(curves.day_cnt)
+                self.assertTrue(np.array_equal(curves.curves, expected))
+                mean, bands, largest=curves.summary()
+                self.assertTrue(np.allclose(mean, expected.mean(axis=0)))
+                self.assertTrue(np.array_equal(largest, expected.max(axis=0)))
+
+    def test_transition_states(self):
+        transitions=read_naadsm.default_transitions()
+        previous, next=read_naadsm.transition_states(transitions)
+        for (before, after), event in transitions.items():
+            self.assertEqual((previous[event], next[event]), (before, after))
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(EpicurveTest)
+
+
+
+if __name__ == "__main__":
+    parser=DefaultArgumentParser(description="Counts units in each state per day",
+        suite=suite)
+    parser.add_argument("--input", dest="infile", action="store",
+        default="naadsm.h5", help="Input HDF5 file with ensemble of events")
+    parser.add_argument("--output", dest="outfile", action="store",
+        default="epicurve.csv", help="CSV output with a row per day and state")
+    parser.add_argument("--quantiles", dest="quantiles", action="store",
+        default="0.05,0.5,0.95", help="Comma-separated quantiles across runs")
+    parser.add_argument("--jobs", dest="jobs", action="store", type=int,
+        default=1, help="Number of processes reading runs")
+
+    args=parser.parse_args()
+    quantiles=[float(x) for x in args.quantiles.split(",")]
+    epicurves(args.infile, args.outfile, quantiles, args.jobs)
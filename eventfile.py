@@ -0,0 +1,250 @@
+'''
+Layout of the HDF5 event file. There are two layouts.
+
+In the "groups" layout, each run is a group /trajectory/dsetN
+holding the datasets Event, Who, Whom and When.
+
+In the "table" layout, the columns of all runs are concatenated
+into /trajectory/Event, Who, Whom and When, and run i has rows
+run_offsets[i] up to run_offsets[i+1] of /trajectory/run_offsets.
+
+Writers keep attributes on /trajectory so that readers and later
+writers don't have to walk the group to count or number runs.
+EventFile reads either layout.
+'''
+import logging
+import numpy as np
+import h5py
+
+logger=logging.getLogger(__file__)
+
+# Index to use for the next dsetN group.
+next_dset_attr="next_dset"
+# Number of runs under /trajectory.
+trajectory_count_attr="trajectory_count"
+# Number of the last run converted from the trace, and the byte
+# offset in the trace where the next run to convert starts.
+last_run_attr="last_run"
+trace_offset_attr="trace_offset"
+# Hash of the bytes of the trace before trace_offset, to tell a trace
+# which grew from one which was replaced.
+trace_digest_attr="trace_digest"
+# Number of units in the landscape, including those without events.
+unit_count_attr="unit_count"
+# Either "groups" or "table". Files without it are "groups".
+layout_attr="layout"
+offsets_name="run_offsets"
+# Name and type of each column of events.
+columns=[("Event", np.int32), ("Who", np.int32), ("Whom", np.int32),
+    ("When", np.float64)]
+column_names=[name for (name, dtype) in columns]
+
+
+def layout(openh5):
+    attrs=openh5["/trajectory"].attrs
+    if layout_attr in attrs:
+        value=attrs[layout_attr]
+        return value.decode() if isinstance(value, bytes) else str(value)
+    return "groups"
+
+
+def dset_number(name):
+    return int(name[4:])
+
+
+def scan_dataset_names(openh5):
+    '''
+    Lists dsetN groups in order of N, which is the order they were
+    written, rather than the text order h5py iterates them in, where
+    dset10 comes before dset2.
+    '''
+    names=[x for x in openh5["/trajectory"] if x.startswith("dset")]
+    return sorted(names, key=dset_number)
+
+
+def scan_next_dset(openh5):
+    maxnum=-1
+    for name in scan_dataset_names(openh5):
+        maxnum=max(maxnum, dset_number(name))
+    return maxnum+1
+
+
+def next_dset(openh5):
+    '''Index of the next dsetN, from the attribute when it is there.'''
+    attrs=openh5["/trajectory"].attrs
+    if next_dset_attr in attrs:
+        return int(attrs[next_dset_attr])
+    return scan_next_dset(openh5)
+
+
+def trajectory_count(openh5):
+    '''Number of runs, from the attribute when it is there.'''
+    attrs=openh5["/trajectory"].attrs
+    if trajectory_count_attr in attrs:
+        return int(attrs[trajectory_count_attr])
+    if layout(openh5)=="table":
+        return len(openh5["/trajectory"][offsets_name])-1
+    return len(scan_dataset_names(openh5))
+
+
+def unit_count(openh5):
+    '''Number of units when the writer recorded it, else None.'''
+    attrs=openh5["/trajectory"].attrs
+    if unit_count_attr in attrs:
+        return int(attrs[unit_count_attr])
+    return None
+
+
+def trace_position(openh5):
+    '''(last_run, trace_offset) when the writer recorded them, else None.'''
+    attrs=openh5["/trajectory"].attrs
+    if trace_offset_attr in attrs:
+        return int(attrs[last_run_attr]), int(attrs[trace_offset_attr])
+    return None
+
+
+def trace_digest(openh5):
+    '''The hash of the converted part of the trace, else None.'''
+    attrs=openh5["/trajectory"].attrs
+    if trace_digest_attr in attrs:
+        value=attrs[trace_digest_attr]
+        return value.decode() if isinstance(value, bytes) else str(value)
+    return None
+
+
+def dataset_names(openh5):
+    '''
+    Lists dsetN groups in order of N, so runs come in the order
+    written, as in the table layout. When the attributes show runs
+    were numbered 0 to N-1, the names are made without reading the group.
+    '''
+    attrs=openh5["/trajectory"].attrs
+    if next_dset_attr in attrs and trajectory_count_attr in attrs:
+        count=int(attrs[trajectory_count_attr])
+        if count==int(attrs[next_dset_attr]):
+            return ["dset{0}".format(i) for i in range(count)]
+    return scan_dataset_names(openh5)
+
+
+class Run(object):
+    '''
+    Columns of one run, read when asked for, so run["Event"]
+    works for either layout the way it does for a dsetN group.
+    '''
+    def __init__(self, source, begin=None, end=None):
+        self.source=source
+        self.begin=begin
+        self.end=end
+        self.cache=dict()
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            if self.begin is None:
+                self.cache[name]=self.source[name][()]
+            else:
+                self.cache[name]=self.source[name][self.begin:self.end]
+        return self.cache[name]
+
+    def __len__(self):
+        if self.begin is None:
+            return len(self.source["Event"])
+        return self.end-self.begin
+
+
+class EventFile(object):
+    '''
+    Reads runs from an event file in either layout. Iterating gives
+    a Run for each run, in the order written, for either layout. columns()
+    reads every run at once, for vectorized passes over the ensemble.
+    '''
+    def __init__(self, filename, mode="r"):
+        if isinstance(filename, h5py.File):
+            self.openh5=filename
+            self.owned=False
+        else:
+            logger.debug("Opening {0}".format(filename))
+            self.openh5=h5py.File(filename, mode)
+            self.owned=True
+        self.layout=layout(self.openh5)
+        self.trajectory=self.openh5["/trajectory"]
+        if self.layout=="table":
+            self.offsets=self.trajectory[offsets_name][()]
+        else:
+            self.names=dataset_names(self.openh5)
+
+    def close(self):
+        if self.owned:
+            self.openh5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        if self.layout=="table":
+            return len(self.offsets)-1
+        return len(self.names)
+
+    def run(self, idx):
+        '''The run at position idx.'''
+        if self.layout=="table":
+            return Run(self.trajectory, int(self.offsets[idx]),
+                int(self.offsets[idx+1]))
+        return Run(self.trajectory[self.names[idx]])
+
+    def added_since(self, count):
+        '''
+        Positions of the runs written after the first count runs. For
+        the groups layout these are dsetN with N of count or more.
+        '''
+        if self.layout=="table":
+            return list(range(count, len(self)))
+        return [idx for (idx, name) in enumerate(self.names)
+            if dset_number(name)>=count]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.run(idx)
+
+    def unit_count(self):
+        return unit_count(self.openh5)
+
+    def last_times(self):
+        '''The When of the last event in each run, or -1 for empty runs.'''
+        if self.layout=="table":
+            ends=self.offsets[1:]
+            last=-np.ones((len(ends),), dtype=np.float64)
+            nonempty=ends>self.offsets[:-1]
+            when=self.trajectory["When"]
+            last[nonempty]=[when[x-1] for x in ends[nonempty]]
+            return last
+        last=list()
+        for name in self.names:
+            when=self.trajectory[name]["When"]
+            last.append(when[-1] if len(when)>0 else -1)
+        return np.array(last, dtype=np.float64)
+
+    def columns(self, names=None):
+        '''
+        Returns a dictionary of columns for all runs, concatenated,
+        and run offsets, so run i has rows offsets[i] to offsets[i+1].
+        '''
+        names=names or column_names
+        if self.layout=="table":
+            return dict([(x, self.trajectory[x][()]) for x in names]), self.offsets
+        parts=dict([(x, list()) for x in names])
+        lengths=[0]
+        for run in self:
+            for name in names:
+                parts[name].append(run[name])
+            lengths.append(len(parts[names[0]][-1]))
+        dtypes=dict(columns)
+        joined=dict()
+        for name in names:
+            if len(parts[name])>0:
+                joined[name]=np.concatenate(parts[name])
+            else:
+                joined[name]=np.zeros((0,), dtype=dtypes[name])
+        return joined, np.cumsum(lengths)
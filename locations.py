@@ -1,9 +1,15 @@
+import hashlib
+import os
 import os.path
+import shutil
+import tempfile
 import xml.etree.ElementTree as etree
 import xml.parsers.expat.errors
 import numpy as np
-import scipy.spatial.distance as distance
+import scipy.spatial
 import logging
+import unittest
+from default_parser import DefaultArgumentParser
 
 logger=logging.getLogger(__file__)
 
@@ -23,47 +29,393 @@ def distancekm(latlon1, latlon2):
     return _radians_km*(2*np.arcsin(np.sqrt(np.power(np.sin((ll1[0]-ll2[0])/2),2)+
         np.cos(ll1[0])*np.cos(ll2[0])*np.power(np.sin((ll1[1]-ll2[1])/2), 2))))
 
+def haversine_km(latlon1, latlon2):
+    """Distances on a spherical earth between arrays of (lat, lon)
+    in degrees, which broadcast against each other."""
+    ll1=np.asarray(latlon1)*_degrees_to_radians
+    ll2=np.asarray(latlon2)*_degrees_to_radians
+    return _radians_km*(2*np.arcsin(np.sqrt(np.power(np.sin((ll1[...,0]-ll2[...,0])/2),2)+
+        np.cos(ll1[...,0])*np.cos(ll2[...,0])*np.power(np.sin((ll1[...,1]-ll2[...,1])/2), 2))))
+
+
+def unit_vectors(latlon):
+    """Points on the unit sphere for an array of (lat, lon) in degrees."""
+    ll=np.asarray(latlon)*_degrees_to_radians
+    coslat=np.cos(ll[:,0])
+    return np.column_stack([coslat*np.cos(ll[:,1]), coslat*np.sin(ll[:,1]),
+        np.sin(ll[:,0])])
+
+
+def chord_from_km(km):
+    """Straight-line distance on the unit sphere for a distance in km."""
+    return 2*np.sin(np.minimum(np.asarray(km, dtype=np.float64)/_radians_km, np.pi)/2)
+
+
+def km_from_chord(chord):
+    return _radians_km*2*np.arcsin(np.minimum(np.asarray(chord)/2, 1.0))
+
+
 class Landscape(object):
+    """
+    Farms and their locations, held as columns: ids, production_type
+    and status as codes into production_types and statuses, size and
+    farm_locations as (lat, lon). Distances come from a KD-tree on
+    unit-sphere coordinates, built the first time it is needed,
+    so the full matrix of distances is never made unless asked for.
+    """
+    # Saved to and loaded from the cache, along with farm_locations.
+    column_names=["ids", "production_type", "production_types", "size",
+        "status", "statuses"]
+
     def __init__(self):
-        pass
+        self._tree=None
+        self._distances=None
+        self._farms=None
 
-    def from_naadsm_file(self, root, ns):
-        self.farms=list()
-        for unit in root.findall("herd", ns):
-            unit_name=unit.find("id").text
-            f=Farm(unit_name)
-            unit_type=unit.find("production-type").text
-            f.production_type=unit_type
-            unit_size=int(unit.find("size").text)
-            f.size=unit_size
+    def from_columns(self, columns):
+        for name in self.column_names:
+            setattr(self, name, columns[name])
+        self.farm_locations=np.asarray(columns["farm_locations"],
+            dtype=np.float64).reshape(-1, 2)
+        self._tree=None
+        self._distances=None
+        self._farms=None
+        logger.debug("found {0} farms".format(len(self.ids)))
+
+    def from_herds(self, herds):
+        """Fills the columns from an iterable of herd elements."""
+        ids=list()
+        production_type=list()
+        size=list()
+        latlon=list()
+        status=list()
+        for unit in herds:
+            ids.append(unit.find("id").text)
+            production_type.append(unit.find("production-type").text)
+            size.append(int(unit.find("size").text))
             location=unit.find("location")
-            lat=float(location.find("latitude").text)
-            lon=float(location.find("longitude").text)
-            f.latlon=np.array([lat, lon])
-            status=unit.find("status").text
-            f.status=status
-            self.farms.append(f)
-        self.farm_locations=np.array([x.latlon for x in self.farms])
-        self.distances=distance.squareform(
-            distance.pdist(self.farm_locations, distancekm))
-        logger.debug("found {0} farms".format(len(self.farms)))
-
-def load_naadsm_herd(herd_filename):
-    ns={"naadsm" : "http://www.naadsm.org/schema",
-        "xsd" : "http://www.w3.org/2001/XMLSchema",
-        "xml" : "http://www.w3.org/XML/1998/namespace",
-        "gml" : "http://www.opengis.net/gml",
-        "xsi" : "http://www.w3.org/2001/XMLSchema-instance"}
+            latlon.append((float(location.find("latitude").text),
+                float(location.find("longitude").text)))
+            status.append(unit.find("status").text)
+        production_types, production_codes=np.unique(
+            np.array(production_type, dtype=np.str_), return_inverse=True)
+        statuses, status_codes=np.unique(np.array(status, dtype=np.str_),
+            return_inverse=True)
+        self.from_columns({"ids" : np.array(ids, dtype=np.str_),
+            "production_type" : production_codes.astype(np.int32),
+            "production_types" : production_types,
+            "size" : np.array(size, dtype=np.int64),
+            "status" : status_codes.astype(np.int32),
+            "statuses" : statuses,
+            "farm_locations" : np.array(latlon, dtype=np.float64)})
+
+    def from_naadsm_file(self, root, ns):
+        self.from_herds(root.findall("herd", ns))
+
+    def columns(self):
+        columns=dict([(x, getattr(self, x)) for x in self.column_names])
+        columns["farm_locations"]=self.farm_locations
+        return columns
+
+    @property
+    def farms(self):
+        """A Farm object for each farm, made when first asked for."""
+        if self._farms is None:
+            self._farms=list()
+            for idx in range(len(self.ids)):
+                f=Farm(str(self.ids[idx]))
+                f.production_type=str(self.production_types[self.production_type[idx]])
+                f.size=int(self.size[idx])
+                f.latlon=self.farm_locations[idx].copy()
+                f.status=str(self.statuses[self.status[idx]])
+                self._farms.append(f)
+        return self._farms
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            logger.debug("building spatial index of {0} farms".format(
+                len(self.farm_locations)))
+            self._tree=scipy.spatial.cKDTree(unit_vectors(self.farm_locations))
+        return self._tree
+
+    def within(self, farm_idx, radius_km):
+        """Indices of farms within radius_km of farm farm_idx,
+        including itself, in increasing order."""
+        center=unit_vectors(self.farm_locations[[farm_idx]])[0]
+        found=self.tree.query_ball_point(center, chord_from_km(radius_km))
+        return np.sort(np.array(found, dtype=np.int64))
+
+    def nearest(self, farm_idx, k):
+        """Distances in km and indices of the k farms nearest
+        farm farm_idx, which is the first of them."""
+        center=unit_vectors(self.farm_locations[[farm_idx]])[0]
+        chord, found=self.tree.query(center, k)
+        return km_from_chord(chord), found
+
+    def pair_distances(self, first, second):
+        """Distances in km between farms first[i] and second[i]."""
+        return haversine_km(self.farm_locations[first], self.farm_locations[second])
+
+    def distance_matrix(self, chunk=1024):
+        """The full farm by farm matrix of distances in km, computed
+        a block of rows at a time."""
+        locations=self.farm_locations
+        matrix=np.zeros((len(locations), len(locations)), dtype=np.float64)
+        for begin in range(0, len(locations), chunk):
+            end=min(begin+chunk, len(locations))
+            matrix[begin:end]=haversine_km(locations[begin:end,np.newaxis,:],
+                locations[np.newaxis,:,:])
+        return matrix
+
+    @property
+    def distances(self):
+        if self._distances is None:
+            self._distances=self.distance_matrix()
+        return self._distances
+
+def iter_herds(herd_filename):
+    """
+    Yields each herd element of a herd file as it is parsed,
+    then clears it, so the whole document is never held.
+    """
+    context=etree.iterparse(herd_filename, events=("start", "end"))
+    event, root=next(context)
+    for event, elem in context:
+        if event=="end" and elem.tag=="herd":
+            yield elem
+            root.clear()
+
+
+def file_digest(filename, block=1<<20):
+    digest=hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_name(herd_filename):
+    return "{0}.cache".format(herd_filename)
+
+
+def cache_stamp(herd_filename):
+    return os.path.join(cache_name(herd_filename), "source.txt")
+
+
+def cache_column(herd_filename, name):
+    return os.path.join(cache_name(herd_filename), "{0}.npy".format(name))
+
+
+def save_cache_stamp(herd_filename, digest):
+    """The stamp is size, mtime and SHA-1 of the source, written last."""
+    stat=os.stat(herd_filename)
+    stamp=cache_stamp(herd_filename)
+    with open(stamp+".tmp", "w") as f:
+        f.write("{0} {1} {2}\n".format(stat.st_size, stat.st_mtime_ns, digest))
+    os.replace(stamp+".tmp", stamp)
+
+
+def load_cached_herd(herd_filename):
+    """
+    Columns saved for this herd file, or None. The cache matches if
+    the herd file has the same size and mtime, or failing that, the
+    same SHA-1 hash. Each column is its own .npy file, memory-mapped
+    read-only, so pages are read as they are used.
+    """
+    stamp=cache_stamp(herd_filename)
+    if not os.path.exists(stamp):
+        return None
+    stat=os.stat(herd_filename)
     try:
-        hxml=etree.parse(herd_filename)
+        with open(stamp) as f:
+            size, mtime, digest=f.read().split()
+        columns=dict([(x, np.load(cache_column(herd_filename, x), mmap_mode="r"))
+            for x in Landscape.column_names+["farm_locations"]])
+    except (IOError, ValueError) as err:
+        logger.warning("Could not read {0}: {1}".format(
+            cache_name(herd_filename), err))
+        return None
+    if int(size)!=stat.st_size or int(mtime)!=stat.st_mtime_ns:
+        if digest!=file_digest(herd_filename):
+            logger.debug("{0} is out of date".format(cache_name(herd_filename)))
+            return None
+        try:
+            save_cache_stamp(herd_filename, digest)
+        except IOError as err:
+            logger.warning("Could not write {0}: {1}".format(stamp, err))
+    return columns
+
+
+def save_cached_herd(herd_filename, columns, digest=None):
+    """
+    Writes each column to herd_filename.cache/name.npy. The stamp is
+    removed first and written last, so a cache left half written
+    by an error is never read.
+    """
+    stamp=cache_stamp(herd_filename)
+    try:
+        os.makedirs(cache_name(herd_filename), exist_ok=True)
+        if os.path.exists(stamp):
+            os.remove(stamp)
+        for name in Landscape.column_names+["farm_locations"]:
+            np.save(cache_column(herd_filename, name), np.asarray(columns[name]))
+        save_cache_stamp(herd_filename, digest or file_digest(herd_filename))
+    except (IOError, OSError) as err:
+        logger.warning("Could not write {0}: {1}".format(
+            cache_name(herd_filename), err))
+
+
+def load_naadsm_herd(herd_filename, cache=True):
+    """
+    Reads a NAADSM herd file into a Landscape. The file is parsed
+    incrementally, and the columns are cached next to it in
+    herd_filename.cache, which later loads memory-map instead.
+    """
+    landscape=Landscape()
+    if cache:
+        columns=load_cached_herd(herd_filename)
+        if columns is not None:
+            logger.debug("Reading cached {0}".format(cache_name(herd_filename)))
+            landscape.from_columns(columns)
+            return landscape
+    try:
+        landscape.from_herds(iter_herds(herd_filename))
     except etree.ParseError as err:
         logger.error("Could not parse {0} at line {1} with error {2}".format(
             herd_filename, err.position,
             xml.parsers.expat.errors.messages[err.code]))
-    
-    landscape=Landscape()
-    landscape.from_naadsm_file(hxml, ns)
+        raise
+    if cache:
+        save_cached_herd(herd_filename, landscape.columns())
     return landscape
 
 def load_herd_locations(herd_filename):
     return load_naadsm_herd(herd_filename).farm_locations
+
+
+class LandscapeTest(unittest.TestCase):
+    '''Compares the KD-tree lookups with distances to every farm.'''
+    def setUp(self):
+        rng=np.random.RandomState(7)
+        latlon=np.column_stack([rng.uniform(-60, 60, 300),
+            rng.uniform(-180, 180, 300)])
+        # Farm 0 and one exactly opposite it, and others near that.
+        latlon[0]=(10.0, 20.0)
+        latlon[1]=(-10.0, -160.0)
+        latlon[2:12]=latlon[1]+rng.uniform(-0.5, 0.5, (10, 2))
+        self.landscape=Landscape()
+        self.landscape.from_columns({"ids" : np.arange(300).astype(np.str_),
+            "production_type" : np.zeros(300, dtype=np.int32),
+            "production_types" : np.array(["Broilers"]),
+            "size" : np.ones(300, dtype=np.int64),
+            "status" : np.zeros(300, dtype=np.int32),
+            "statuses" : np.array(["Susceptible"]),
+            "farm_locations" : latlon})
+        self.brute=haversine_km(latlon[:,np.newaxis,:], latlon[np.newaxis,:,:])
+
+    def test_within(self):
+        half=np.pi*_radians_km
+        for farm in [0, 1, 5, 100]:
+            for radius in [0, 50, 1000, 8000, half-30, half-1, half, half+1, 1e5]:
+                expected=np.nonzero(self.brute[farm]<=radius)[0]
+                self.assertEqual(self.landscape.within(farm, radius).tolist(),
+                    expected.tolist(), (farm, radius))
+        self.assertEqual(len(self.landscape.within(0, half)), 300)
+
+    def test_nearest(self):
+        for farm in [0, 1, 5, 100]:
+            for k in [1, 2, 10, 300]:
+                distances, found=self.landscape.nearest(farm, k)
+                order=np.argsort(self.brute[farm], kind="stable")[:k]
+                self.assertEqual(np.atleast_1d(found).tolist(), order.tolist())
+                self.assertTrue(np.allclose(distances, self.brute[farm][order],
+                    atol=1e-6))
+
+    def test_distance_matrix(self):
+        whole=self.landscape.distance_matrix(chunk=300)
+        self.assertTrue(np.allclose(whole, self.brute))
+        for chunk in [1, 7, 64, 1000]:
+            self.assertTrue(np.array_equal(
+                self.landscape.distance_matrix(chunk=chunk), whole))
+
+
+class HerdCacheTest(unittest.TestCase):
+    '''Checks when the cached columns of a herd file are used.'''
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.herd=os.path.join(self.directory, "herd.xml")
+        self.write_herd(100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_herd(self, first_size, mtime_ns=10**18):
+        with open(self.herd, "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<naadsm:herds '
+                'xmlns:naadsm="http://www.naadsm.org/schema">\n')
+            for idx in range(20):
+                f.write("<herd><id>{0}</id><production-type>{1}</production-type>"
+                    "<size>{2}</size><location><latitude>{3}</latitude>"
+                    "<longitude>{4}</longitude></location><status>{5}</status>"
+                    "</herd>\n".format(idx+1, ["Broilers", "Layers"][idx%2],
+                    first_size if idx==0 else 10*idx, 33+0.1*idx, -80-0.1*idx,
+                    "Susceptible"))
+            f.write("</naadsm:herds>\n")
+        os.utime(self.herd, ns=(mtime_ns, mtime_ns))
+
+    def column_mtimes(self):
+        return [os.stat(cache_column(self.herd, x)).st_mtime_ns
+            for x in Landscape.column_names+["farm_locations"]]
+
+    def test_hit(self):
+        parsed=load_naadsm_herd(self.herd)
+        columns=load_cached_herd(self.herd)
+        self.assertIsNotNone(columns)
+        for name, column in parsed.columns().items():
+            self.assertIsInstance(columns[name], np.memmap)
+            self.assertTrue(np.array_equal(columns[name], column))
+        self.assertEqual(load_naadsm_herd(self.herd).size.tolist(),
+            parsed.size.tolist())
+
+    def test_touched(self):
+        load_naadsm_herd(self.herd)
+        written=self.column_mtimes()
+        os.utime(self.herd, ns=(2*10**18, 2*10**18))
+        self.assertIsNotNone(load_cached_herd(self.herd))
+        self.assertEqual(self.column_mtimes(), written)
+        with open(cache_stamp(self.herd)) as f:
+            self.assertEqual(int(f.read().split()[1]), 2*10**18)
+
+    def test_edited(self):
+        load_naadsm_herd(self.herd)
+        self.write_herd(999, 2*10**18)
+        self.assertIsNone(load_cached_herd(self.herd))
+        self.assertEqual(load_naadsm_herd(self.herd).size[0], 999)
+        self.assertEqual(load_cached_herd(self.herd)["size"][0], 999)
+
+    def test_interrupted(self):
+        landscape=load_naadsm_herd(self.herd)
+        # A column which can't be written stops save_cached_herd part way.
+        os.remove(cache_column(self.herd, "size"))
+        os.mkdir(cache_column(self.herd, "size"))
+        save_cached_herd(self.herd, landscape.columns())
+        self.assertFalse(os.path.exists(cache_stamp(self.herd)))
+        self.assertIsNone(load_cached_herd(self.herd))
+
+
+def suite():
+    loader=unittest.TestLoader()
+    return unittest.TestSuite([loader.loadTestsFromTestCase(LandscapeTest),
+        loader.loadTestsFromTestCase(HerdCacheTest)])
+
+
+if __name__ == "__main__":
+    parser=DefaultArgumentParser(description="Reads a NAADSM herd file and caches it",
+        suite=suite)
+    parser.add_argument("--herd", dest="herd", action="store",
+        default=None, help="NAADSM herd XML file to read")
+    args=parser.parse_args()
+    if args.herd is not None:
+        landscape=load_naadsm_herd(args.herd)
+        logger.info("{0} farms in {1}".format(len(landscape.ids), args.herd))
@@ -6,14 +6,23 @@ animation process uses the following previous work:
 Rain simulation: Simulates rain drops on a surface by animating the scale and opacity
 of 50 scatter points. (Author: Nicolas P. Rougier)
 """
+import collections
 import logging
+import multiprocessing
+import os
+import subprocess
 import sys
 import numpy as np
 import h5py
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 from  matplotlib.animation import FuncAnimation
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import cache
 import locations
+import eventfile
 
 _degrees_to_radians=np.pi/180
 _radians_km=180*60*1.852/np.pi
@@ -21,18 +30,9 @@ _radians_km=180*60*1.852/np.pi
 logger=logging.getLogger(__file__)
 logging.basicConfig(level=logging.DEBUG)
 
-def datasets(open_file):
-    trajectories=open_file['/trajectory']
-    names=list()
-    for trajectory_name in trajectories:
-        if trajectory_name.startswith("dset"):
-            names.append(trajectory_name)
-    return names
-
 def transitions(open_file, herd_file):
     loc=locations.load_herd_locations(herd_file)
-    trajectory_name=datasets(open_file)[0]
-    dset=open_file["/trajectory/{0}".format(trajectory_name)]
+    dset=eventfile.EventFile(open_file).run(0)
 
     event=dset["Event"]
     who=dset["Who"]
@@ -50,64 +50,250 @@ def distancekm(latlon1, latlon2):
     return _radians_km*(2*np.arcsin(np.sqrt(np.power(np.sin((ll1[0]-ll2[0])/2),2)+
         np.cos(ll1[0])*np.cos(ll2[0])*np.power(np.sin((ll1[1]-ll2[1])/2), 2))))
 
-def map_proj():
+# This is a projection for South Carolina
+sc_proj='+proj=lcc +lat_1=32.5 +lat_2=34.83333333333334 +lat_0=31.83333333333333 +lon_0=-81 +x_0=609600 +y_0=0 +datum=NAD83 +units=ft +no_defs '
+named_projections={'sc' : sc_proj}
+
+def landscape_proj(latlon):
+    """
+    A Lambert conformal conic projection fitted to the bounding box
+    of the farms, with standard parallels a sixth of the way in
+    from the top and bottom.
+    """
+    min_lat, min_lon=np.min(latlon, axis=0)
+    max_lat, max_lon=np.max(latlon, axis=0)
+    span=max_lat-min_lat
+    return ('+proj=lcc +lat_1={0} +lat_2={1} +lat_0={2} +lon_0={3} '+
+        '+datum=NAD83 +units=m +no_defs').format(min_lat+span/6,
+        max_lat-span/6, (min_lat+max_lat)/2, (min_lon+max_lon)/2)
+
+def map_proj(proj=None, latlon=None):
+    """
+    A pyproj projection, given as a proj4 string or a name in
+    named_projections, or fitted to the farm locations when not given.
+    """
     import pyproj
-    # This is a projection for South Carolina
-    sc_proj='+proj=lcc +lat_1=32.5 +lat_2=34.83333333333334 +lat_0=31.83333333333333 +lon_0=-81 +x_0=609600 +y_0=0 +datum=NAD83 +units=ft +no_defs '
-    projection=pyproj.Proj(sc_proj)
+    if proj is None:
+        proj=landscape_proj(latlon)
+    projection=pyproj.Proj(named_projections.get(proj, proj))
     return projection
 
-def update(frame_number):
-    # Get an index which we can use to re-spawn the oldest raindrop.
-    logger.debug("frame_number {0}".format(frame_number))
-    current_time = frame_number*end_time/frame_cnt
-
-    # Make all colors more transparent as time progresses.
-    rain_drops['color'][:, 3] -= 1.0/len(rain_drops)
-    rain_drops['color'][:,3] = np.clip(rain_drops['color'][:,3], 0, 1)
-
-    # Make all circles bigger.
-    rain_drops['size'] += rain_growth_rate
-    (einfect, eclinical, erecover, ewane)=(0, 1, 2, 3)
-
-    global event_idx
-    global locations_scaled
-    global ax
-    global event
-    global when
-    global who
-    global whom
-    while event_idx<len(event) and \
-            when[event_idx]<current_time:
-        farm_idx=whom[event_idx]-1
-        source_idx=who[event_idx]-1
-        now=when[event_idx]
-        what=event[event_idx]
-        if what==einfect:
-            logger.debug("changing farm {0}".format(farm_idx))
-            farms['color'][farm_idx] = color_code['infected']
-            rain_drops['size'][farm_idx]=marker_size
-            rain_drops['color'][farm_idx, 3]=1.0
-            if source_idx != farm_idx:
-                x0, y0=locations_scaled[source_idx,:]
-                x1, y1=locations_scaled[farm_idx,:]
-                dx=x1-x0
-                dy=y1-y0
-                r=np.sqrt(dx*dx+dy*dy)
-                dr=0.04 # Want to reduce length by fixed distance
-                g=(r-dr)/r
-                if g<0:
-                    g=0.1
-                logger.info("x0 {0} x1 {1}".format(x0, x1))
-                ax.arrow(x0, y0, g*dx, g*dy, head_width=0.01, head_length=0.02,
-                    fc='k', ec='k')
-        event_idx+=1
-
-
-    # Update the scatter collection, with the new colors, sizes and positions.
-    farms_scat.set_facecolors(farms['color'])
-    rain_scat.set_edgecolors(rain_drops['color'])
-    rain_scat.set_sizes(rain_drops['size'])
+def scale_unit_square(projected):
+    """Scales projected coordinates so each axis runs from 0 to 1."""
+    min_xy=np.min(projected, axis=0)
+    max_xy=np.max(projected, axis=0)
+    return (projected-min_xy)*(1.0/(max_xy-min_xy))
+
+def projected_locations(herd_file, latlon, proj=None):
+    """
+    Farm locations projected with map_proj and scaled to the unit
+    square. They are cached next to the herd file, keyed by the herd
+    file's size and mtime and by the projection.
+    """
+    proj=proj or landscape_proj(latlon)
+    cached="{0}.proj.npz".format(herd_file)
+    stat=os.stat(herd_file)
+    stamp=np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    if os.path.exists(cached):
+        try:
+            with np.load(cached) as saved:
+                if (str(saved["proj"])==proj and
+                        np.array_equal(saved["stamp"], stamp)):
+                    logger.debug("Reading cached {0}".format(cached))
+                    return saved["locations_scaled"]
+        except (IOError, KeyError, ValueError) as err:
+            logger.warning("Could not read {0}: {1}".format(cached, err))
+    projection=map_proj(proj)
+    x, y=projection(latlon[:,1], latlon[:,0])
+    locations_scaled=scale_unit_square(np.column_stack([x, y]))
+    try:
+        with open(cached, "wb") as f:
+            np.savez(f, proj=np.str_(proj), stamp=stamp,
+                locations_scaled=locations_scaled)
+    except IOError as err:
+        logger.warning("Could not write {0}: {1}".format(cached, err))
+    return locations_scaled
+
+(einfect, eclinical, erecover, ewane)=(0, 1, 2, 3)
+
+def frame_count(event, when):
+    """End time, a little past the last infection, and number of frames."""
+    last_infection=np.where(event==einfect)[0]
+    end_time=when[last_infection[-1]]*1.05
+    frame_cnt=int(end_time)+1
+    return end_time, frame_cnt
+
+def color_codes():
+    color_choice={'susceptible' : 'black', 'infected' : 'orangered'}
+    color_code=dict()
+    for disease_name, cname in color_choice.items():
+        r, g, b=mcolors.hex2color(mcolors.cnames[cname])
+        color_code[disease_name]=np.array((r, g, b, 1.0))
+    return color_code
+
+class OutbreakAnimation(object):
+    """
+    Draws one run as farms which change color when infected, a ripple
+    which grows from each newly infected farm, and a line from source
+    to target for each infection. Before any frame is drawn, the frame
+    of each infection is found with np.searchsorted on When, and the
+    first frame each farm is infected is kept in first_frame. The
+    state at any frame is then a comparison with that array, so frames
+    can be drawn in any order without replaying events. Lines are
+    segments of one LineCollection, and ripples are drawn for infected
+    farms only. Calling it with a frame number returns all three of
+    its artists, because blitting redraws only the artists returned,
+    and those not returned would vanish from the screen.
+    """
+    marker_size=100
+    rain_growth_rate=50
+    # Arrows stop this far short of the infected farm.
+    arrow_gap=0.04
+
+    def __init__(self, ax, locations_scaled, event, who, whom, when,
+            initially_infected, frame_cnt, end_time):
+        self.ax=ax
+        self.locations_scaled=locations_scaled
+        self.frame_cnt=frame_cnt
+        self.color_code=color_codes()
+        self.n_drops=locations_scaled.shape[0]
+
+        # Frame f shows events before f*end_time/frame_cnt, so an
+        # event shows from the first frame whose time is past it.
+        frame_times=np.arange(frame_cnt)*end_time/frame_cnt
+        infections=np.nonzero(event==einfect)[0]
+        infection_frames=np.searchsorted(frame_times, when[infections],
+            side="right")
+        infected_farms=whom[infections]-1
+        source_farms=who[infections]-1
+        # Initially infected farms start one frame early, as they did
+        # when every frame grew all ripples before adding new ones.
+        self.first_frame=np.full(self.n_drops, frame_cnt, dtype=np.int32)
+        self.first_frame[[idx-1 for idx in initially_infected]]=-1
+        np.minimum.at(self.first_frame, infected_farms, infection_frames)
+
+        spread=source_farms!=infected_farms
+        self.segments=self.arrow_segments(source_farms[spread],
+            infected_farms[spread])
+        self.segment_bounds=np.searchsorted(infection_frames[spread],
+            np.arange(frame_cnt), side="right")
+        self.infection_bounds=np.searchsorted(infection_frames,
+            np.arange(frame_cnt), side="right")
+
+        self.farm_colors=np.zeros((self.n_drops, 4))
+        self.farm_colors[:]=self.color_code['susceptible']
+        self.farms_scat=ax.scatter(locations_scaled[:,0], locations_scaled[:,1],
+            s=self.marker_size, lw=0.5, facecolors=self.farm_colors,
+            edgecolors='none')
+        self.rain_scat=ax.scatter(np.zeros(0), np.zeros(0), s=self.marker_size,
+            lw=0.5, facecolors='none', edgecolors='none')
+        self.arrows=LineCollection(np.zeros((0, 2, 2)), colors='k', linewidths=1)
+        ax.add_collection(self.arrows)
+        self.shown=None
+        self.shown_segments=None
+
+    def arrow_segments(self, source, target):
+        start=self.locations_scaled[source]
+        delta=self.locations_scaled[target]-start
+        r=np.sqrt(np.sum(delta*delta, axis=1))
+        g=np.ones(len(r))
+        moved=r>0
+        g[moved]=(r[moved]-self.arrow_gap)/r[moved]
+        g[g<0]=0.1
+        return np.stack([start, start+g[:,np.newaxis]*delta], axis=1).reshape(-1, 2, 2)
+
+    def __call__(self, frame_number):
+        logger.debug("frame_number {0}".format(frame_number))
+        infected=self.first_frame<=frame_number
+        if self.infection_bounds[frame_number]!=self.shown:
+            self.farm_colors[:]=self.color_code['susceptible']
+            self.farm_colors[infected]=self.color_code['infected']
+            self.farms_scat.set_facecolors(self.farm_colors)
+            self.shown=self.infection_bounds[frame_number]
+        if self.segment_bounds[frame_number]!=self.shown_segments:
+            self.shown_segments=self.segment_bounds[frame_number]
+            self.arrows.set_segments(self.segments[:self.shown_segments])
+
+        # Ripples grow and become more transparent as time progresses.
+        age=frame_number-self.first_frame[infected]
+        colors=np.zeros((len(age), 4))
+        colors[:,3]=np.clip(1.0-age/float(self.n_drops), 0, 1)
+        self.rain_scat.set_offsets(self.locations_scaled[infected].reshape(-1, 2))
+        self.rain_scat.set_sizes(self.marker_size+self.rain_growth_rate*age)
+        self.rain_scat.set_edgecolors(colors)
+        return [self.farms_scat, self.arrows, self.rain_scat]
+
+    def init(self):
+        self.shown=None
+        self.shown_segments=None
+        return self(0)
+
+def movie_axes(fig):
+    """An Axes which fills the figure, with no ticks."""
+    ax = fig.add_axes([0, 0, 1, 1], frameon=False)
+    ax.set_xlim(0,1), ax.set_xticks([])
+    ax.set_ylim(0,1), ax.set_yticks([])
+    return ax
+
+def render_frames(chunk):
+    """
+    Renders frames begin up to end off screen and returns each as
+    raw RGB bytes. The animation jumps straight to the first frame,
+    so any chunk can be rendered by any process.
+    """
+    setup, begin, end=chunk
+    fig=Figure(figsize=setup["figsize"], dpi=setup["dpi"])
+    canvas=FigureCanvasAgg(fig)
+    ax=movie_axes(fig)
+    animation=OutbreakAnimation(ax, setup["locations_scaled"], setup["event"],
+        setup["who"], setup["whom"], setup["when"],
+        setup["initially_infected"], setup["frame_cnt"], setup["end_time"])
+    frames=list()
+    for frame_number in range(begin, end):
+        animation(frame_number)
+        canvas.draw()
+        frames.append(np.asarray(canvas.buffer_rgba())[:,:,:3].tobytes())
+    return frames
+
+def render_movie(setup, output_file, fps, jobs=1, chunk_size=25, ahead=2):
+    """
+    Renders every frame without a display and pipes raw RGB frames
+    to ffmpeg. With more than one job, a process pool renders chunks
+    of frames and they are written in frame order, so the movie is
+    the same as rendering with one process. At most ahead*jobs chunks
+    are queued or waiting to be written, so rendered frames can't
+    pile up in memory when ffmpeg is slower than the pool.
+    """
+    width=int(round(setup["figsize"][0]*setup["dpi"]))
+    height=int(round(setup["figsize"][1]*setup["dpi"]))
+    command=["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo",
+        "-pix_fmt", "rgb24", "-s", "{0}x{1}".format(width, height),
+        "-r", str(fps), "-i", "-", "-pix_fmt", "yuv420p", output_file]
+    logger.debug("running {0}".format(" ".join(command)))
+    chunks=[(setup, begin, min(begin+chunk_size, setup["frame_cnt"]))
+        for begin in range(0, setup["frame_cnt"], chunk_size)]
+    encoder=subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        if jobs>1:
+            with multiprocessing.Pool(jobs) as pool:
+                pending=collections.deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(render_frames, (chunk,)))
+                    if len(pending)>=ahead*jobs:
+                        for frame in pending.popleft().get():
+                            encoder.stdin.write(frame)
+                while pending:
+                    for frame in pending.popleft().get():
+                        encoder.stdin.write(frame)
+        else:
+            for chunk in chunks:
+                for frame in render_frames(chunk):
+                    encoder.stdin.write(frame)
+    finally:
+        encoder.stdin.close()
+        encoder.wait()
+    if encoder.returncode!=0:
+        raise RuntimeError("ffmpeg failed with code {0}".format(encoder.returncode))
 
 if __name__ == '__main__':
     import sys, os.path, getopt
@@ -115,8 +301,12 @@ if __name__ == '__main__':
     output_file = "run.mp4"
     herd_file = None
     initially_infected = []
+    headless = False
+    jobs = 1
+    proj = None
+    cache_dir = None
 
-    options, arguments = getopt.getopt(sys.argv[1:], "i:u:o:I:")
+    options, arguments = getopt.getopt(sys.argv[1:], "i:u:o:I:Hj:p:C:")
 
     for option, value in options:
         print(option,value)
@@ -126,6 +316,16 @@ if __name__ == '__main__':
             herd_file = value
         if option == "-o":
             output_file = value
+        if option == "-p":
+            proj = value
+        if option == "-C":
+            cache_dir = value
+            headless = True
+        if option == "-H":
+            headless = True
+        if option == "-j":
+            jobs = int(value)
+            headless = True
         if option == "-I":
             try:
                 initially_infected = [int(e) for e in value.split(',')]
@@ -143,85 +343,40 @@ if __name__ == '__main__':
     logger.debug("whom {0}".format(whom))
     logger.debug("when {0}".format(when))
 
-    color_choice={'susceptible' : 'black', 'infected' : 'orangered'}
-    color_code=dict()
-    for disease_name, cname in color_choice.items():
-        r, g, b=mcolors.hex2color(mcolors.cnames[cname])
-        color_code[disease_name]=np.array((r, g, b, 1.0))
-
-    # Create new Figure and an Axes which fills it.
-    fig = plt.figure(figsize=(7,7))
-    ax = fig.add_axes([0, 0, 1, 1], frameon=False)
-    ax.set_xlim(0,1), ax.set_xticks([])
-    ax.set_ylim(0,1), ax.set_yticks([])
-
-    # Create rain data
-    n_drops = locations.shape[0]
-    projection=map_proj()
-    projected=locations[:,:]
-    for i in range(locations.shape[0]):
-        projected[i,:]=np.array(projection(locations[i,1], locations[i,0]))
-    logger.debug("projected {0}".format(projected))
-
-    max_x=np.max(projected[:,0])
-    min_x=np.min(projected[:,0])
-    max_y=np.max(projected[:,1])
-    min_y=np.min(projected[:,1])
-    locations_scaled=(projected-np.array([min_x, min_y]))*np.array(
-        [1.0/(max_x-min_x), 1.0/(max_y-min_y)])
+    locations_scaled=projected_locations(herd_file, locations, proj)
     #logger.debug(locations_scaled)
     logger.debug("min farm {0} max farm {1}".format(np.min(whom), np.max(whom)))
-    farm_cnt = n_drops
-    last_infection=np.where(event==0)[0]
-    end_time=when[last_infection[-1]]*1.05
-    frame_cnt=int(end_time)+1
+    end_time, frame_cnt=frame_count(event, when)
     frame_interval=int(10000/frame_cnt)
     logger.debug("end_time {0}".format(end_time))
     logger.debug("frame_cnt {0}".format(frame_cnt))
     logger.debug("frame_interval {0}".format(frame_interval))
 
-    event_idx=0
-
-    farms = np.zeros(n_drops,
-                     dtype=[('position', float, 2),('size', float, 1), ('color', float, 4)])
-
-    marker_size=100
-
-    # Initialize the raindrops in random positions and with
-    # random growth rates.
-    farms['position'] = locations_scaled #np.random.uniform(0, 1, (n_drops, 2))
-    farms['size'].fill(marker_size)
-    farms['color'][:]=color_code['susceptible']
+    if headless:
+        setup={"locations_scaled" : locations_scaled, "event" : event,
+            "who" : who, "whom" : whom, "when" : when,
+            "initially_infected" : initially_infected,
+            "frame_cnt" : frame_cnt, "end_time" : end_time,
+            "figsize" : (7,7), "dpi" : 100}
+        fps=1000.0/frame_interval
+        arguments={"proj" : proj, "initially_infected" : initially_infected,
+            "figsize" : setup["figsize"], "dpi" : setup["dpi"], "fps" : fps}
+        cache.cached(cache_dir, cache.default_max_bytes, "outbreak_movie",
+            [data_file, herd_file], arguments, [output_file],
+            lambda: render_movie(setup, output_file, fps, jobs))
+        sys.exit(0)
 
-    rain_growth_rate=50
+    # Create new Figure and an Axes which fills it.
+    fig = plt.figure(figsize=(7,7))
+    ax = movie_axes(fig)
 
-    rain_drops = np.zeros(n_drops, dtype=[('position', float, 2),
-                                        ('size',     float, 1),
-                                        ('color',    float, 4)])
-
-    rain_drops['position'] = farms['position']
-    rain_drops['size'].fill(marker_size)
-    rain_drops['color'][:]=np.array((0.0, 0.0, 0.0, 0.0))
-
-    # Construct the scatter which we will update during animation
-    # as the raindrops develop.
-    farms_scat = ax.scatter(farms['position'][:,0], farms['position'][:,1],
-                    s=farms['size'], lw=0.5, facecolors=farms['color'],
-                    edgecolors='none')
-    rain_scat = ax.scatter(rain_drops['position'][:,0], rain_drops['position'][:,1],
-                    s=rain_drops['size'], lw=0.5, facecolors='none',
-                    edgecolors=rain_drops['color'])
-
-    # Add infection for the initially infected sites
-    for idx in initially_infected:
-        farm_idx=idx-1
-        farms['color'][farm_idx] = color_code['infected']
-        rain_drops['size'][farm_idx]=marker_size
-        rain_drops['color'][farm_idx, 3]=1.0
+    update=OutbreakAnimation(ax, locations_scaled, event, who, whom, when,
+        initially_infected, frame_cnt, end_time)
 
     # Construct the animation, using the update function as the animation
-    # director.
+    # director. Only the artists a frame changes are redrawn.
     animation = FuncAnimation(fig, update, frames=frame_cnt,
-        interval=frame_interval, repeat=False)
+        init_func=update.init, interval=frame_interval, repeat=False,
+        blit=True)
     plt.show()
     animation.save(output_file)
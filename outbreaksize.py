@@ -3,41 +3,214 @@ Produces a csv of outbreak sizes.
 '''
 import csv
 import logging
+import os
+import shutil
+import tempfile
+import unittest
 import h5py
 import numpy as np
 import matplotlib.pyplot as plt
-from default_parser import DefaultArgumentParser
+from default_parser import DefaultArgumentParser, timed
+import cache
+import eventfile
+import read_naadsm
+import reducers
 # from sklearn.neighbors import KernelDensity
 
 logger=logging.getLogger(__file__)
 
 
+# Event codes for transitions out of susceptible into
+# latent, clinical or naturally immune.
+infections=[0, 5, 6]
+# Name of the group under /summary which holds size statistics.
+summary_name="outbreaksize"
+
+
+def event_counts(filename):
+    '''
+    Counts of each event code in each run, as a (run x code) array,
+    in one vectorized pass. The Event column of every run is read at
+    once with EventFile.columns, and one np.bincount counts pairs of
+    run and code.
+    '''
+    with eventfile.EventFile(filename) as f:
+        logger.debug("{0} trajectories".format(len(f)))
+        with timed("event_counts") as counted:
+            columns, offsets=f.columns(["Event"])
+            events=columns["Event"].astype(np.int64)
+            run_cnt=len(offsets)-1
+            counted["runs"]=run_cnt
+            counted["rows"]=len(events)
+            code_cnt=max(int(events.max())+1 if len(events)>0 else 0,
+                max(infections)+1)
+            runs=np.repeat(np.arange(run_cnt), np.diff(offsets))
+            table=np.bincount(runs*code_cnt+events, minlength=run_cnt*code_cnt)
+    return table.reshape(run_cnt, code_cnt)
+
+
 def run_sizes(filename):
-    f=h5py.File(filename)
-    sizes=list()
-    infections=set([0, 5, 6])
-    for trajgroup in f["/trajectory"]:
-        if trajgroup.startswith("dset"):
-            cnt=0
-            events=f["/trajectory/{0}/Event".format(trajgroup)]
-            cnt=0
-            for e in events:
-                if e in infections:
-                    cnt+=1
-            sizes.append(cnt)
-    return sizes
+    '''Number of infection events in each run.'''
+    with timed("run_sizes") as counted:
+        sizes=event_counts(filename)[:, infections].sum(axis=1)
+        counted["runs"]=len(sizes)
+    return sizes.tolist()
+
+
+def iter_sizes(f, positions=None):
+    '''Number of infection events in runs of an EventFile, by position.'''
+    if positions is None:
+        positions=range(len(f))
+    for idx in positions:
+        with timed("iter_sizes", runs=1) as counted:
+            events=f.run(idx)["Event"]
+            counted["rows"]=len(events)
+            size=int(np.isin(events, infections).sum())
+        yield size
+
+
+def size_reducers():
+    '''Streaming summaries of outbreak size, from the reducers module.'''
+    return {"sizes" : reducers.Histogram(), "moments" : reducers.Moments(),
+        "quantiles" : reducers.QuantileSketch()}
+
+
+def add_size(summary, size):
+    for reducer in summary.values():
+        reducer.add([size])
+
 
 def write_totals(filename, outfile):
+    '''
+    Writes the size of each run as it is read, so sizes are never
+    all held at once, and returns their summary reducers.
+    '''
     logger.info("Reading input {0}. Writing to {1}".format(filename, outfile))
-    totals=run_sizes(filename)
+    summary=size_reducers()
+    with eventfile.EventFile(filename) as f, open(outfile, 'w') as csvfile:
+        writer=csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(["trial", "outbreaksize"])
+        for i, size in enumerate(iter_sizes(f)):
+            writer.writerow([i+1, size])
+            add_size(summary, size)
+    moments=summary["moments"]
     logger.info("Number of trajectories {0}, average size {1}".format(
-        len(totals), np.average(totals)))
-    logger.debug("Sizes are {0}".format(totals))
+        moments.count, moments.mean if moments.count>0 else np.nan))
+    return summary
+
+
+def update_summary(filename):
+    '''
+    Adds runs not yet in /summary/outbreaksize of the event file to
+    its reducers and saves them back, so only new runs are read. When
+    the summary is up to date, the file is not opened for writing,
+    so it is left unchanged.
+    '''
+    with h5py.File(filename, "r") as openh5:
+        saved=reducers.load_summary(openh5, summary_name)
+        if saved is not None and saved[1]==eventfile.trajectory_count(openh5):
+            return saved[0]
+    with h5py.File(filename, "a") as openh5:
+        f=eventfile.EventFile(openh5)
+        summary=size_reducers()
+        start=0
+        saved=reducers.load_summary(openh5, summary_name)
+        if saved is not None and saved[1]<=len(f):
+            summary, start=saved[0], saved[1]
+        logger.info("Summarizing runs {0} to {1}".format(start, len(f)))
+        for size in iter_sizes(f, f.added_since(start)):
+            add_size(summary, size)
+        reducers.save_summary(openh5, summary_name, summary, len(f))
+    return summary
+
+
+def write_event_counts(filename, outfile):
+    '''Writes counts of every event code seen, one row per run.'''
+    logger.info("Reading input {0}. Writing to {1}".format(filename, outfile))
+    table=event_counts(filename)
+    seen=np.nonzero(table.sum(axis=0))[0]
     with open(outfile, 'w') as csvfile:
         writer=csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(["trial", "outbreaksize"])
-        for i in range(len(totals)):
-            writer.writerow([i+1, totals[i]])
+        writer.writerow(["trial"]+["event{0}".format(x) for x in seen])
+        for i in range(len(table)):
+            writer.writerow([i+1]+table[i, seen].tolist())
+
+
+class OutbreakSizeTest(unittest.TestCase):
+    '''Compares the CSV with the one from counting event by event.'''
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.h5=os.path.join(self.directory, "events.h5")
+        table=read_naadsm.transition_table(read_naadsm.default_transitions())
+        with h5py.File(self.h5, "w") as f:
+            f.create_group("/trajectory")
+            writer=read_naadsm.EventWriter(f)
+            for seed in range(12):
+                states=read_naadsm.synthetic_states(40, 30, 0.1*seed, seed)
+                writer.save(read_naadsm.state_changes(states, table)[0])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def loop_sizes(self):
+        f=h5py.File(self.h5, "r")
+        sizes=list()
+        names=[x for x in f["/trajectory"] if x.startswith("dset")]
+        # Runs in the order written, dset0, dset1, ..., dset10.
+        for trajgroup in sorted(names, key=lambda x: int(x[4:])):
+            cnt=0
+            for e in f["/trajectory/{0}/Event".format(trajgroup)]:
+                if e in set(infections):
+                    cnt+=1
+            sizes.append(cnt)
+        f.close()
+        return sizes
+
+    def test_csv(self):
+        outfile=os.path.join(self.directory, "sizes.csv")
+        write_totals(self.h5, outfile)
+        expected=["trial,outbreaksize"]
+        expected.extend(["{0},{1}".format(i+1, x)
+            for (i, x) in enumerate(self.loop_sizes())])
+        with open(outfile) as csvfile:
+            self.assertEqual(csvfile.read().splitlines(), expected)
+
+    def test_summary(self):
+        sizes=self.loop_sizes()
+        update_summary(self.h5)
+        table=read_naadsm.transition_table(read_naadsm.default_transitions())
+        with h5py.File(self.h5, "a") as f:
+            writer=read_naadsm.EventWriter(f)
+            states=read_naadsm.synthetic_states(40, 30, 0.9, 99)
+            writer.save(read_naadsm.state_changes(states, table)[0])
+        summary=update_summary(self.h5)
+        sizes=self.loop_sizes()
+        self.assertEqual(summary["moments"].count, len(sizes))
+        self.assertAlmostEqual(summary["moments"].mean, np.mean(sizes))
+        self.assertEqual(summary["sizes"].counts.tolist(),
+            np.bincount(sizes).tolist())
+
+    def test_summary_unchanged(self):
+        '''An up to date summary leaves the file as it was, for the cache.'''
+        update_summary(self.h5)
+        with open(self.h5, "rb") as f:
+            before=f.read()
+        mtime=os.stat(self.h5).st_mtime_ns
+        summary=update_summary(self.h5)
+        self.assertEqual(summary["moments"].count, 12)
+        with open(self.h5, "rb") as f:
+            self.assertEqual(f.read(), before)
+        self.assertEqual(os.stat(self.h5).st_mtime_ns, mtime)
+
+    def test_event_counts(self):
+        table=event_counts(self.h5)
+        self.assertEqual(table[:, infections].sum(axis=1).tolist(),
+            self.loop_sizes())
+        self.assertEqual(table.shape[0], 12)
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(OutbreakSizeTest)
 
 # X_plot=np.linspace(-5, 50, 1000)[:, np.newaxis]
 # fig, ax=plt.subplots(1, 1)
@@ -48,11 +221,36 @@ def write_totals(filename, outfile):
 # ax[0,0].fill(X_plot[:, 0], np.exp(log_dens), fc='#AAAFF')
 
 if __name__ == '__main__':
-    parser=DefaultArgumentParser(description="Produces csv of total outbreak size")
+    parser=DefaultArgumentParser(description="Produces csv of total outbreak size",
+        suite=suite)
     parser.add_argument("--input", dest="infile", action="store",
         default="run.h5", help="Input HDF5 file with ensemble of events")
     parser.add_argument("--output", dest="outfile", action="store",
         default="sizesc.csv", help="CSV output with sizes")
+    parser.add_argument("--events", dest="eventfile", action="store",
+        default=None, help="CSV output with counts of each event type per run")
+    parser.add_function("summary", "update size statistics in /summary of the input")
+    parser.add_argument("--cache-dir", dest="cache_dir", action="store",
+        default=None, help="Reuse outputs kept in this cache directory")
+    parser.add_argument("--cache-size", dest="cache_size", action="store",
+        type=int, default=cache.default_max_bytes>>20,
+        help="Size limit of the cache, in MB")
 
     args=parser.parse_args()
-    write_totals(args.infile, args.outfile)
+    outputs=[args.outfile]
+    if args.eventfile is not None:
+        outputs.append(args.eventfile)
+
+    def compute():
+        write_totals(args.infile, args.outfile)
+        if args.eventfile is not None:
+            write_event_counts(args.infile, args.eventfile)
+
+    # Summaries change the input file, so they come before its hash,
+    # and leave it alone when there are no new runs.
+    if args.summary:
+        summary=update_summary(args.infile)
+        logger.info("Size quantiles 0.05, 0.5, 0.95 are {0}".format(
+            summary["quantiles"].quantile([0.05, 0.5, 0.95])))
+    cache.cached(args.cache_dir, args.cache_size<<20, "outbreaksize",
+        [args.infile], {"events" : args.eventfile is not None}, outputs, compute)
@@ -3,12 +3,13 @@
 #NAADSMTRACE=$1
 #ID=$2
 #NAADSMDATA=$3 
+#JOBS=$4
+#CACHE_DIR=$5
+CACHE_DIR=${CACHE_DIR:-$HOME/.cache/naadsmtools}
 
-python read_naadsm.py --multiple --input $NAADSMTRACE --output $NAADSMDATA
-python outbreaksize.py --input $NAADSMDATA --output outbreak_hist_$ID.csv
-R --no-save --args "outbreak_hist_$ID" < plot_outbreaksize.R 
-python residence_histogram.py --input $NAADSMDATA --id $ID
-R --no-save --args "clinical_$ID" < plot_individual_dist.R
-R --no-save --args "latent_$ID" < plot_individual_dist.R
-R --no-save --args "susceptible_$ID" < plot_individual_dist.R
+python read_naadsm.py --input $NAADSMTRACE --output $NAADSMDATA --jobs ${JOBS:-1}
+python outbreaksize.py --input $NAADSMDATA --output outbreak_hist_$ID.csv --cache-dir $CACHE_DIR
+python survival.py --sizes outbreak_hist_$ID
+python residence_histogram.py --input $NAADSMDATA --id $ID --format weighted --cache-dir $CACHE_DIR
+python survival.py --name clinical_$ID,latent_$ID,susceptible_$ID
 
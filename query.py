@@ -0,0 +1,373 @@
+'''
+Answers questions about runs of an event file, such as when farm
+1234 was infected in each run, or which runs had more than 50
+farms infected by day 30, from indexes kept in the group /index of the
+file, so they read only what they return instead of every run.
+
+  python query.py --input naadsm.h5 --build
+  python query.py --input naadsm.h5 --farm 1234
+  python query.py --input naadsm.h5 --min-size 50 --by-day 30
+  python query.py --input naadsm.h5 --min-size 50 --export large.h5
+
+The indexes are made once by --build, which reads every run. They are
+the size and last day of each run, the first infection day of each
+farm in each run, stored twice: by run, with farms in order of
+infection, and by farm, with runs in order, and the number of farms
+infected in each run by each day on which a farm was first infected. Runs are numbered by
+their position in EventFile, and farms as in the Whom column, from
+zero. Runs added to the file afterwards need --build again.
+
+--export copies the selected runs into a new event file, in the order
+given, which outbreak_movie.py, residence_histogram.py and the other
+tools read like any other. The movie shows the first of them.
+'''
+import csv
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import h5py
+import numpy as np
+from default_parser import DefaultArgumentParser, timed
+import eventfile
+import read_naadsm
+
+logger=logging.getLogger(__file__)
+
+index_name="/index"
+# Number of runs in the event file when the index was built.
+run_count_attr="run_count"
+# Event codes for transitions out of susceptible, as in outbreaksize.py.
+infections=[0, 5, 6]
+
+
+def first_infections(run):
+    '''
+    Farms infected in a run, each once, in order of infection, the
+    days they were first infected, and the number of infection events.
+    '''
+    events=run["Event"]
+    infected=np.isin(events, infections)
+    whom=run["Whom"][infected]
+    when=run["When"][infected]
+    # Events are in time order, so the first index of each farm is its first day.
+    order=np.sort(np.unique(whom, return_index=True)[1])
+    return whom[order].astype(np.int64), when[order], int(infected.sum())
+
+
+def farm_major(run_offsets, farms, days, farm_cnt):
+    '''
+    The same infections ordered by farm then run, as farm offsets and
+    the run and day of each, so farm i has entries offsets[i] to offsets[i+1].
+    '''
+    runs=np.repeat(np.arange(len(run_offsets)-1), np.diff(run_offsets))
+    order=np.lexsort((runs, farms))
+    offsets=np.zeros((farm_cnt+1,), dtype=np.int64)
+    np.cumsum(np.bincount(farms, minlength=farm_cnt), out=offsets[1:])
+    return offsets, runs[order], days[order]
+
+
+def farms_by_day(run_offsets, days):
+    '''
+    Days on which any farm was first infected, in order, and for each
+    of them, the number of farms infected by then in each run, as an
+    array of (day, run), so the counts for one day are contiguous.
+    '''
+    day_values=np.unique(days)
+    run_cnt=len(run_offsets)-1
+    counts=np.zeros((len(day_values), run_cnt), dtype=np.int64)
+    for run in range(run_cnt):
+        run_days=np.sort(days[run_offsets[run]:run_offsets[run+1]])
+        counts[:, run]=np.searchsorted(run_days, day_values, side="right")
+    return day_values, counts
+
+
+def build_index(filename):
+    '''Reads every run and writes /index, replacing any there.'''
+    with h5py.File(filename, "a") as openh5:
+        f=eventfile.EventFile(openh5)
+        farms=list()
+        days=list()
+        sizes=np.zeros((len(f),), dtype=np.int64)
+        lengths=[0]
+        farm_cnt=f.unit_count() or 0
+        for idx, run in enumerate(f):
+            with timed("build_index", runs=1, rows=len(run)):
+                run_farms, run_days, sizes[idx]=first_infections(run)
+            farms.append(run_farms)
+            days.append(run_days)
+            lengths.append(len(run_farms))
+            if len(run_farms)>0:
+                farm_cnt=max(farm_cnt, int(run_farms.max())+1)
+        run_offsets=np.cumsum(lengths)
+        farms=np.concatenate(farms) if len(farms)>0 else np.zeros((0,), dtype=np.int64)
+        days=np.concatenate(days) if len(days)>0 else np.zeros((0,), dtype=np.float64)
+        farm_offsets, farm_runs, farm_days=farm_major(run_offsets, farms, days,
+            farm_cnt)
+        day_values, infected_by_day=farms_by_day(run_offsets, days)
+
+        if index_name in openh5:
+            del openh5[index_name]
+        group=openh5.create_group(index_name)
+        for name, data in [("final_size", sizes), ("end_day", f.last_times()),
+                ("run_offsets", run_offsets), ("run_farms", farms),
+                ("run_days", days), ("farm_offsets", farm_offsets),
+                ("farm_runs", farm_runs), ("farm_days", farm_days),
+                ("day_values", day_values), ("infected_by_day", infected_by_day)]:
+            group.create_dataset(name, data=data)
+        group.attrs[run_count_attr]=len(f)
+        logger.info("Indexed {0} runs, {1} infections of {2} farms".format(
+            len(f), len(farms), farm_cnt))
+
+
+class Index(object):
+    '''
+    Reads /index of an event file. Lookups by farm or run read two
+    offsets and then only the entries they return. Lookups by size
+    read a number per run, and by day, the days indexed as well.
+    '''
+    def __init__(self, filename):
+        if isinstance(filename, h5py.File):
+            self.openh5=filename
+            self.owned=False
+        else:
+            self.openh5=h5py.File(filename, "r")
+            self.owned=True
+        if index_name not in self.openh5:
+            self.close()
+            raise KeyError("No {0} in the event file, run query.py --build".format(
+                index_name))
+        self.group=self.openh5[index_name]
+        run_cnt=eventfile.trajectory_count(self.openh5)
+        if int(self.group.attrs[run_count_attr])!=run_cnt:
+            logger.warning("Index has {0} runs but the file has {1}, run --build".format(
+                int(self.group.attrs[run_count_attr]), run_cnt))
+
+    def close(self):
+        if self.owned:
+            self.openh5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return int(self.group.attrs[run_count_attr])
+
+    @property
+    def farm_count(self):
+        return len(self.group["farm_offsets"])-1
+
+    def entries(self, prefix, idx):
+        begin, end=self.group["{0}_offsets".format(prefix)][idx:idx+2]
+        return begin, end
+
+    def farm(self, farm):
+        '''Runs in which farm was infected, and the first day in each.'''
+        if farm<0 or farm>=self.farm_count:
+            return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.float64)
+        begin, end=self.entries("farm", farm)
+        return self.group["farm_runs"][begin:end], self.group["farm_days"][begin:end]
+
+    def run(self, run):
+        '''Farms infected in run, in order of infection, and their first days.'''
+        begin, end=self.entries("run", run)
+        return self.group["run_farms"][begin:end], self.group["run_days"][begin:end]
+
+    def final_sizes(self):
+        return self.group["final_size"][()]
+
+    def end_days(self):
+        return self.group["end_day"][()]
+
+    def farms_infected(self, day=None):
+        '''
+        Number of farms infected in each run, by the end of day if
+        given. Reinfections aren't counted, as they are in final_sizes.
+        '''
+        if "infected_by_day" not in self.group:
+            raise KeyError("No infected_by_day in {0}, run query.py --build".format(
+                index_name))
+        if day is None:
+            return np.diff(self.group["run_offsets"][()])
+        idx=int(np.searchsorted(self.group["day_values"][()], day, side="right"))
+        if idx==0:
+            return np.zeros((len(self),), dtype=np.int64)
+        return self.group["infected_by_day"][idx-1]
+
+    def runs_by_size(self, low=None, high=None, day=None):
+        '''
+        Runs whose size is from low to high, inclusive, either or both
+        of which may be None. The size is the number of farms infected,
+        by the end of day if given.
+        '''
+        sizes=self.farms_infected(day)
+        selected=np.ones(len(sizes), dtype=bool)
+        if low is not None:
+            selected&=sizes>=low
+        if high is not None:
+            selected&=sizes<=high
+        return np.nonzero(selected)[0]
+
+
+def export_runs(filename, runs, outfile, layout=None):
+    '''Copies runs, by position, into a new event file.'''
+    with eventfile.EventFile(filename) as f, h5py.File(outfile, "w") as out:
+        out.create_group("/trajectory")
+        writer=read_naadsm.EventWriter(out, layout=layout or f.layout)
+        for idx in runs:
+            run=f.run(int(idx))
+            writer.save([run[x] for x in eventfile.column_names], f.unit_count())
+    logger.info("Wrote {0} runs to {1}".format(len(runs), outfile))
+
+
+def write_rows(outfile, header, columns):
+    '''CSV rows to outfile, or to standard output if it is None.'''
+    csvfile=sys.stdout if outfile is None else open(outfile, "w")
+    try:
+        writer=csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(header)
+        for row in zip(*[np.asarray(x).tolist() for x in columns]):
+            writer.writerow(row)
+    finally:
+        if outfile is not None:
+            csvfile.close()
+
+
+class QueryTest(unittest.TestCase):
+    '''Compares lookups with scans of every run, for both layouts.'''
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.table=read_naadsm.transition_table(read_naadsm.default_transitions())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def events(self, layout, run_cnt=12):
+        filename=os.path.join(self.directory, "{0}.h5".format(layout))
+        with h5py.File(filename, "w") as f:
+            f.create_group("/trajectory")
+            writer=read_naadsm.EventWriter(f, layout=layout)
+            for seed in range(run_cnt):
+                states=read_naadsm.synthetic_states(30, 40, 0.08*seed, seed)
+                writer.save(read_naadsm.state_changes(states, self.table)[0], 30)
+        build_index(filename)
+        return filename
+
+    def scan(self, filename):
+        '''First infection day of each farm, by run, from the events.'''
+        first=list()
+        sizes=list()
+        with eventfile.EventFile(filename) as f:
+            for run in f:
+                days=dict()
+                size=0
+                for event, whom, when in zip(run["Event"], run["Whom"], run["When"]):
+                    if event in infections:
+                        size+=1
+                        if whom not in days:
+                            days[int(whom)]=float(when)
+                first.append(days)
+                sizes.append(size)
+        return first, sizes
+
+    def test_lookups(self):
+        for layout in ["groups", "table"]:
+            filename=self.events(layout)
+            first, sizes=self.scan(filename)
+            with Index(filename) as index:
+                self.assertEqual(len(index), 12)
+                for farm in range(index.farm_count):
+                    runs, days=index.farm(farm)
+                    expected=[(r, x[farm]) for (r, x) in enumerate(first) if farm in x]
+                    self.assertEqual(list(zip(runs.tolist(), days.tolist())), expected)
+                for run in range(len(first)):
+                    farms, days=index.run(run)
+                    self.assertEqual(dict(zip(farms.tolist(), days.tolist())), first[run])
+                    self.assertTrue(np.all(np.diff(days)>=0))
+                for day in [-1, 0, 1, 10, 10.5, 39, 100]:
+                    self.assertEqual(index.farms_infected(day).tolist(),
+                        [len([d for d in x.values() if d<=day]) for x in first])
+                self.assertEqual(index.final_sizes().tolist(), sizes)
+                farm_cnts=[len(x) for x in first]
+                self.assertEqual(index.farms_infected().tolist(), farm_cnts)
+                self.assertEqual(index.runs_by_size(5, 20).tolist(),
+                    [i for (i, x) in enumerate(farm_cnts) if 5<=x<=20])
+                last=max(index.end_days())
+                self.assertEqual(index.runs_by_size(5, 20, last).tolist(),
+                    index.runs_by_size(5, 20).tolist())
+
+    def test_export(self):
+        filename=self.events("groups")
+        outfile=os.path.join(self.directory, "subset.h5")
+        with Index(filename) as index:
+            runs=index.runs_by_size(low=3)
+        export_runs(filename, runs, outfile)
+        with eventfile.EventFile(filename) as f, eventfile.EventFile(outfile) as g:
+            self.assertEqual(len(g), len(runs))
+            self.assertEqual(g.unit_count(), 30)
+            for position, idx in enumerate(runs):
+                for name in eventfile.column_names:
+                    self.assertTrue(np.array_equal(f.run(idx)[name], g.run(position)[name]))
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(QueryTest)
+
+
+
+if __name__ == "__main__":
+    parser=DefaultArgumentParser(description="Queries indexes of an event file",
+        suite=suite)
+    parser.add_argument("--input", dest="infile", action="store",
+        default="naadsm.h5", help="Input HDF5 file with ensemble of events")
+    parser.add_function("build", "read every run and write /index")
+    parser.add_argument("--farm", dest="farm", action="store", type=int,
+        default=None, help="List runs in which this farm was infected, with days")
+    parser.add_argument("--run", dest="run", action="store", type=int,
+        default=None, help="List farms infected in this run, with days")
+    parser.add_argument("--min-size", dest="min_size", action="store", type=int,
+        default=None, help="Select runs with at least this many farms infected")
+    parser.add_argument("--max-size", dest="max_size", action="store", type=int,
+        default=None, help="Select runs with at most this many farms infected")
+    parser.add_argument("--by-day", dest="by_day", action="store", type=float,
+        default=None, help="Count farms infected up to this day for --min-size and --max-size")
+    parser.add_argument("--output", dest="outfile", action="store",
+        default=None, help="CSV file for results, instead of standard output")
+    parser.add_argument("--export", dest="export", action="store",
+        default=None, help="Copy the selected runs into this new event file")
+    parser.add_argument("--layout", dest="layout", action="store",
+        choices=["groups", "table"], default=None,
+        help="Layout of the exported file, by default that of the input")
+    args=parser.parse_args()
+
+    if args.build:
+        build_index(args.infile)
+    selecting=(args.min_size, args.max_size, args.by_day)!=(None, None, None)
+    if args.farm is None and args.run is None and not selecting:
+        if not args.build:
+            parser.print_help()
+        sys.exit(0)
+
+    # The runs listed are the ones --export copies.
+    with Index(args.infile) as index:
+        if selecting:
+            selected=index.runs_by_size(args.min_size, args.max_size, args.by_day)
+            farm_cnts=index.farms_infected(args.by_day)[selected]
+            sizes=index.final_sizes()[selected]
+            ends=index.end_days()[selected]
+            write_rows(args.outfile, ["run", "farms", "outbreaksize", "end_day"],
+                [selected, farm_cnts, sizes, ends])
+        elif args.farm is not None:
+            selected, days=index.farm(args.farm)
+            write_rows(args.outfile, ["run", "day"], [selected, days])
+        else:
+            farms, days=index.run(args.run)
+            write_rows(args.outfile, ["farm", "day"], [farms, days])
+            selected=[args.run]
+    if args.export is not None:
+        export_runs(args.infile, selected, args.export, args.layout)
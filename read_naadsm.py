@@ -1,10 +1,25 @@
+import collections
+import hashlib
 import logging
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import unittest
 import numpy as np
 import h5py
-from default_parser import DefaultArgumentParser
+from default_parser import DefaultArgumentParser, timed
+import eventfile
 
 logger=logging.getLogger(__file__)
 
+# States are numbered as in naadsm/gui/NAADSMLibrary.pas,
+# Susceptible, Latent, suBclinical, Clinical, Naturally immune,
+# Vaccine immune, Destroyed.
+state_cnt=7
+
 
 def combine_counts(starting, combine):
     for k, v in combine.items():
@@ -14,76 +29,473 @@ def combine_counts(starting, combine):
             starting[k]+=v
     return starting
 
-def read_multiple_naadsmsc(filename, outfile):
-    hdf=h5py.File(outfile, "w")
-    hdf.create_group("/trajectory")
-
-    allowed=dict()
-    vals=list()
-    run=-1
+def default_transitions():
+    '''
+    Event codes for each (previous state, next state) pair. The
+    transitions NAADSM/SC reports for disease progression have their
+    own codes. Every other change of state gets a code from 10 up.
+    '''
     transitions_type=dict([(b,a+10) for (a,b) in enumerate([(s,d) for s in range(6) for d in range(6) if s!=d])])
+    # Transitions in and out of destroyed come after, so the codes
+    # above keep their values.
+    destroyed=state_cnt-1
+    other=[(s, destroyed) for s in range(destroyed)]+[(destroyed, d) for d in range(destroyed)]
+    transitions_type.update(dict([(b,a+10+len(transitions_type)) for (a,b) in enumerate(other)]))
     transitions_type.update({(0,1) : 0, (1,3) : 1, (3,4) : 3, (4,0) : 4, (0,3) : 5, (0,4) : 6, (1,4) : 8})
-    # lookup table for states from naadsm/gui/NAADSMLibrary.pas
-    lookup = {'0': 0, '1': 1, '2': 2, '3': 3, '4': 4, '5': 5, '6': 6, \
-              'S': 0, 'L': 1, 'B': 2, 'C': 3, 'N': 4, 'V': 5, 'D': 6}
-    with open(filename, "r") as f:
-        line=f.readline()
-        if len(line)<2:
-            print(line, len(line))
-        if line.startswith("node"):
-            while line is not "":
-                if line.startswith("node"):
-                    x, n, x, r=line.strip().split()
-                    n=int(n)
-                    r=int(r)
-
-                    if r!=run:
-                        if len(vals)>0:
-                            vals=np.vstack(vals)
-                            allowed=combine_counts(allowed, show_transitions(vals))
-                            events=events_from_states(vals, transitions_type)
-                            save_h5(hdf, events)
-                        vals=list()
-                        run=r
-
-                    line=f.readline()
-                    states=[int(y) for y in line.strip().split()]
-                    vals.append(np.array(states))
-
-                line=f.readline()
-
-        elif line.startswith("Iteration"):
-            while True:
-                if line.startswith("Iteration"):
-                    x, r=line.strip().split()
-                    r=int(r)
-
-                if r!=run:
-                    if len(vals)>0:
-                        vals=np.vstack(vals)
-                        allowed=combine_counts(allowed, show_transitions(vals))
-                        events=events_from_states(vals, transitions_type)
-                        save_h5(hdf, events)
-                    vals=list()
-                    run=r
-
-                line=f.readline()
-                if not line: break
-
-                while (len(line) != 1) and (not line.startswith("Iteration")):
-                    states=[lookup[y] for y in line.strip().split()]
-                    vals.append(np.array(states))
-                    line=f.readline()
-                    if not line: break
-
-            line=f.readline()
-                
-    if len(vals)>0:
-        vals=np.vstack(vals)
-        allowed=combine_counts(allowed, show_transitions(vals))
-        events=events_from_states(np.vstack(vals), transitions_type)
-        save_h5(hdf, events)
+    return transitions_type
+
+
+def transition_table(transitions_dict):
+    '''
+    Turns a dictionary from (previous, next) to event code into
+    a state_cnt x state_cnt array. Pairs without an event are -1.
+    '''
+    table=-np.ones((state_cnt, state_cnt), dtype=np.int32)
+    for (previous, next), event in transitions_dict.items():
+        table[previous, next]=event
+    return table
+
+
+def transition_states(transitions_dict):
+    '''
+    The inverse of transition_table, arrays of the previous and next
+    state for each event code. Codes without a transition are -1.
+    '''
+    code_cnt=max(transitions_dict.values())+1
+    previous=-np.ones((code_cnt,), dtype=np.int8)
+    next=-np.ones((code_cnt,), dtype=np.int8)
+    for (before, after), event in transitions_dict.items():
+        previous[event]=before
+        next[event]=after
+    return previous, next
+
+
+def state_changes(state_array, table):
+    '''
+    Finds every change of state in a (day x unit) state array in one
+    pass. Returns the event columns (event, whom, who, when), ordered
+    by day and then unit, and a dictionary of counts of each
+    (previous, next) transition, as show_transitions would.
+    '''
+    state_array=np.asarray(state_array)
+    with timed("state_changes", days=len(state_array),
+            states=state_array.size) as counted:
+        previous=state_array[:-1]
+        next=state_array[1:]
+        day, unit=np.nonzero(previous!=next)
+        pairs=previous[day, unit].astype(np.intp)*state_cnt+next[day, unit]
+        event=table.ravel()[pairs]
+        if np.any(event<0):
+            bad=pairs[event<0][0]
+            raise KeyError((int(bad//state_cnt), int(bad%state_cnt)))
+        counts=np.bincount(pairs, minlength=state_cnt*state_cnt)
+        counted["events"]=len(event)
+    allowed=dict()
+    for pair in np.nonzero(counts)[0]:
+        allowed[(int(pair//state_cnt), int(pair%state_cnt))]=int(counts[pair])
+    return (event, unit, unit, (day+1).astype(np.float64)), allowed
+
+
+# Decodes a line of states to bytes holding state numbers. Digits
+# are NAADSM/SC output. Letters are the GUI's codes, from the lookup
+# table in naadsm/gui/NAADSMLibrary.pas.
+state_bytes=bytes.maketrans(b"0123456SLBCNVD", bytes(range(state_cnt))*2)
+space_bytes=b" \t\r\n"
+# Largest state array kept for one run, in bytes.
+default_max_buffer=1<<30
+
+
+def decode_states(line):
+    '''A line of single-character states as an int8 array.'''
+    states=np.frombuffer(line.translate(state_bytes, space_bytes), dtype=np.int8)
+    if len(states)>0 and (states.max()>=state_cnt or states.min()<0):
+        raise ValueError("Unknown state in line {0}".format(line[:80]))
+    return states
+
+
+def parse_runs(lines, max_buffer=default_max_buffer):
+    '''
+    Reads lines of a trace, as bytes, and yields (run, states) for
+    each run, where states is an int8 (day x unit) array. Runs start
+    at "node n run r" lines for NAADSM/SC output and at "Iteration r"
+    lines for GUI output. The states array is a view of a buffer
+    which is reused for the next run, so copy it to keep it.
+    The buffer doubles as days are added, up to max_buffer bytes.
+    '''
+    buffer=None
+    day=0
+    run=None
+    for line in lines:
+        if line.startswith(b"node"):
+            r=int(line.split()[3])
+        elif line.startswith(b"Iteration"):
+            r=int(line.split()[1])
+        else:
+            if len(line.strip())==0:
+                continue
+            states=decode_states(line)
+            if buffer is None:
+                rows=max(1, min(64, max_buffer//max(len(states), 1)))
+                buffer=np.zeros((rows, len(states)), dtype=np.int8)
+            if len(states)!=buffer.shape[1]:
+                raise ValueError("Run {0} day {1} has {2} units, not {3}".format(
+                    run, day, len(states), buffer.shape[1]))
+            if day==buffer.shape[0]:
+                rows=min(2*day, max_buffer//buffer.shape[1])
+                if rows<=day:
+                    raise MemoryError("Run {0} needs more than {1} bytes".format(
+                        run, max_buffer))
+                grown=np.zeros((rows, buffer.shape[1]), dtype=np.int8)
+                grown[:day]=buffer[:day]
+                buffer=grown
+            buffer[day]=states
+            day+=1
+            continue
+
+        if r!=run:
+            if day>0:
+                yield run, buffer[:day]
+            day=0
+            run=r
+
+    if day>0:
+        yield run, buffer[:day]
+
+
+def iter_runs(filename, max_buffer=default_max_buffer):
+    '''Yields (run, states) for each run in a trace file.'''
+    with open(filename, "rb") as f:
+        for run, states in parse_runs(f, max_buffer):
+            yield run, states
+
+
+# Start of a line which begins a run, in either format.
+run_header=re.compile(rb"^(?:node\s+\S+\s+run|Iteration)\s+(-?\d+)", re.MULTILINE)
+
+
+def scan_runs(mm, begin=0):
+    '''
+    Numbers and starting byte offsets of the runs in a memory-mapped
+    trace from byte begin on. Consecutive headers with the same run
+    number are one run.
+    '''
+    runs=list()
+    offsets=list()
+    for header in run_header.finditer(mm, begin):
+        run=int(header.group(1))
+        if len(runs)==0 or runs[-1]!=run:
+            runs.append(run)
+            offsets.append(header.start())
+    return runs, offsets
+
+
+def mapped_lines(mm, begin, end):
+    '''Lines of a memory map from byte begin up to byte end.'''
+    mm.seek(begin)
+    while mm.tell()<end:
+        yield mm.readline()
+
+
+class TraceIndex(object):
+    '''
+    Byte offsets of each run in a trace, so that single runs or
+    ranges of runs are decoded without reading the rest of the file.
+    The trace is memory-mapped and scanned for run headers. The index
+    is kept in a sidecar file next to the trace and reused while the
+    trace keeps the same size and modification time.
+    runs[i] is the number of the i-th run in the file, which spans
+    bytes offsets[i] to offsets[i+1].
+    '''
+    def __init__(self, filename, sidecar=None):
+        self.filename=filename
+        self.sidecar=sidecar or "{0}.idx.npz".format(filename)
+        stat=os.stat(filename)
+        self.stamp=np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        self.file=open(filename, "rb")
+        self.mm=None
+        if stat.st_size>0:
+            self.mm=mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if not self.load():
+            self.build()
+            self.save()
+
+    def load(self):
+        if not os.path.exists(self.sidecar):
+            return False
+        try:
+            with np.load(self.sidecar) as saved:
+                if not np.array_equal(saved["stamp"], self.stamp):
+                    logger.debug("{0} is out of date".format(self.sidecar))
+                    return False
+                self.runs=saved["runs"]
+                self.offsets=saved["offsets"]
+        except (IOError, KeyError, ValueError) as err:
+            logger.warning("Could not read {0}: {1}".format(self.sidecar, err))
+            return False
+        return True
+
+    def build(self):
+        runs=list()
+        offsets=list()
+        if self.mm is not None:
+            runs, offsets=scan_runs(self.mm)
+        offsets.append(self.stamp[0])
+        self.runs=np.array(runs, dtype=np.int64)
+        self.offsets=np.array(offsets, dtype=np.int64)
+        logger.debug("indexed {0} runs in {1}".format(len(runs), self.filename))
+
+    def save(self):
+        try:
+            # Through a file, so np.savez doesn't add .npz to the name.
+            with open(self.sidecar, "wb") as f:
+                np.savez(f, runs=self.runs, offsets=self.offsets,
+                    stamp=self.stamp)
+        except IOError as err:
+            logger.warning("Could not write {0}: {1}".format(self.sidecar, err))
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.runs)
+
+    def lines(self, begin, end):
+        return mapped_lines(self.mm, begin, end)
+
+    def iter_runs(self, start=0, stop=None, max_buffer=default_max_buffer):
+        '''
+        Yields (run, states) for runs start up to stop, counted
+        by position in the file, as parse_runs does.
+        '''
+        stop=len(self.runs) if stop is None else min(stop, len(self.runs))
+        if start>=stop:
+            return
+        lines=self.lines(self.offsets[start], self.offsets[stop])
+        for run, states in parse_runs(lines, max_buffer):
+            yield run, states
+
+    def read_run(self, run, max_buffer=default_max_buffer):
+        '''The int8 (day x unit) states for the run with this number.'''
+        position=np.nonzero(self.runs==run)[0]
+        if len(position)==0:
+            raise KeyError("No run {0} in {1}".format(run, self.filename))
+        for r, states in self.iter_runs(position[0], position[0]+1, max_buffer):
+            return states.copy()
+
+
+def convert_runs(runs, table):
+    '''Yields (run, events, counts, unit_cnt) for each (run, states).'''
+    for run, states in runs:
+        events, counts=state_changes(states, table)
+        logger.debug("run {0} has {1} days".format(run, len(states)))
+        yield run, events, counts, states.shape[1]
+
+
+# Length of the hex digest from prefix_digest.
+prefix_digest_size=40
+
+
+def prefix_digest(filename, end, block_size=1<<16):
+    '''
+    sha1 of the length and of the first and last blocks of the bytes
+    of a file before end. It changes when a trace is replaced by
+    another, even of the same size, and not when runs are added.
+    '''
+    digest=hashlib.sha1(str(end).encode())
+    with open(filename, "rb") as f:
+        digest.update(f.read(min(block_size, end)))
+        last=max(0, end-block_size)
+        f.seek(last)
+        digest.update(f.read(end-last))
+    return digest.hexdigest()
+
+
+def trace_extends(filename, outfile):
+    '''
+    False if the runs in outfile were converted from a different trace
+    than filename, because the trace is shorter than what was
+    converted or its converted bytes have another digest.
+    '''
+    if not os.path.exists(outfile):
+        return True
+    with h5py.File(outfile, "r") as hdf:
+        if "/trajectory" not in hdf:
+            return True
+        position=eventfile.trace_position(hdf)
+        if position is None:
+            return True
+        digest=eventfile.trace_digest(hdf)
+    end=position[1]
+    if digest is None or os.stat(filename).st_size<end:
+        return False
+    return prefix_digest(filename, end)==digest
+
+
+def appended_runs(filename, begin, final=False):
+    '''
+    Numbers of the runs in a trace from byte begin on and the byte
+    offsets which bound them, one more than there are runs. Unless
+    final, the last run is left out, because the simulation may
+    still be writing it. Raises ValueError if begin is not the start
+    of a run, which means the trace was replaced.
+    '''
+    size=os.stat(filename).st_size
+    if size<begin:
+        raise ValueError("{0} is shorter than the {1} bytes already converted".format(
+            filename, begin))
+    if size==begin:
+        return [], [begin]
+    with open(filename, "rb") as f:
+        mm=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if not run_header.match(mm, begin):
+                raise ValueError("{0} has no run starting at byte {1}".format(
+                    filename, begin))
+            runs, offsets=scan_runs(mm, begin)
+        finally:
+            mm.close()
+    if final:
+        offsets.append(size)
+    else:
+        runs=runs[:-1]
+    return runs, offsets
 
+
+def convert_span(span):
+    '''
+    Worker for bounded_runs. Converts each run between consecutive
+    byte offsets of a trace and returns a list of (end, converted),
+    where end is the offset after the run and converted is (run,
+    events, counts, unit_cnt), or None for a run without states.
+    '''
+    filename, bounds, max_buffer=span
+    table=transition_table(default_transitions())
+    converted=list()
+    with open(filename, "rb") as f:
+        mm=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for begin, end in zip(bounds[:-1], bounds[1:]):
+                runs=parse_runs(mapped_lines(mm, begin, end), max_buffer)
+                converted.append((end, next(convert_runs(runs, table), None)))
+        finally:
+            mm.close()
+    return converted
+
+
+def bounded_runs(filename, bounds, jobs=1, max_buffer=default_max_buffer,
+        ahead=2):
+    '''
+    Yields (end, converted) for each run between consecutive byte
+    offsets in bounds, in file order, as convert_span does. With more
+    than one job, a pool of processes parses and diffs spans of runs.
+    At most ahead*jobs spans are queued or waiting to be written, so
+    converted runs don't pile up while the HDF5 file is written.
+    '''
+    bounds=[int(x) for x in bounds]
+    run_cnt=len(bounds)-1
+    per_task=max(1, run_cnt//(4*jobs))
+    spans=[(filename, bounds[begin:min(begin+per_task, run_cnt)+1], max_buffer)
+        for begin in range(0, run_cnt, per_task)]
+    if jobs>1 and len(spans)>1:
+        with multiprocessing.Pool(jobs) as pool:
+            pending=collections.deque()
+            for span in spans:
+                pending.append(pool.apply_async(convert_span, (span,)))
+                if len(pending)>=ahead*jobs:
+                    for item in pending.popleft().get():
+                        yield item
+            while pending:
+                for item in pending.popleft().get():
+                    yield item
+    else:
+        for span in spans:
+            for item in convert_span(span):
+                yield item
+
+
+def update_summaries(outfile):
+    '''Brings summaries kept under /summary up to date with added runs.'''
+    import reducers
+    with h5py.File(outfile, "r") as f:
+        names=list(f[reducers.summary_path]) if reducers.summary_path in f else []
+    if "outbreaksize" in names:
+        import outbreaksize
+        outbreaksize.update_summary(outfile)
+    if "residence" in names:
+        import residence_histogram
+        residence_histogram.update_tracking(outfile)
+
+
+def read_multiple_naadsmsc(filename, outfile, max_buffer=default_max_buffer,
+        resume=False, jobs=1, append=False, final=False, **storage):
+    '''
+    Converts a trace to an HDF5 event file, one run at a time.
+    Keyword arguments are passed to the EventWriter, to choose
+    chunking and compression. With resume, runs already in the
+    output file are kept and the trace index skips past them.
+    With append, conversion starts at the trace offset recorded
+    in the output, and only complete runs are converted unless
+    final, so a trace still being written can be converted as it
+    grows. Summaries in the output are then updated. If the trace
+    isn't the one the output was converted from, but was replaced,
+    the output is written again from the start. With more
+    than one job, a pool of processes parses and diffs runs while
+    this process writes them in order, so the file is the same
+    as a serial conversion.
+    '''
+    allowed=dict()
+    table=transition_table(default_transitions())
+    mode="a" if (resume or append) else "w"
+    if append and not trace_extends(filename, outfile):
+        logger.warning("{0} holds runs of another trace than {1}, converting it again".format(
+            outfile, filename))
+        mode="w"
+    with h5py.File(outfile, mode) as hdf:
+        if "/trajectory" not in hdf:
+            hdf.create_group("/trajectory")
+        writer=EventWriter(hdf, **storage)
+        bounds=None
+        position=eventfile.trace_position(hdf)
+        if append and (position is not None or writer.trajectory_cnt==0):
+            begin=position[1] if position is not None else 0
+            runs, bounds=appended_runs(filename, begin, final)
+            logger.info("Appending {0} runs after byte {1}".format(len(runs), begin))
+        elif resume or append or jobs>1:
+            with TraceIndex(filename) as index:
+                start=0
+                if resume or append:
+                    start=writer.trajectory_cnt
+                    logger.info("Resuming after {0} of {1} runs".format(
+                        start, len(index)))
+                runs, bounds=index.runs[start:], index.offsets[start:]
+        if bounds is not None:
+            converted=bounded_runs(filename, bounds, jobs, max_buffer)
+        else:
+            # The whole trace is read, so it is marked converted at the end.
+            size=os.stat(filename).st_size
+            converted=((None, item) for item in
+                convert_runs(iter_runs(filename, max_buffer), table))
+        run=writer.last_run
+        for end, item in converted:
+            if item is None:
+                writer.mark(run, end, prefix_digest(filename, end))
+                continue
+            run, events, counts, unit_cnt=item
+            allowed=combine_counts(allowed, counts)
+            writer.save(events, unit_cnt, None if end is None else
+                (run, end, prefix_digest(filename, end)))
+        if bounds is None:
+            writer.mark(run, size, prefix_digest(filename, size))
+    if append:
+        update_summaries(outfile)
     return allowed
 
 
@@ -103,54 +515,389 @@ def show_transitions(state_array):
 
 
 def events_from_states(state_array, transitions_dict):
-    events=list()
-    for i in range(1, len(state_array)):
-        for j in range(0, state_array.shape[1]):
-            previous=state_array[i-1][j]
-            next=state_array[i][j]
-            if previous!=next:
-                key=(previous, next)
-                event=transitions_dict[key]    
-                day=i
-                who=j
-                whom=j
-                events.append((event, whom, who, day))
-    return events
+    '''
+    Finds changes of state one unit and day at a time. Returns the
+    same event columns (event, whom, who, when) as state_changes,
+    which does this in one pass, so either can go to save_h5.
+    '''
+    event=list()
+    unit=list()
+    when=list()
+    with timed("events_from_states", days=len(state_array)) as counted:
+        for i in range(1, len(state_array)):
+            for j in range(0, state_array.shape[1]):
+                previous=state_array[i-1][j]
+                next=state_array[i][j]
+                if previous!=next:
+                    key=(previous, next)
+                    event.append(transitions_dict[key])
+                    unit.append(j)
+                    when.append(i)
+        counted["events"]=len(event)
+    unit=np.array(unit, dtype=np.intp)
+    return (np.array(event, dtype=np.int32), unit, unit,
+        np.array(when, dtype=np.float64))
 
 
 def next_dset(openh5):
-    maxnum=-1
-    for name in openh5["/trajectory"]:
-        if name.startswith("dset"):
-            maxnum=max(maxnum, int(name[4:]))
-    return maxnum+1
+    return eventfile.next_dset(openh5)
+
+
+def chunk_rows(event_cnt):
+    '''
+    Rows per chunk for a column of event_cnt entries. Small runs
+    get a single chunk. Larger runs get about eight chunks, as a
+    power of two between 4096 and 65536 rows.
+    '''
+    if event_cnt<=4096:
+        return max(event_cnt, 1)
+    rows=1<<int(np.ceil(np.log2(event_cnt/8.0)))
+    return int(min(max(rows, 4096), 65536))
+
+
+class EventWriter(object):
+    '''
+    Writes the events of each run to an event file, in either layout
+    described in eventfile. Every column is built as a contiguous
+    typed array and written with a single call. For the groups layout,
+    chunking is used when asked for or when a filter (compression or
+    shuffle) needs it. The table layout is always chunked, so that its
+    columns can grow. Run numbering is kept in the writer and in
+    attributes of /trajectory, so appending to a file resumes without
+    reading its groups.
+    '''
+    columns=eventfile.columns
+    table_chunk=16384
+
+    def __init__(self, openh5, compression=None, compression_opts=None,
+            shuffle=False, chunked=False, layout=None):
+        self.openh5=openh5
+        self.compression=compression
+        self.compression_opts=compression_opts
+        self.shuffle=shuffle
+        self.chunked=chunked or shuffle or (compression is not None)
+        self.trajectory=openh5["/trajectory"]
+        self.next_idx=next_dset(openh5)
+        self.trajectory_cnt=eventfile.trajectory_count(openh5)
+        position=eventfile.trace_position(openh5)
+        self.last_run=position[0] if position is not None else -1
+        existing=eventfile.layout(openh5)
+        if self.trajectory_cnt==0 and len(self.trajectory)==0:
+            self.layout=layout or existing
+        elif layout is not None and layout!=existing:
+            raise ValueError("Cannot add {0} runs to a file with {1} layout".format(
+                layout, existing))
+        else:
+            self.layout=existing
+        self.trajectory.attrs[eventfile.layout_attr]=self.layout
+        if self.trajectory_cnt==0 and position is None:
+            self.create_attributes()
+        if self.layout=="table":
+            self.create_table()
+        else:
+            partial="dset{0}".format(self.next_idx)
+            if partial in self.trajectory:
+                logger.warning("Removing {0}, left by an interrupted save".format(partial))
+                del self.trajectory[partial]
+
+    def create_attributes(self):
+        '''
+        Makes the attributes save and mark write, in one order. They
+        then write values in place with modify, so the bytes of the
+        file don't depend on how often mark is called.
+        '''
+        attrs=self.trajectory.attrs
+        attrs[eventfile.next_dset_attr]=self.next_idx
+        attrs[eventfile.trajectory_count_attr]=self.trajectory_cnt
+        attrs[eventfile.last_run_attr]=self.last_run
+        attrs[eventfile.trace_offset_attr]=0
+        attrs[eventfile.trace_digest_attr]=np.bytes_(prefix_digest_size*b"0")
+
+    def filter_options(self):
+        options=dict()
+        if self.compression is not None:
+            options["compression"]=self.compression
+            if self.compression_opts is not None:
+                options["compression_opts"]=self.compression_opts
+        if self.shuffle:
+            options["shuffle"]=True
+        return options
+
+    def dataset_options(self, event_cnt):
+        if not self.chunked or event_cnt==0:
+            return dict()
+        options=self.filter_options()
+        options["chunks"]=(chunk_rows(event_cnt),)
+        return options
+
+    def create_table(self):
+        '''
+        Makes the columns and offsets of the table layout, or trims
+        rows after the last offset, left by an interrupted save.
+        '''
+        if eventfile.offsets_name not in self.trajectory:
+            for name, dtype in self.columns:
+                self.trajectory.create_dataset(name, (0,), dtype=dtype,
+                    maxshape=(None,), chunks=(self.table_chunk,),
+                    **self.filter_options())
+            self.trajectory.create_dataset(eventfile.offsets_name,
+                data=np.zeros((1,), dtype=np.int64), maxshape=(None,),
+                chunks=(self.table_chunk,))
+        offsets=self.trajectory[eventfile.offsets_name]
+        if len(offsets)>self.trajectory_cnt+1:
+            offsets.resize((self.trajectory_cnt+1,))
+        self.row_cnt=int(offsets[-1])
+        for name, dtype in self.columns:
+            if len(self.trajectory[name])!=self.row_cnt:
+                logger.warning("Trimming {0} to {1} rows, left by an interrupted save".format(
+                    name, self.row_cnt))
+                self.trajectory[name].resize((self.row_cnt,))
+
+    def save_group(self, events):
+        group=self.trajectory.create_group("dset{0}".format(self.next_idx))
+        options=self.dataset_options(len(events[0]))
+        for (name, dtype), column in zip(self.columns, events):
+            data=np.ascontiguousarray(column, dtype=dtype)
+            group.create_dataset(name, data=data, **options)
+
+    def save_table(self, events):
+        begin=self.row_cnt
+        end=begin+len(events[0])
+        for (name, dtype), column in zip(self.columns, events):
+            dataset=self.trajectory[name]
+            dataset.resize((end,))
+            dataset[begin:end]=np.ascontiguousarray(column, dtype=dtype)
+        offsets=self.trajectory[eventfile.offsets_name]
+        offsets.resize((self.trajectory_cnt+2,))
+        offsets[self.trajectory_cnt+1]=end
+        self.row_cnt=end
+
+    def mark(self, run, trace_offset, digest):
+        '''
+        Records the last run converted, where the next one starts, and
+        the prefix_digest of the trace up to there.
+        '''
+        self.last_run=run
+        attrs=self.trajectory.attrs
+        attrs.modify(eventfile.last_run_attr, run)
+        attrs.modify(eventfile.trace_offset_attr, trace_offset)
+        attrs.modify(eventfile.trace_digest_attr, np.bytes_(digest.encode()))
+
+    def save(self, events, unit_cnt=None, position=None):
+        '''
+        Events are the columns (event, whom, who, when). unit_cnt,
+        when given, is the number of units in the run, which is kept
+        as the largest seen so readers know units without events.
+        position, when given, is (run, trace_offset, digest) for mark.
+        '''
+        if len(events)!=len(self.columns):
+            raise ValueError("Expected {0} event columns but got {1}".format(
+                len(self.columns), len(events)))
+        lengths=set([len(x) for x in events])
+        if len(lengths)>1:
+            raise ValueError("Event columns differ in length: {0}".format(
+                [len(x) for x in events]))
+        dset_idx=self.next_idx
+        row_bytes=sum([np.dtype(dtype).itemsize for (name, dtype) in self.columns])
+        with timed("save_h5", runs=1, rows=len(events[0]),
+                bytes=row_bytes*len(events[0])):
+            if self.layout=="table":
+                self.save_table(events)
+            else:
+                self.save_group(events)
+        self.next_idx+=1
+        self.trajectory_cnt+=1
+        attrs=self.trajectory.attrs
+        attrs.modify(eventfile.next_dset_attr, self.next_idx)
+        attrs.modify(eventfile.trajectory_count_attr, self.trajectory_cnt)
+        if unit_cnt is not None:
+            known=eventfile.unit_count(self.openh5) or 0
+            attrs.modify(eventfile.unit_count_attr, max(known, int(unit_cnt)))
+        if position is not None:
+            self.mark(*position)
+        return dset_idx
 
 
 def save_h5(openh5, events):
-    dset_idx=next_dset(openh5)
-    group=openh5.create_group("/trajectory/dset{0}".format(dset_idx))
-    event=group.create_dataset("Event", (len(events),), dtype="i")
-    whom=group.create_dataset("Who", (len(events),), dtype="i")
-    who=group.create_dataset("Whom", (len(events),), dtype="i")
-    when=group.create_dataset("When", (len(events),), dtype=np.float64)
-    for eidx in range(len(events)):
-        aevent, awhom, awho, aday=events[eidx]
-        event[eidx]=aevent
-        whom[eidx]=awhom
-        who[eidx]=awho
-        when[eidx]=aday
+    '''Events are the columns (event, whom, who, when).'''
+    return EventWriter(openh5).save(events)
+
+
+
+def synthetic_states(unit_cnt, day_cnt, attack_rate=0.5, seed=0):
+    '''
+    A (day x unit) state array where a fraction of units goes
+    through susceptible, latent, clinical and naturally immune.
+    '''
+    rng=np.random.RandomState(seed)
+    infected=rng.uniform(size=unit_cnt)<attack_rate
+    start=np.where(infected, rng.randint(1, day_cnt, unit_cnt), day_cnt)
+    clinical=start+rng.randint(1, 8, unit_cnt)
+    immune=clinical+rng.randint(1, 15, unit_cnt)
+    day=np.arange(day_cnt)[:,np.newaxis]
+    states=np.zeros((day_cnt, unit_cnt), dtype=np.int8)
+    states[day>=start]=1
+    states[day>=clinical]=3
+    states[day>=immune]=4
+    return states
+
+
+def benchmark_transitions(unit_cnt, day_cnt):
+    '''
+    Times show_transitions and events_from_states against
+    state_changes on a synthetic trace and checks they agree.
+    '''
+    import time
+    transitions_type=default_transitions()
+    table=transition_table(transitions_type)
+    states=synthetic_states(unit_cnt, day_cnt)
+
+    begin=time.time()
+    loop_allowed=show_transitions(states)
+    loop_events=events_from_states(states, transitions_type)
+    loop_time=time.time()-begin
+
+    begin=time.time()
+    events, allowed=state_changes(states, table)
+    vector_time=time.time()-begin
+
+    assert loop_allowed==allowed
+    assert all([np.array_equal(x, y) for (x, y) in zip(loop_events, events)])
+    logger.info("{0} units {1} days {2} events".format(
+        unit_cnt, day_cnt, len(events[0])))
+    logger.info("loops {0:.3f} s, state_changes {1:.3f} s, speedup {2:.1f}".format(
+        loop_time, vector_time, loop_time/max(vector_time, 1e-9)))
+    return loop_time, vector_time
+
+
+class ConvertTest(unittest.TestCase):
+    '''Converts a small NAADSM/SC trace with one and with more processes.'''
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.trace=os.path.join(self.directory, "naadsm.out")
+        with open(self.trace, "w") as f:
+            for run in range(12):
+                states=synthetic_states(25, 20, 0.1*run, run)
+                for day in states:
+                    f.write("node 0 run {0}\n".format(run))
+                    f.write(" ".join([str(x) for x in day])+"\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def converted_bytes(self, jobs, **kwargs):
+        outfile=os.path.join(self.directory, "jobs{0}.h5".format(jobs))
+        read_multiple_naadsmsc(self.trace, outfile, jobs=jobs, **kwargs)
+        with open(outfile, "rb") as f:
+            return f.read()
+
+    def test_jobs_same_bytes(self):
+        for layout in ["groups", "table"]:
+            serial=self.converted_bytes(1, layout=layout)
+            self.assertEqual(serial, self.converted_bytes(2, layout=layout))
+
+    def test_sidecar_name(self):
+        sidecar=os.path.join(self.directory, "runs.index")
+        with TraceIndex(self.trace, sidecar) as index:
+            runs=index.runs.tolist()
+        self.assertTrue(os.path.exists(sidecar))
+        with TraceIndex(self.trace, sidecar) as index:
+            self.assertTrue(index.load())
+            self.assertEqual(index.runs.tolist(), runs)
+
+    def test_layouts_same_runs(self):
+        '''Both layouts give runs in trace order, past dset9 too.'''
+        columns=dict()
+        for layout in ["groups", "table"]:
+            outfile=os.path.join(self.directory, "{0}.h5".format(layout))
+            read_multiple_naadsmsc(self.trace, outfile, layout=layout)
+            with eventfile.EventFile(outfile) as f:
+                self.assertEqual(len(f), 12)
+                columns[layout]=[[run[x].tolist() for x in eventfile.column_names]
+                    for run in f]
+        self.assertEqual(columns["groups"], columns["table"])
+        table=transition_table(default_transitions())
+        for run, converted in enumerate(columns["table"]):
+            states=synthetic_states(25, 20, 0.1*run, run)
+            expected=[x.tolist() for x in state_changes(states, table)[0]]
+            self.assertEqual(converted[0], expected[0])
+            self.assertEqual(converted[3], expected[3])
+
+    def test_events_from_states(self):
+        '''The loop's events save to the same run as state_changes.'''
+        states=synthetic_states(25, 20, 0.5, 3)
+        outfile=os.path.join(self.directory, "loop.h5")
+        with h5py.File(outfile, "w") as openh5:
+            openh5.create_group("/trajectory")
+            save_h5(openh5, events_from_states(states, default_transitions()))
+        expected=state_changes(states, transition_table(default_transitions()))[0]
+        with eventfile.EventFile(outfile) as f:
+            run=f.run(0)
+            for name, column in zip(eventfile.column_names, expected):
+                self.assertEqual(run[name].tolist(), column.tolist())
+
+    def test_save_checks_columns(self):
+        states=synthetic_states(25, 20, 0.5, 3)
+        events=state_changes(states, transition_table(default_transitions()))[0]
+        rows=list(zip(*events))
+        with h5py.File(os.path.join(self.directory, "bad.h5"), "w") as openh5:
+            openh5.create_group("/trajectory")
+            self.assertRaises(ValueError, save_h5, openh5, rows)
+            self.assertRaises(ValueError, save_h5, openh5,
+                (events[0], events[1], events[2], events[3][:-1]))
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ConvertTest)
 
 
 
 if __name__ == "__main__":
-    parser=DefaultArgumentParser(description="Produces HDF5 event file from trace data")
+    parser=DefaultArgumentParser(description="Produces HDF5 event file from trace data",
+        suite=suite)
     parser.add_argument("--input", dest="infile", action="store",
         default="naadsm.out", help="Input trace from NAADSM")
     parser.add_argument("--output", dest="outfile", action="store",
         default="naadsm.h5", help="HDF5 file with events")
+    parser.add_argument("--compression", dest="compression", action="store",
+        choices=["gzip", "lzf"], default=None,
+        help="Compress event datasets with this filter")
+    parser.add_argument("--compression-level", dest="compression_opts",
+        action="store", type=int, default=None,
+        help="Level from 0 to 9 for gzip compression")
+    parser.add_argument("--max-buffer", dest="max_buffer", action="store",
+        type=int, default=default_max_buffer>>20,
+        help="Largest state array for one run, in MB")
+    parser.add_argument("--jobs", dest="jobs", action="store", type=int,
+        default=1, help="Number of processes which parse and diff runs")
+    parser.add_argument("--layout", dest="layout", action="store",
+        choices=["groups", "table"], default=None,
+        help="One dsetN group per run, or one table of all runs")
+    parser.add_function("resume",
+        "keep runs already in the output and convert the rest")
+    parser.add_function("append",
+        "convert runs added to the trace since the offset recorded in the output")
+    parser.add_function("final",
+        "with --append, also convert the last run, as the trace is complete")
+    parser.add_function("shuffle",
+        "apply the byte shuffle filter before compression")
+    parser.add_function("chunked", "store event datasets in chunks")
+    parser.add_function("benchmark",
+        "compare transition loops with state_changes on a synthetic trace")
+    parser.add_argument("--units", dest="units", action="store", type=int,
+        default=5000, help="Number of units for --benchmark")
+    parser.add_argument("--days", dest="days", action="store", type=int,
+        default=365, help="Number of days for --benchmark")
     args=parser.parse_args()
 
-    allowed_transitions=read_multiple_naadsmsc(args.infile, args.outfile)
-    logger.info("allowed transitions are {0}.".format(allowed_transitions))
+    if args.benchmark:
+        benchmark_transitions(args.units, args.days)
+    else:
+        allowed_transitions=read_multiple_naadsmsc(args.infile, args.outfile,
+            max_buffer=args.max_buffer<<20, resume=args.resume,
+            jobs=args.jobs, append=args.append, final=args.final,
+            compression=args.compression, compression_opts=args.compression_opts,
+            shuffle=args.shuffle, chunked=args.chunked, layout=args.layout)
+        logger.info("allowed transitions are {0}.".format(allowed_transitions))
 
 
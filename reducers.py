@@ -0,0 +1,333 @@
+'''
+Reducers which summarize values from a stream of runs. Each one
+takes values with add(), combines with another of its kind with
+merge(), and is saved to and loaded from an HDF5 group, so the
+summary of runs already read is kept in the event file and
+statistics for runs added later merge in without reading old runs.
+
+  Histogram      exact counts of non-negative integers
+  Moments        count, mean, variance, min and max, by Welford's method
+  QuantileSketch approximate quantiles in bounded memory, a KLL sketch
+
+Summaries are groups under /summary, one per analysis, holding
+a group per reducer and a run_count attribute with the number of
+runs they include.
+'''
+import logging
+import unittest
+import numpy as np
+import h5py
+from default_parser import DefaultArgumentParser
+
+logger=logging.getLogger(__file__)
+
+summary_path="/summary"
+kind_attr="kind"
+run_count_attr="run_count"
+
+
+class Histogram(object):
+    '''Counts of each non-negative integer value, growing as needed.'''
+    kind="histogram"
+
+    def __init__(self, length=0):
+        self.counts=np.zeros((length,), dtype=np.int64)
+
+    def grow(self, length):
+        if length>len(self.counts):
+            larger=np.zeros((length,), dtype=np.int64)
+            larger[:len(self.counts)]=self.counts
+            self.counts=larger
+
+    def add(self, values, weights=None):
+        values=np.asarray(values, dtype=np.int64)
+        if len(values)>0 and values.min()<0:
+            raise ValueError("Histogram values must not be negative")
+        self.add_counts(np.bincount(values, weights).astype(np.int64))
+
+    def add_counts(self, counts):
+        '''Adds counts already binned, so counts[i] is for value i.'''
+        self.grow(len(counts))
+        self.counts[:len(counts)]+=counts
+
+    def merge(self, other):
+        self.add_counts(other.counts)
+        return self
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def quantile(self, q):
+        '''Smallest value with at least a fraction q of counts at or below it.'''
+        cumulative=np.cumsum(self.counts)
+        if len(cumulative)==0 or cumulative[-1]==0:
+            return np.nan
+        return int(np.searchsorted(cumulative, q*cumulative[-1]))
+
+    def save(self, group):
+        group.create_dataset("counts", data=self.counts)
+
+    @classmethod
+    def load(cls, group):
+        histogram=cls()
+        histogram.counts=group["counts"][()].astype(np.int64)
+        return histogram
+
+
+class Moments(object):
+    '''
+    Count, mean and sum of squared deviations, updated a batch
+    at a time and merged with the pairwise formula of Chan et al.
+    '''
+    kind="moments"
+
+    def __init__(self):
+        self.count=0
+        self.mean=0.0
+        self.m2=0.0
+        self.minimum=np.inf
+        self.maximum=-np.inf
+
+    def combine(self, count, mean, m2, minimum, maximum):
+        total=self.count+count
+        if count==0:
+            return
+        delta=mean-self.mean
+        self.mean+=delta*count/total
+        self.m2+=m2+delta*delta*self.count*count/total
+        self.count=total
+        self.minimum=min(self.minimum, minimum)
+        self.maximum=max(self.maximum, maximum)
+
+    def add(self, values):
+        values=np.asarray(values, dtype=np.float64)
+        if len(values)>0:
+            mean=values.mean()
+            self.combine(len(values), mean, float(((values-mean)**2).sum()),
+                values.min(), values.max())
+
+    def merge(self, other):
+        self.combine(other.count, other.mean, other.m2, other.minimum,
+            other.maximum)
+        return self
+
+    def variance(self, ddof=0):
+        if self.count<=ddof:
+            return np.nan
+        return self.m2/(self.count-ddof)
+
+    def save(self, group):
+        for name in ["count", "mean", "m2", "minimum", "maximum"]:
+            group.attrs[name]=getattr(self, name)
+
+    @classmethod
+    def load(cls, group):
+        moments=cls()
+        moments.count=int(group.attrs["count"])
+        for name in ["mean", "m2", "minimum", "maximum"]:
+            setattr(moments, name, float(group.attrs[name]))
+        return moments
+
+
+class QuantileSketch(object):
+    '''
+    A KLL sketch. Level i holds items which each stand for 2**i
+    values. When a level is over its capacity, its items are sorted
+    and every other one, from a random start, moves up a level. Top
+    levels hold k items and lower levels shrink by 2/3 each, so the
+    sketch keeps about 3k items. Until the first compaction it is
+    exact.
+    '''
+    kind="kll"
+
+    def __init__(self, k=200, seed=0):
+        self.k=k
+        self.count=0
+        self.levels=[np.zeros((0,), dtype=np.float64)]
+        self.rng=np.random.RandomState(seed)
+
+    def capacity(self, level):
+        depth=len(self.levels)-level-1
+        return max(2, int(np.ceil(self.k*(2.0/3.0)**depth)))
+
+    def compress(self):
+        level=0
+        while level<len(self.levels):
+            items=self.levels[level]
+            if len(items)>self.capacity(level):
+                if level+1==len(self.levels):
+                    self.levels.append(np.zeros((0,), dtype=np.float64))
+                items=np.sort(items)
+                # An odd item out stays at this level.
+                kept=items[len(items)-len(items)%2:]
+                paired=items[:len(items)-len(items)%2]
+                promoted=paired[self.rng.randint(2)::2]
+                self.levels[level]=kept
+                self.levels[level+1]=np.concatenate([self.levels[level+1], promoted])
+            level+=1
+
+    def add(self, values):
+        values=np.asarray(values, dtype=np.float64).ravel()
+        self.count+=len(values)
+        self.levels[0]=np.concatenate([self.levels[0], values])
+        self.compress()
+
+    def merge(self, other):
+        for level, items in enumerate(other.levels):
+            if level==len(self.levels):
+                self.levels.append(np.zeros((0,), dtype=np.float64))
+            self.levels[level]=np.concatenate([self.levels[level], items])
+        self.count+=other.count
+        self.compress()
+        return self
+
+    def weighted(self):
+        '''Sorted items and the number of values each stands for.'''
+        items=np.concatenate(self.levels)
+        weights=np.concatenate([np.full(len(x), 1<<level, dtype=np.int64)
+            for (level, x) in enumerate(self.levels)])
+        order=np.argsort(items, kind="mergesort")
+        return items[order], weights[order]
+
+    def quantile(self, q):
+        '''Approximate quantiles, with the same rank rule as Histogram.'''
+        items, weights=self.weighted()
+        if len(items)==0:
+            return np.nan*np.asarray(q)
+        cumulative=np.cumsum(weights)
+        idx=np.searchsorted(cumulative, np.asarray(q)*cumulative[-1])
+        return items[np.minimum(idx, len(items)-1)]
+
+    def save(self, group):
+        group.attrs["k"]=self.k
+        group.attrs["count"]=self.count
+        group.create_dataset("items", data=np.concatenate(self.levels))
+        group.create_dataset("level_sizes",
+            data=np.array([len(x) for x in self.levels], dtype=np.int64))
+
+    @classmethod
+    def load(cls, group):
+        count=int(group.attrs["count"])
+        sketch=cls(int(group.attrs["k"]), seed=count%(1<<31))
+        sketch.count=count
+        bounds=np.cumsum(np.concatenate([[0], group["level_sizes"][()]]))
+        items=group["items"][()]
+        sketch.levels=[items[bounds[i]:bounds[i+1]] for i in range(len(bounds)-1)]
+        return sketch
+
+
+kinds=dict([(x.kind, x) for x in [Histogram, Moments, QuantileSketch]])
+
+
+def save_summary(openh5, name, reducers, run_cnt, attrs=None):
+    '''
+    Replaces /summary/name with a group per reducer, where reducers
+    is a dictionary from name to reducer, and the number of runs.
+    '''
+    parent=openh5.require_group(summary_path)
+    if name in parent:
+        del parent[name]
+    group=parent.create_group(name)
+    group.attrs[run_count_attr]=run_cnt
+    for key, value in (attrs or dict()).items():
+        group.attrs[key]=value
+    for key, reducer in reducers.items():
+        child=group.create_group(key)
+        child.attrs[kind_attr]=reducer.kind
+        reducer.save(child)
+
+
+def load_summary(openh5, name):
+    '''
+    Returns the reducers, run count and other attributes saved
+    as /summary/name, or None when there is no such summary.
+    '''
+    path="{0}/{1}".format(summary_path, name)
+    if path not in openh5:
+        return None
+    group=openh5[path]
+    reducers=dict()
+    for key in group:
+        kind=group[key].attrs[kind_attr]
+        kind=kind.decode() if isinstance(kind, bytes) else str(kind)
+        reducers[key]=kinds[kind].load(group[key])
+    attrs=dict([(k, v) for (k, v) in group.attrs.items() if k!=run_count_attr])
+    return reducers, int(group.attrs[run_count_attr]), attrs
+
+
+class ReducerTest(unittest.TestCase):
+    '''Checks reducers against numpy on the whole of their input.'''
+    def setUp(self):
+        rng=np.random.RandomState(3)
+        self.parts=[rng.poisson(4.0*(i+1), 1000+100*i) for i in range(8)]
+        self.values=np.concatenate(self.parts)
+
+    def test_histogram(self):
+        histogram=Histogram()
+        for part in self.parts:
+            histogram.merge(self.single(Histogram, part))
+        self.assertTrue(np.array_equal(histogram.counts, np.bincount(self.values)))
+        self.assertEqual(histogram.quantile(0.5), int(np.percentile(
+            self.values, 50, method="inverted_cdf")))
+
+    def single(self, cls, part):
+        reducer=cls()
+        reducer.add(part)
+        return reducer
+
+    def test_moments(self):
+        moments=Moments()
+        for part in self.parts:
+            moments.merge(self.single(Moments, part))
+        self.assertEqual(moments.count, len(self.values))
+        self.assertAlmostEqual(moments.mean, self.values.mean())
+        self.assertAlmostEqual(moments.variance(1), self.values.var(ddof=1))
+        self.assertEqual(moments.maximum, self.values.max())
+
+    def test_sketch(self):
+        sketch=QuantileSketch(k=100)
+        for part in self.parts:
+            sketch.merge(self.single(QuantileSketch, part))
+        self.assertEqual(sketch.count, len(self.values))
+        self.assertLess(len(np.concatenate(sketch.levels)), 400)
+        ordered=np.sort(self.values)
+        for q in [0.1, 0.5, 0.9]:
+            rank=np.searchsorted(ordered, sketch.quantile(q), side="right")
+            self.assertLess(abs(rank/float(len(ordered))-q), 0.05)
+
+    def test_exact_sketch(self):
+        sketch=self.single(QuantileSketch, self.parts[0][:100])
+        self.assertEqual(sketch.quantile(0.5), Histogram().merge(
+            self.single(Histogram, self.parts[0][:100])).quantile(0.5))
+
+    def test_save(self):
+        reducers={"h" : self.single(Histogram, self.values),
+            "m" : self.single(Moments, self.values),
+            "q" : self.single(QuantileSketch, self.values)}
+        with h5py.File("reducer_test.h5", "w", driver="core",
+                backing_store=False) as f:
+            save_summary(f, "test", reducers, 8)
+            loaded, run_cnt, attrs=load_summary(f, "test")
+        self.assertEqual(run_cnt, 8)
+        self.assertTrue(np.array_equal(loaded["h"].counts, reducers["h"].counts))
+        self.assertEqual(loaded["m"].m2, reducers["m"].m2)
+        self.assertEqual(loaded["q"].quantile(0.3), reducers["q"].quantile(0.3))
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(ReducerTest)
+
+
+
+if __name__ == "__main__":
+    parser=DefaultArgumentParser(description="Streaming reducers for ensembles",
+        suite=suite)
+    parser.add_argument("--input", dest="infile", action="store",
+        default=None, help="HDF5 file whose summaries to show")
+    args=parser.parse_args()
+    if args.infile is not None:
+        with h5py.File(args.infile, "r") as f:
+            for name in f.get(summary_path, dict()):
+                reducers, run_cnt, attrs=load_summary(f, name)
+                logger.info("{0}: {1} runs, {2}".format(name, run_cnt,
+                    ", ".join(sorted(reducers.keys()))))
@@ -5,110 +5,324 @@ to occur.
 '''
 import csv
 import logging
+import os
+import shutil
+import tempfile
+import unittest
 import h5py
 import numpy as np
 import matplotlib.pyplot as plt
-from default_parser import DefaultArgumentParser
+from default_parser import DefaultArgumentParser, timed
+import cache
+import eventfile
+import read_naadsm
+import reducers
 
 logger=logging.getLogger(__file__)
 
 
 
-def first_dataset(filename, functor):
-    f=h5py.File(filename, "r")
-    sizes=list()
-    infections=set([0, 5, 6])
-    for trajgroup in f["/trajectory"]:
-        if trajgroup.startswith("dset"):
-            functor(trajgroup)
-            f.close()
-            return
-    f.close()
+def foreach_dataset(filename, functor):
+    with eventfile.EventFile(filename) as f:
+        for run in f:
+            with timed("foreach_dataset", runs=1, rows=len(run)):
+                functor(run)
 
 
-def foreach_dataset(filename, functor):
-    logger.debug("Opening {0}".format(filename))
-    f=h5py.File(filename, "r")
-    sizes=list()
-    infections=set([0, 5, 6])
-    for trajgroup in f["/trajectory"]:
-        if trajgroup.startswith("dset"):
-            functor(f["/trajectory/{0}".format(trajgroup)])
-    f.close()
-
-
-class BaseCounts(object):
-    def __init__(self):
-        self.farm_cnt=-1
-        self.run_cnt=0
-        self.day_cnt=-1
+# Farm which has always been treated as the initially infected unit.
+# It starts latent on day 0 instead of susceptible.
+initial_farm=20
+# Event codes Tracking knows how to follow.
+tracked_events=[0, 1, 3, 5, 7]
+# Histograms kept by Tracking, and the group under /summary
+# where they are saved.
+histogram_names=["susceptible_observed", "susceptible_censored", "latent",
+    "latentc", "clinical", "clinicalc", "runs_ending", "farms_ending"]
+summary_name="residence"
 
-    def __call__(self, trajgroup):
-        farm_cnt=max(trajgroup["Who"])+1
-        self.farm_cnt=max(self.farm_cnt, farm_cnt)
-        self.day_cnt=max(self.day_cnt, trajgroup["When"][-1])
-        self.run_cnt+=1
+
+def grown(histogram, length):
+    '''The histogram, padded with zeros to at least length bins.'''
+    if len(histogram)>=length:
+        return histogram
+    larger=np.zeros((length,), dtype=histogram.dtype)
+    larger[:len(histogram)]=histogram
+    return larger
 
 
-def binned(observed, censored, measured, end_day):
-    delta_t=measured[:,1]-measured[:,0]
-    counts=np.histogram(delta_t[delta_t>=0], bins=range(0, len(observed)+1, 1))[0]
-    observed+=counts
-    has_start=set(np.where(measured[:,0]>=0)[0])
-    no_end=set(np.where(measured[:,1]<0)[0])
-    cens_farms=list(has_start & no_end)
-    cens_counts=np.histogram(end_day-measured[cens_farms,0],
-        bins=range(0, len(censored)+1, 1))[0]
-    censored+=cens_counts
+def histogram_counts(name):
+    '''A read-only attribute for the counts of one of Tracking's histograms.'''
+    return property(lambda self: self.histograms[name].counts)
+
+
+def binned(start, end, end_day):
+    '''
+    Given the day each farm entered and left a state, returns counts
+    of days spent in the state by farms which left it, and counts of
+    days until end_day for farms which entered but never left, the
+    censored observations. Start of -1 means never entered and
+    negative end means never left.
+    '''
+    delta_t=end-start
+    observed=np.bincount(delta_t[delta_t>=0])
+    cens_days=np.floor(end_day-start[(start>=0) & (end<0)]).astype(np.int64)
+    censored=np.bincount(cens_days[cens_days>=0])
+    return observed, censored
 
 
 class Tracking(object):
-    def __init__(self, farm_cnt, run_cnt, day_cnt):
+    '''
+    Histograms of days spent susceptible (infect), latent and clinical,
+    with censored counts in infectc, latentc and clinicalc. Each run is
+    read once, and entry and exit days of each state are found for all
+    farms at once with masks by event code and np.maximum.at, which
+    keeps the last event per farm because events are in time order.
+    Histograms are reducers.Histogram, which grow as longer runs are
+    seen. Farms past the largest index seen in a run are added to the
+    susceptible censored counts when they are read, so the farm count
+    need not be known ahead. Trackings of different runs merge, and
+    are saved to /summary/residence of the event file.
+    '''
+    susceptible_observed=histogram_counts("susceptible_observed")
+    susceptible_censored=histogram_counts("susceptible_censored")
+    latent=histogram_counts("latent")
+    latentc=histogram_counts("latentc")
+    clinical=histogram_counts("clinical")
+    clinicalc=histogram_counts("clinicalc")
+    runs_ending=histogram_counts("runs_ending")
+    farms_ending=histogram_counts("farms_ending")
+
+    def __init__(self, farm_cnt=0, run_cnt=0, day_cnt=0):
         self.farm_cnt=farm_cnt
         self.run_cnt=run_cnt
-        # This is a count of times it took this many days.
-        self.infect=np.zeros((day_cnt+1,), np.int)
-        # The c version is censors.
-        self.infectc=np.zeros((day_cnt+1,), np.int)
-        self.latent=np.zeros((day_cnt+1,), np.int)
-        self.latentc=np.zeros((day_cnt+1,), np.int)
-        self.clinical=np.zeros((day_cnt+1,), np.int)
-        self.clinicalc=np.zeros((day_cnt+1,), np.int)
+        self.day_cnt=day_cnt
+        # Each histogram is a count of times it took this many days.
+        # The c versions are censors. Runs ending on each day, and the
+        # sum of their farm extents, are for farms a run never reached.
+        self.histograms=dict([(name, reducers.Histogram(day_cnt+1))
+            for name in histogram_names])
         self.run_idx=0
 
+    @property
+    def infect(self):
+        # The initial farm enters on day -1, so it can stay one day
+        # longer than the last day. It has always been counted in the
+        # last bin, which np.histogram closed on the right.
+        infect=grown(self.susceptible_observed, self.day_cnt+1).copy()
+        if len(infect)>self.day_cnt+1:
+            infect[self.day_cnt]+=infect[self.day_cnt+1:].sum()
+            infect=infect[:self.day_cnt+1]
+        return infect
+
+    @property
+    def infectc(self):
+        length=max(len(self.susceptible_censored), len(self.runs_ending))
+        unseen=self.farm_cnt*grown(self.runs_ending, length)-grown(
+            self.farms_ending, length)
+        return grown(self.susceptible_censored, length)+unseen
+
+    def add(self, name, counts):
+        self.histograms[name].add_counts(counts)
+
+    def merge(self, other):
+        for name in histogram_names:
+            self.histograms[name].merge(other.histograms[name])
+        self.farm_cnt=max(self.farm_cnt, other.farm_cnt)
+        self.day_cnt=max(self.day_cnt, other.day_cnt)
+        self.run_idx+=other.run_idx
+        return self
+
+    def save(self, openh5):
+        reducers.save_summary(openh5, summary_name, self.histograms,
+            self.run_idx, {"farm_cnt" : self.farm_cnt, "day_cnt" : self.day_cnt})
+
+    @classmethod
+    def load(cls, openh5):
+        '''The Tracking saved in the file, or None if there is none.'''
+        saved=reducers.load_summary(openh5, summary_name)
+        if saved is None:
+            return None
+        histograms, run_cnt, attrs=saved
+        tracking=cls(int(attrs["farm_cnt"]), run_cnt, int(attrs["day_cnt"]))
+        tracking.histograms.update(histograms)
+        tracking.run_idx=run_cnt
+        return tracking
+
     def __call__(self, trajgroup):
-        # each state array is (enabling time, firing time)
-        # for each farm. Initialize with -1 when there is no enabling
-        # time. Make firing time -2 so that -2 - (-1)= -1, so clearly
-        # not a time difference.
-        infect=np.ones((self.farm_cnt, 2), np.int)
-        infect[:,0]*=0
-        infect[:,1]*=-1
-        infect[20,0]=-1
-        latent=np.ones((self.farm_cnt, 2), np.int)
-        latent[:,0]*=-1
-        latent[:,1]*=-2
-        latent[20,0]=0
-        clinical=np.ones((self.farm_cnt, 2), np.int)
+        events=np.asarray(trajgroup["Event"])
+        who=np.asarray(trajgroup["Whom"])
+        when=np.asarray(trajgroup["When"])
+        unexpected=~np.isin(events, tracked_events)
+        if np.any(unexpected):
+            raise ValueError("Unexpected event {0}".format(events[unexpected][0]))
+        if len(who)>0 and who.min()<0:
+            raise ValueError("Event for a negative farm index")
+
+        farm_cnt=initial_farm+1
+        if len(events)>0:
+            farm_cnt=max(farm_cnt, int(np.max(trajgroup["Who"]))+1, int(who.max())+1)
+        self.farm_cnt=max(self.farm_cnt, farm_cnt)
+        day=when.astype(np.int64)
+        today=when[-1] if len(when)>0 else -1
+
+        # Enabling and firing day of each state for each farm.
+        # -1 is no enabling time. Firing is -2 so that -2 - (-1) = -1
+        # is clearly not a time difference.
+        infect_start=np.zeros((farm_cnt,), np.int64)
+        infect_end=-np.ones((farm_cnt,), np.int64)
+        infect_start[initial_farm]=-1
+        latent_start=-np.ones((farm_cnt,), np.int64)
+        latent_end=-2*np.ones((farm_cnt,), np.int64)
+        latent_start[initial_farm]=0
+        clinical_start=-np.ones((farm_cnt,), np.int64)
+        clinical_end=-2*np.ones((farm_cnt,), np.int64)
+
+        infected=(events==0) | (events==5)
+        progressed=(events==1) | (events==7) | (events==5)
+        clinical=progressed | (events==3)
+        np.maximum.at(infect_end, who[infected], day[infected])
+        np.maximum.at(latent_start, who[infected], day[infected])
+        np.maximum.at(latent_end, who[progressed], day[progressed])
+        np.maximum.at(clinical_start, who[clinical], day[clinical])
+
+        observed, censored=binned(infect_start, infect_end, today)
+        self.add("susceptible_observed", observed)
+        self.add("susceptible_censored", censored)
+        observed, censored=binned(latent_start, latent_end, today)
+        self.add("latent", observed)
+        self.add("latentc", censored)
+        observed, censored=binned(clinical_start, clinical_end, today)
+        self.add("clinical", observed)
+        # Censored clinical counts have always gone to the observed
+        # histogram, so clinicalc stays empty. Kept to match earlier output.
+        self.add("clinical", censored)
+
+        if today>=0:
+            self.day_cnt=max(self.day_cnt, int(np.floor(today)))
+            ending=np.zeros((int(np.floor(today))+1,), np.int64)
+            ending[-1]=1
+            self.add("runs_ending", ending)
+            self.add("farms_ending", ending*farm_cnt)
+        self.run_idx+=1
+
+
+def write_csv(name, observed, censored):
+    logger.debug("{0} observed".format(observed))
+    logger.debug("{0} censored".format(censored))
+    with open("{0}.csv".format(name), "w") as csvfile:
+        writer=csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(["trial", "value", "censored"])
+        idx=1
+        for oidx in range(len(observed)):
+            for i in range(observed[oidx]):
+                writer.writerow([idx, oidx, 1])
+                idx+=1
+        for oidx in range(len(censored)):
+            for i in range(censored[oidx]):
+                writer.writerow([idx, oidx, 0])
+                idx+=1
+
+
+def weighted_rows(observed, censored):
+    '''
+    Columns value, censored and count, with one entry for each
+    nonzero bin. censored is 1 for an observed exit and 0 for a
+    censored observation, as in the per-observation CSV.
+    '''
+    values=list()
+    flags=list()
+    counts=list()
+    for histogram, flag in [(observed, 1), (censored, 0)]:
+        bins=np.nonzero(histogram)[0]
+        values.append(bins)
+        flags.append(np.full(len(bins), flag, dtype=np.int64))
+        counts.append(np.asarray(histogram)[bins])
+    return np.concatenate(values), np.concatenate(flags), np.concatenate(counts)
+
+
+def write_weighted_csv(name, observed, censored):
+    '''One row per (value, censored) pair, with a count of observations.'''
+    with open("{0}.csv".format(name), "w") as csvfile:
+        writer=csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(["value", "censored", "count"])
+        for row in zip(*[x.tolist() for x in weighted_rows(observed, censored)]):
+            writer.writerow(row)
+
+
+def write_h5(name, observed, censored):
+    '''The weighted table as datasets value, censored and count.'''
+    with h5py.File("{0}.h5".format(name), "w") as f:
+        for column, data in zip(["value", "censored", "count"],
+                weighted_rows(observed, censored)):
+            f.create_dataset(column, data=data)
+
+
+def update_tracking(filename):
+    '''
+    Tracking of every run in the event file, starting from the one
+    saved in it and reading only runs added since, then saved back.
+    '''
+    with h5py.File(filename, "a") as openh5:
+        f=eventfile.EventFile(openh5)
+        tracking=Tracking.load(openh5)
+        if tracking is None or tracking.run_idx>len(f):
+            tracking=Tracking()
+        added=f.added_since(tracking.run_idx)
+        logger.info("Adding {0} runs to {1} summarized".format(len(added),
+            tracking.run_idx))
+        for idx in added:
+            tracking(f.run(idx))
+        tracking.save(openh5)
+    return tracking
+
+
+writers={"rows" : write_csv, "weighted" : write_weighted_csv, "h5" : write_h5}
+
+
+class LoopTracking(object):
+    '''
+    The Tracking which read events one at a time, before the single
+    pass, kept to check the pass writes the same histograms. It needs
+    the farm and day counts of the whole ensemble ahead.
+    '''
+    def __init__(self, farm_cnt, day_cnt):
+        self.farm_cnt=farm_cnt
+        self.infect=np.zeros((day_cnt+1,), np.int64)
+        self.infectc=np.zeros((day_cnt+1,), np.int64)
+        self.latent=np.zeros((day_cnt+1,), np.int64)
+        self.latentc=np.zeros((day_cnt+1,), np.int64)
+        self.clinical=np.zeros((day_cnt+1,), np.int64)
+        self.clinicalc=np.zeros((day_cnt+1,), np.int64)
+
+    def binned(self, observed, censored, measured, end_day):
+        delta_t=measured[:,1]-measured[:,0]
+        observed+=np.histogram(delta_t[delta_t>=0],
+            bins=range(0, len(observed)+1, 1))[0]
+        has_start=set(np.where(measured[:,0]>=0)[0])
+        no_end=set(np.where(measured[:,1]<0)[0])
+        cens_farms=list(has_start & no_end)
+        censored+=np.histogram(end_day-measured[cens_farms,0],
+            bins=range(0, len(censored)+1, 1))[0]
+
+    def __call__(self, trajgroup):
+        infect=np.zeros((self.farm_cnt, 2), np.int64)
+        infect[:,1]=-1
+        infect[initial_farm,0]=-1
+        latent=np.ones((self.farm_cnt, 2), np.int64)
+        latent[:,0]=-1
+        latent[:,1]=-2
+        latent[initial_farm,0]=0
+        clinical=np.ones((self.farm_cnt, 2), np.int64)
         clinical[:,0]=-1
         clinical[:,1]=-2
         events=trajgroup["Event"]
         who=trajgroup["Whom"]
         when=trajgroup["When"]
-        transitions_type={(0,1) : 0, (1,3) : 1, (3,4) : 3,
-            (4,0) : 4, (0,3) : 5, (0,4) : 6, (1,4) : 8}
-        # (0,1), (0,3), (1,3), (3,4)
         today=-1
         for idx in range(len(events)):
             e=events[idx]
             today=when[idx]
             if e==0:
-                if (who[idx]==20):
-                    logger.debug("20 had an infection")
-                if (who[idx]<0):
-                    logger.error("writing to a negative who")
-                if (who[idx]>=self.farm_cnt):
-                    logger.error("farm index too large")
                 infect[who[idx]][1]=int(when[idx])
                 latent[who[idx]][0]=int(when[idx])
             elif e==5:
@@ -121,53 +335,82 @@ class Tracking(object):
                 clinical[who[idx]][0]=int(when[idx])
             elif e==3:
                 clinical[who[idx]][0]=int(when[idx])
-            else:
-                logger.error("Unexpected event {0}".format(e))
-                assert(False)
+        self.binned(self.infect, self.infectc, infect, today)
+        self.binned(self.latent, self.latentc, latent, today)
+        self.binned(self.clinical, self.clinical, clinical, today)
 
-        binned(self.infect, self.infectc, infect, today)
-        binned(self.latent, self.latentc, latent, today)
-        binned(self.clinical, self.clinical, clinical, today)
 
-        self.run_idx+=1
+class TrackingTest(unittest.TestCase):
+    '''Compares the CSV files of the single pass with those of the loop.'''
+    def setUp(self):
+        self.directory=tempfile.mkdtemp()
+        self.h5=os.path.join(self.directory, "events.h5")
+        table=read_naadsm.transition_table(read_naadsm.default_transitions())
+        with h5py.File(self.h5, "w") as f:
+            f.create_group("/trajectory")
+            writer=read_naadsm.EventWriter(f)
+            # Short runs leave farms latent and clinical at the end, censored.
+            for seed in range(8):
+                states=read_naadsm.synthetic_states(60, 12+3*seed, 0.1+0.1*seed, seed)
+                writer.save(read_naadsm.state_changes(states, table)[0])
 
+    def tearDown(self):
+        shutil.rmtree(self.directory)
 
-def write_csv(name, observed, censored):
-    logger.debug("{0} observed".format(observed))
-    logger.debug("{0} censored".format(censored))
-    with open("{0}.csv".format(name), "w") as csvfile:
-        writer=csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(["trial", "value", "censored"])
-        idx=1
-        for oidx in range(len(observed)):
-            for i in range(observed[oidx]):
-                writer.writerow([idx, oidx, 1])
-                idx+=1
-        for oidx in range(len(censored)):
-            for i in range(censored[oidx]):
-                writer.writerow([idx, oidx, 0])
-                idx+=1
+    def written(self, tracking, label):
+        lines=dict()
+        for state, observed, censored in [
+                ("susceptible", tracking.infect, tracking.infectc),
+                ("latent", tracking.latent, tracking.latentc),
+                ("clinical", tracking.clinical, tracking.clinicalc)]:
+            name=os.path.join(self.directory, "{0}_{1}".format(state, label))
+            write_csv(name, observed, censored)
+            with open(name+".csv") as csvfile:
+                lines[state]=csvfile.read().splitlines()
+        return lines
+
+    def test_same_csv(self):
+        farm_cnt=0
+        day_cnt=0
+        with eventfile.EventFile(self.h5) as f:
+            for run in f:
+                farm_cnt=max(farm_cnt, int(run["Who"].max())+1)
+                day_cnt=max(day_cnt, int(run["When"][-1]))
+            loop=LoopTracking(farm_cnt, day_cnt)
+            for run in f:
+                loop(run)
+        tracking=Tracking()
+        foreach_dataset(self.h5, tracking)
+        self.assertTrue(loop.latentc.sum()>0)
+        self.assertEqual(self.written(tracking, "pass"), self.written(loop, "loop"))
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(TrackingTest)
 
 
 
 if __name__ == "__main__":
-    parser=DefaultArgumentParser(description="Finds residence time in states.")
+    parser=DefaultArgumentParser(description="Finds residence time in states.",
+        suite=suite)
     parser.add_argument("--input", dest="infile", action="store",
         default="naadsm.h5", help="Input HDF5 file with ensemble of events")
     parser.add_argument("--id", dest="ID", action="store",
         default="", help="Specify scenario ID label for output files")
+    parser.add_argument("--format", dest="format", action="store",
+        choices=sorted(writers.keys()), default="rows",
+        help="rows: a CSV row per observation, weighted: a CSV row per day "+
+        "with a count, h5: the weighted table in HDF5")
+    parser.add_function("summary", "keep histograms in /summary of the input "+
+        "and read only runs added since they were saved")
+    parser.add_argument("--cache-dir", dest="cache_dir", action="store",
+        default=None, help="Reuse outputs kept in this cache directory")
+    parser.add_argument("--cache-size", dest="cache_size", action="store",
+        type=int, default=cache.default_max_bytes>>20,
+        help="Size limit of the cache, in MB")
 
     args=parser.parse_args()
 
-    counts=BaseCounts()
-    foreach_dataset(args.infile, counts)
-    logger.info("Number of farms {0}.".format(counts.farm_cnt))
-    logger.info("Number of runs {0}.".format(counts.run_cnt))
-    logger.info("Largest number of days {0}.".format(counts.day_cnt))
-
-    tracking=Tracking(counts.farm_cnt, counts.run_cnt, counts.day_cnt)
-    foreach_dataset(args.infile, tracking)
-
     if args.ID == "":
         susceptible_name = "susceptible"
         latent_name = "latent"
@@ -176,6 +419,25 @@ if __name__ == "__main__":
         susceptible_name = "susceptible" + "_%s"%args.ID
         latent_name = "latent" + "_%s"%args.ID
         clinical_name = "clinical" + "_%s"%args.ID
-    write_csv(susceptible_name, tracking.infect, tracking.infectc)
-    write_csv(latent_name, tracking.latent, tracking.latentc)
-    write_csv(clinical_name, tracking.clinical, tracking.clinicalc)
+    write=writers[args.format]
+    extension="h5" if args.format=="h5" else "csv"
+    outputs=["{0}.{1}".format(x, extension)
+        for x in [susceptible_name, latent_name, clinical_name]]
+
+    def compute():
+        if args.summary:
+            tracking=update_tracking(args.infile)
+        else:
+            tracking=Tracking()
+            foreach_dataset(args.infile, tracking)
+        logger.info("Number of farms {0}.".format(tracking.farm_cnt))
+        logger.info("Number of runs {0}.".format(tracking.run_idx))
+        logger.info("Largest number of days {0}.".format(len(tracking.infect)-1))
+        write(susceptible_name, tracking.infect, tracking.infectc)
+        write(latent_name, tracking.latent, tracking.latentc)
+        write(clinical_name, tracking.clinical, tracking.clinicalc)
+
+    # Summaries change the input file, so those runs aren't cached.
+    cache.cached(None if args.summary else args.cache_dir, args.cache_size<<20,
+        "residence_histogram", [args.infile], {"format" : args.format},
+        outputs, compute)
@@ -0,0 +1,304 @@
+'''
+Kaplan-Meier survival of the days farms spend in each state, the
+fit plot_individual_dist.R makes, computed with numpy and drawn with
+matplotlib, so the pipeline needs no R. It works on histograms of
+observed and censored days, either those of residence_histogram.Tracking,
+read from the event file, or those in the files residence_histogram.py
+writes.
+
+  python survival.py --input naadsm.h5 --id ID
+  python survival.py --name clinical_ID,latent_ID,susceptible_ID
+  python survival.py --sizes outbreak_hist_ID
+
+The first writes susceptible_ID.pdf, latent_ID.pdf and clinical_ID.pdf
+straight from the event file. The second reads clinical_ID.csv, or a
+newer clinical_ID.h5, and so on. --check-r fits each curve with R's
+survfit too, if R is installed, and logs how far apart they are.
+'''
+import csv
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import h5py
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from default_parser import DefaultArgumentParser, timed
+import residence_histogram
+
+logger=logging.getLogger(__file__)
+
+# Normal quantile for the 95% confidence band, as survfit draws.
+band_z=1.959963984540054
+state_names=["susceptible", "latent", "clinical"]
+
+
+class Curve(object):
+    '''
+    A Kaplan-Meier fit at each day with an exit or a censored
+    observation. Farms censored on a day are at risk on that day,
+    as in survfit. greenwood is the sum over earlier days of
+    d/(n(n-d)), so the standard error of log survival is its root.
+    '''
+    def __init__(self, observed, censored):
+        observed=np.asarray(observed, dtype=np.float64)
+        censored=np.asarray(censored, dtype=np.float64)
+        length=max(len(observed), len(censored))
+        observed=residence_histogram.grown(observed, length)
+        censored=residence_histogram.grown(censored, length)
+        total=observed+censored
+        self.time=np.nonzero(total)[0]
+        # At risk on day t are those leaving on day t or later.
+        self.n_risk=np.cumsum(total[::-1])[::-1][self.time]
+        self.n_event=observed[self.time]
+        self.n_censor=censored[self.time]
+        self.survival=np.cumprod(1.0-self.n_event/self.n_risk)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            terms=self.n_event/(self.n_risk*(self.n_risk-self.n_event))
+        terms[self.n_event==0]=0.0
+        self.greenwood=np.cumsum(terms)
+
+    @property
+    def std_err(self):
+        '''Standard error of log survival, survfit's std.err.'''
+        return np.sqrt(self.greenwood)
+
+    @property
+    def variance(self):
+        '''Greenwood's estimate of the variance of survival.'''
+        return self.survival**2*self.greenwood
+
+    def band(self, z=band_z):
+        '''Lower and upper confidence limits on the log scale, as survfit.'''
+        with np.errstate(invalid="ignore", over="ignore"):
+            spread=np.exp(z*self.std_err)
+            lower=self.survival/spread
+            upper=np.minimum(self.survival*spread, 1.0)
+        missing=(self.survival==0) | ~np.isfinite(self.std_err)
+        lower[missing]=np.nan
+        upper[missing]=np.nan
+        return lower, upper
+
+    def median(self):
+        '''First day survival is at or below a half, or None.'''
+        below=np.nonzero(self.survival<=0.5)[0]
+        return int(self.time[below[0]]) if len(below)>0 else None
+
+
+def read_counts(name):
+    '''
+    Observed and censored histograms from name.csv, or from name.h5
+    if it is newer, in any format residence_histogram.py writes.
+    '''
+    csvname="{0}.csv".format(name)
+    h5name="{0}.h5".format(name)
+    if os.path.exists(h5name) and (not os.path.exists(csvname) or
+            os.path.getmtime(h5name)>os.path.getmtime(csvname)):
+        with h5py.File(h5name, "r") as f:
+            value, flag, count=[f[x][:] for x in ["value", "censored", "count"]]
+    else:
+        with open(csvname) as csvfile:
+            header=next(csv.reader(csvfile))
+        table=np.loadtxt(csvname, delimiter=",", skiprows=1, dtype=np.int64,
+            ndmin=2)
+        columns=dict([(x, table[:, idx]) for (idx, x) in enumerate(header)])
+        value, flag=columns["value"], columns["censored"]
+        count=columns.get("count", np.ones(len(value), dtype=np.int64))
+    length=int(value.max())+1 if len(value)>0 else 0
+    observed=np.bincount(value[flag==1], weights=count[flag==1], minlength=length)
+    censored=np.bincount(value[flag==0], weights=count[flag==0], minlength=length)
+    return observed.astype(np.int64), censored.astype(np.int64)
+
+
+def plot_curve(curve, name, pdfname):
+    '''Survival as a step from one on day zero, with its band dashed.'''
+    time=np.concatenate([[0], curve.time])
+    fig, ax=plt.subplots()
+    ax.step(time, np.concatenate([[1.0], curve.survival]), where="post",
+        color="black")
+    for limit in curve.band():
+        ax.step(time, np.concatenate([[1.0], limit]), where="post",
+            color="black", linestyle="--", linewidth=0.8)
+    ax.set_ylim(0, 1.02)
+    ax.set_title("Survival for {0}".format(name))
+    ax.set_xlabel("Days")
+    ax.set_ylabel("Survival Fraction")
+    fig.savefig(pdfname)
+    plt.close(fig)
+
+
+def plot_survival(name, observed, censored):
+    '''Fits and writes name.pdf, returning the Curve.'''
+    with timed("kaplan_meier", curves=1):
+        curve=Curve(observed, censored)
+    logger.info("{0}: {1} exits, {2} censored, median {3} days".format(name,
+        int(curve.n_event.sum()), int(curve.n_censor.sum()), curve.median()))
+    with timed("plot_survival", curves=1):
+        plot_curve(curve, name, "{0}.pdf".format(name))
+    return curve
+
+
+def plot_sizes(name):
+    '''Histogram of outbreak sizes in name.csv, from outbreaksize.py, as name.pdf.'''
+    sizes=np.loadtxt("{0}.csv".format(name), delimiter=",", skiprows=1,
+        dtype=np.int64, ndmin=2)[:, 1]
+    fig, ax=plt.subplots()
+    ax.hist(sizes, bins="auto", color="gray", edgecolor="black")
+    ax.set_title("Outbreak size for {0}".format(name))
+    ax.set_xlabel("Count of Farms")
+    ax.set_ylabel("Runs")
+    fig.savefig("{0}.pdf".format(name))
+    plt.close(fig)
+
+
+def tracking_counts(filename, summary=False):
+    '''Observed and censored histograms of each state, from an event file.'''
+    if summary:
+        tracking=residence_histogram.update_tracking(filename)
+    else:
+        tracking=residence_histogram.Tracking()
+        residence_histogram.foreach_dataset(filename, tracking)
+    return {"susceptible" : (tracking.infect, tracking.infectc),
+        "latent" : (tracking.latent, tracking.latentc),
+        "clinical" : (tracking.clinical, tracking.clinicalc)}
+
+
+r_fit='''
+library(survival)
+args <- commandArgs(trailingOnly = TRUE)
+x<-read.csv(args[1])
+fit<-survfit(Surv(x$value, x$censored) ~ 1, weights=x$count)
+write.csv(data.frame(time=fit$time, surv=fit$surv, std.err=fit$std.err),
+  args[2], row.names=FALSE)
+'''
+
+
+def check_with_r(curve, observed, censored):
+    '''
+    Fits the same histograms with R's survfit and returns the largest
+    difference in survival and in std.err, or None if R can't be run.
+    '''
+    directory=tempfile.mkdtemp()
+    try:
+        name=os.path.join(directory, "counts")
+        residence_histogram.write_weighted_csv(name, observed, censored)
+        fitted=os.path.join(directory, "fit.csv")
+        try:
+            subprocess.run(["R", "--no-save", "--slave", "--args",
+                name+".csv", fitted], input=r_fit.encode(), check=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as err:
+            logger.warning("Could not check with R: {0}".format(err))
+            return None
+        table=np.genfromtxt(fitted, delimiter=",", skip_header=1, ndmin=2)
+    finally:
+        shutil.rmtree(directory)
+    if not np.array_equal(table[:, 0], curve.time):
+        logger.error("R fit has days {0}, not {1}".format(table[:, 0], curve.time))
+        return (np.inf, np.inf)
+    finite=np.isfinite(table[:, 2]) & np.isfinite(curve.std_err)
+    return (float(np.abs(table[:, 1]-curve.survival).max()),
+        float(np.abs(table[finite, 2]-curve.std_err[finite]).max(initial=0)))
+
+
+def log_r_check(name, curve, observed, censored):
+    difference=check_with_r(curve, observed, censored)
+    if difference is not None:
+        logger.info("{0}: R survival within {1:.3g}, std.err within {2:.3g}".format(
+            name, *difference))
+
+
+class SurvivalTest(unittest.TestCase):
+    '''Compares the fit with the product over each observation.'''
+    def setUp(self):
+        rng=np.random.RandomState(3)
+        self.observed=np.bincount(rng.randint(0, 20, 300), minlength=25)
+        self.censored=np.bincount(rng.randint(5, 25, 40), minlength=25)
+        self.directory=tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_product(self):
+        curve=Curve(self.observed, self.censored)
+        days=np.concatenate([np.repeat(np.arange(25), self.observed),
+            np.repeat(np.arange(25), self.censored)])
+        exits=np.concatenate([np.ones(self.observed.sum()),
+            np.zeros(self.censored.sum())])
+        survival=1.0
+        greenwood=0.0
+        for idx, day in enumerate(curve.time):
+            at_risk=(days>=day).sum()
+            leaving=exits[days==day].sum()
+            self.assertEqual(curve.n_risk[idx], at_risk)
+            survival*=1.0-leaving/at_risk
+            if leaving>0 and leaving<at_risk:
+                greenwood+=leaving/(at_risk*(at_risk-leaving))
+            self.assertAlmostEqual(curve.survival[idx], survival)
+            if leaving<at_risk:
+                self.assertAlmostEqual(curve.greenwood[idx], greenwood)
+
+    def test_read_counts(self):
+        name=os.path.join(self.directory, "clinical")
+        for writer in [residence_histogram.write_csv,
+                residence_histogram.write_weighted_csv,
+                residence_histogram.write_h5]:
+            writer(name, self.observed, self.censored)
+            observed, censored=read_counts(name)
+            self.assertEqual(observed.tolist(), self.observed.tolist())
+            self.assertEqual(censored.tolist(), self.censored.tolist())
+            if os.path.exists(name+".h5"):
+                os.remove(name+".h5")
+
+    def test_band(self):
+        curve=Curve(self.observed, self.censored)
+        lower, upper=curve.band()
+        finite=np.isfinite(lower)
+        self.assertTrue(np.all(lower[finite]<=curve.survival[finite]))
+        self.assertTrue(np.all(upper[finite]>=curve.survival[finite]))
+        self.assertTrue(np.all(upper[finite]<=1.0))
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromTestCase(SurvivalTest)
+
+
+
+if __name__ == "__main__":
+    parser=DefaultArgumentParser(description="Kaplan-Meier plots of residence times",
+        suite=suite)
+    parser.add_argument("--input", dest="infile", action="store",
+        default=None, help="Event file to fit residence times from")
+    parser.add_argument("--id", dest="ID", action="store",
+        default="", help="Scenario ID label for the PDFs made from --input")
+    parser.add_argument("--name", dest="names", action="store",
+        default=None, help="Comma-separated names of residence_histogram.py "+
+        "outputs, without .csv or .h5, to plot")
+    parser.add_argument("--sizes", dest="sizes", action="store",
+        default=None, help="Name of an outbreaksize.py CSV, without .csv, to plot")
+    parser.add_function("summary", "with --input, use and update /summary/residence")
+    parser.add_argument("--check-r", dest="check_r", action="store_true",
+        default=False, help="Fit each curve with R's survfit too and compare")
+    args=parser.parse_args()
+
+    histograms=list()
+    if args.infile is not None:
+        counts=tracking_counts(args.infile, args.summary)
+        for state in state_names:
+            name=state if args.ID=="" else "{0}_{1}".format(state, args.ID)
+            histograms.append((name, counts[state]))
+    if args.names is not None:
+        for name in args.names.split(","):
+            histograms.append((name, read_counts(name)))
+    for name, (observed, censored) in histograms:
+        curve=plot_survival(name, observed, censored)
+        if args.check_r:
+            log_r_check(name, curve, observed, censored)
+    if args.sizes is not None:
+        plot_sizes(args.sizes)
+    if len(histograms)==0 and args.sizes is None:
+        parser.print_help()